@@ -3,6 +3,7 @@
 import argparse
 import shelve
 from collections import defaultdict
+from doc_meta import DocMeta
 from gensim.parsing.porter import PorterStemmer
 from typing import List
 
@@ -45,10 +46,10 @@ def arg_parse() -> argparse.Namespace:
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description="Additional indexes")
     parser.add_argument(
-        "--root",
-        dest="root",
-        help="Lyrics root directory",
-        default="lyrics/",
+        "--meta",
+        dest="meta",
+        help="Documents metadata file",
+        default="docs.meta",
         type=str,
     )
     return parser.parse_args()
@@ -56,10 +57,6 @@ def arg_parse() -> argparse.Namespace:
 
 if __name__ == "__main__":
     args = arg_parse()
-    docs = [
-        dir + "/" + f
-        for dir in os.listdir(args.root)
-        for f in os.listdir(args.root + dir)
-    ]
+    docs = list(DocMeta(args.meta))
     stemmer = PorterStemmer()
     build_name_index(docs, stemmer)
@@ -0,0 +1,316 @@
+"""This module implements batch querying with throughput and latency report.
+
+Queries are read from a JSONL file, one request object per line, in the
+format of the query server, for example
+    {"id": 1, "q": "nothing AND else", "mode": "boolean", "count": 10}
+    {"id": 2, "q": "nothing else matters", "mode": "ml", "count": 20}
+Responses are written to a JSONL file in the same order, with latency of
+every query in "took_ms". Aggregate QPS and latency percentiles are
+printed, and optionally saved as JSON.
+
+With several workers, every worker process opens its own Indexer (index
+files are memory-mapped, so they share pages of OS page cache) and, if
+needed, Embedder.
+"""
+import argparse
+import json
+import numpy as np
+import time
+from multiprocessing import Pool
+from query import Indexer
+from server import run_request
+from typing import Any, Dict, List, Tuple
+
+# Indexer and Embedder of worker process
+_worker = {}
+
+
+def _init_worker(
+    index_path: str,
+    root: str,
+    meta_path: str,
+    store_path: str,
+    ml: bool,
+    batch_size: int,
+    emb_path: str,
+    ann_path: str,
+    backend: str,
+    threads: int,
+) -> None:
+    """Open Indexer and load Embedder in worker process."""
+    index = _worker["index"] = Indexer(index_path, root, meta_path, store_path)
+    _worker["embedder"] = _worker["embeddings"] = _worker["dense"] = None
+    if ml:
+        from dense_index import load_dense_index
+        from embedder import Embedder
+        from query_ml import load_embeddings
+
+        _worker["embedder"] = Embedder(backend, threads)
+        _worker["embeddings"] = load_embeddings(emb_path, len(index.docs))
+        _worker["dense"] = load_dense_index(ann_path)
+    _worker["batch_size"] = batch_size
+
+
+def _run(request: Any) -> Dict[str, Any]:
+    """Answer request in worker process and measure its latency."""
+    start = time.perf_counter()
+    request_id = None
+    try:
+        if not isinstance(request, dict):
+            raise ValueError("Request must be a JSON object")
+        request_id = request.get("id")
+        response = run_request(
+            _worker["index"],
+            request,
+            _worker["embedder"],
+            _worker["batch_size"],
+            embeddings=_worker["embeddings"],
+            dense=_worker["dense"],
+        )
+    except ValueError as e:
+        response = {"error": str(e)}
+    except Exception as e:
+        # Failed search is an error response, the run goes on
+        response = {"error": "{}: {}".format(type(e).__name__, e)}
+    response["id"] = request_id
+    response["took_ms"] = (time.perf_counter() - start) * 1000
+    return response
+
+
+def read_requests(path: str) -> List[Any]:
+    """Read requests from JSONL file, empty lines are skipped."""
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(
+    responses: List[Dict[str, Any]], elapsed: float
+) -> Dict[str, float]:
+    """Get aggregate throughput and latency of queries.
+
+    Args:
+        responses: Responses with latencies "took_ms".
+        elapsed: Wall time of the whole batch in seconds.
+
+    Returns:
+        Number of queries and errors, QPS, mean and p50, p95, p99
+        latencies in milliseconds.
+
+    """
+    latencies = np.array([r["took_ms"] for r in responses], dtype=float)
+    summary = {
+        "queries": len(responses),
+        "errors": sum(1 for r in responses if "error" in r),
+        "elapsed_s": elapsed,
+        "qps": len(responses) / elapsed if elapsed > 0 else 0.0,
+    }
+    if len(latencies):
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        summary.update(
+            mean_ms=float(latencies.mean()),
+            p50_ms=float(p50),
+            p95_ms=float(p95),
+            p99_ms=float(p99),
+        )
+    return summary
+
+
+def run_batch(
+    requests: List[Any],
+    index_path: str,
+    root: str,
+    meta_path: str,
+    store_path: str = "docs.store",
+    workers: int = 1,
+    batch_size: int = 100,
+    emb_path: str = "embeddings.npy",
+    ann_path: str = "embeddings.faiss",
+    backend: str = "torch",
+    threads: int = 0,
+) -> Tuple[List[Dict[str, Any]], float]:
+    """Answer requests, in a single process or in a pool of workers.
+
+    Args:
+        requests: Request objects.
+        index_path: Index name.
+        root: Directory where songs lyrics is.
+        meta_path: Documents metadata file.
+        store_path: Packed documents file.
+        workers: Number of worker processes, 1 to answer in this process.
+        batch_size: Batch size of embedder.
+        emb_path: Numpy file with embeddings for all texts, memory-mapped
+            by every worker.
+        ann_path: Dense index file of embeddings, read by every worker.
+        backend: Inference backend of embedder, see `embedder.BACKENDS`.
+        threads: Number of CPU threads of embedder in every worker,
+            default if 0.
+
+    Returns:
+        Responses in order of requests, and wall time in seconds.
+
+    """
+    ml = any(
+        isinstance(r, dict) and r.get("mode") in ("ml", "hybrid")
+        for r in requests
+    )
+    init_args = (
+        index_path,
+        root,
+        meta_path,
+        store_path,
+        ml,
+        batch_size,
+        emb_path,
+        ann_path,
+        backend,
+        threads,
+    )
+    if workers > 1:
+        # Small chunks keep workers balanced, but not too small for IPC
+        chunksize = max(1, len(requests) // (32 * workers))
+        with Pool(workers, _init_worker, init_args) as pool:
+            start = time.perf_counter()
+            responses = pool.map(_run, requests, chunksize)
+            elapsed = time.perf_counter() - start
+    else:
+        _init_worker(*init_args)
+        start = time.perf_counter()
+        responses = [_run(request) for request in requests]
+        elapsed = time.perf_counter() - start
+        _worker["index"].close()
+    return responses, elapsed
+
+
+def arg_parse() -> argparse.Namespace:
+    """Parse command line arguments."""
+    # Imported here, because it imports torch, which only CLI needs
+    from embedder import BACKENDS
+
+    parser = argparse.ArgumentParser(description="Batch querying")
+    parser.add_argument(
+        "--root",
+        dest="root",
+        help="Lyrics root directory",
+        default="lyrics/",
+        type=str,
+    )
+    parser.add_argument(
+        "--index", dest="index", help="Index", default="index", type=str
+    )
+    parser.add_argument(
+        "--meta",
+        dest="meta",
+        help="Documents metadata file",
+        default="docs.meta",
+        type=str,
+    )
+    parser.add_argument(
+        "--store",
+        dest="store",
+        help="Packed documents file",
+        default="docs.store",
+        type=str,
+    )
+    parser.add_argument(
+        "--queries",
+        dest="queries",
+        help="JSONL file of requests",
+        default="queries.jsonl",
+        type=str,
+    )
+    parser.add_argument(
+        "--out",
+        dest="out",
+        help="JSONL file of responses",
+        default="results.jsonl",
+        type=str,
+    )
+    parser.add_argument(
+        "--summary",
+        dest="summary",
+        help="JSON file of throughput and latency summary",
+        default=None,
+        type=str,
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        help="Number of worker processes",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--emb",
+        dest="emb_file",
+        help="Numpy file with embeddings for all texts, used by ML search",
+        default="embeddings.npy",
+        type=str,
+    )
+    parser.add_argument(
+        "--ann",
+        dest="ann_file",
+        help="Dense index file of embeddings, used by hybrid search",
+        default="embeddings.faiss",
+        type=str,
+    )
+    parser.add_argument(
+        "--backend",
+        dest="backend",
+        help="Inference backend of embedder",
+        choices=BACKENDS,
+        default="torch",
+    )
+    parser.add_argument(
+        "--threads",
+        dest="threads",
+        help="Number of CPU threads of embedder, default if 0",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--bs",
+        dest="batch_size",
+        help="Batch size of ML search",
+        default=100,
+        type=int,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = arg_parse()
+    requests = read_requests(args.queries)
+    responses, elapsed = run_batch(
+        requests,
+        args.index,
+        args.root,
+        args.meta,
+        args.store,
+        args.workers,
+        args.batch_size,
+        args.emb_file,
+        args.ann_file,
+        args.backend,
+        args.threads,
+    )
+    with open(args.out, "w") as f:
+        for response in responses:
+            f.write(json.dumps(response) + "\n")
+
+    summary = summarize(responses, elapsed)
+    print(
+        "{queries} queries ({errors} errors) in {elapsed_s:.2f} s, "
+        "{qps:.1f} QPS".format(**summary)
+    )
+    if "p50_ms" in summary:
+        print(
+            "latency ms: mean {mean_ms:.2f}, p50 {p50_ms:.2f}, "
+            "p95 {p95_ms:.2f}, p99 {p99_ms:.2f}".format(**summary)
+        )
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""This module implements compressed bitmaps of docIDs, roaring-style.
+
+DocIDs are split by their high 16 bits into chunks of 2^16 documents, and
+every chunk is stored in a container, depending on its density:
+    sparse chunk: Sorted array of low 16 bits of docIDs, 2 bytes each.
+    dense chunk: Bitmap of 2^16 bits, 8 KiB.
+An array of ARRAY_MAX docIDs takes as much memory as a bitmap, so a set
+of docIDs never takes more than 2 bytes per docID, and a set of almost
+all documents takes about 1 bit per document.
+"""
+import numpy as np
+from typing import Dict
+
+CHUNK_BITS = 16
+LOW_MASK = (1 << CHUNK_BITS) - 1
+# Maximal size of array container, bigger chunks are stored as bitmaps
+ARRAY_MAX = 4096
+
+
+def _bits(container: np.ndarray) -> np.ndarray:
+    """Convert container to bitmap, packed into 8192 bytes."""
+    if container.dtype == np.uint8:
+        return container
+    mask = np.zeros(1 << CHUNK_BITS, dtype=bool)
+    mask[container] = True
+    return np.packbits(mask, bitorder="little")
+
+
+def _low(container: np.ndarray) -> np.ndarray:
+    """Convert container to sorted array of low bits of docIDs."""
+    if container.dtype == np.uint16:
+        return container
+    bits = np.unpackbits(container, bitorder="little")
+    return np.flatnonzero(bits).astype(np.uint16)
+
+
+def _container(low: np.ndarray) -> np.ndarray:
+    """Make container of sorted array of low bits, bitmap if it is dense."""
+    if len(low) <= ARRAY_MAX:
+        return low.astype(np.uint16)
+    return _bits(low.astype(np.uint16))
+
+
+def _cardinality(container: np.ndarray) -> int:
+    """Count docIDs in container."""
+    if container.dtype == np.uint16:
+        return len(container)
+    return int(np.unpackbits(container).sum())
+
+
+def _normalize(container: np.ndarray) -> np.ndarray:
+    """Convert container to array, if its bitmap became sparse."""
+    if container.dtype == np.uint8 and _cardinality(container) <= ARRAY_MAX:
+        return _low(container)
+    return container
+
+
+class RoaringBitmap:
+    """Set of docIDs, stored in array and bitmap containers.
+
+    Attributes:
+        containers: Non-empty containers by high bits of their docIDs.
+
+    """
+
+    __slots__ = ("containers",)
+
+    def __init__(self, containers: Dict[int, np.ndarray] = None) -> None:
+        """Initialize RoaringBitmap.
+
+        Args:
+            containers: Non-empty containers by high bits of docIDs.
+
+        """
+        self.containers = containers or {}
+
+    @classmethod
+    def from_array(cls, doc_ids: np.ndarray) -> "RoaringBitmap":
+        """Build bitmap of a sorted array of unique docIDs."""
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        keys = np.unique(doc_ids >> CHUNK_BITS)
+        bounds = np.searchsorted(
+            doc_ids, np.append(keys, keys[-1:] + 1) << CHUNK_BITS
+        )
+        return cls(
+            {
+                int(key): _container(doc_ids[start:end] & LOW_MASK)
+                for key, start, end in zip(keys, bounds, bounds[1:])
+            }
+        )
+
+    def __len__(self) -> int:
+        return sum(_cardinality(c) for c in self.containers.values())
+
+    @property
+    def nbytes(self) -> int:
+        """Memory taken by containers."""
+        return sum(c.nbytes for c in self.containers.values())
+
+    def to_array(self) -> np.ndarray:
+        """Get sorted array of docIDs."""
+        chunks = [
+            (key << CHUNK_BITS) + _low(self.containers[key]).astype(np.int64)
+            for key in sorted(self.containers)
+        ]
+        if not chunks:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(chunks)
+
+    def contains(self, doc_ids: np.ndarray) -> np.ndarray:
+        """Check membership of docIDs.
+
+        Args:
+            doc_ids: Sorted array of docIDs.
+
+        Returns:
+            Boolean mask of docIDs that are in the set.
+
+        """
+        found = np.zeros(len(doc_ids), dtype=bool)
+        for key, container in self.containers.items():
+            start, end = np.searchsorted(
+                doc_ids, [key << CHUNK_BITS, (key + 1) << CHUNK_BITS]
+            )
+            if start == end:
+                continue
+            low = doc_ids[start:end] & LOW_MASK
+            if container.dtype == np.uint8:
+                bits = container[low >> 3] >> (low & 7).astype(np.uint8)
+                found[start:end] = (bits & 1).astype(bool)
+            else:
+                pos = np.searchsorted(container, low)
+                pos = np.minimum(pos, len(container) - 1)
+                found[start:end] = container[pos] == low
+        return found
+
+    def union(self, other: "RoaringBitmap") -> "RoaringBitmap":
+        """Get set of docIDs in either bitmap."""
+        containers = dict(self.containers)
+        for key, container in other.containers.items():
+            if key not in containers:
+                containers[key] = container
+                continue
+            mine = containers[key]
+            if mine.dtype == np.uint16 and container.dtype == np.uint16:
+                containers[key] = _container(np.union1d(mine, container))
+            else:
+                containers[key] = _bits(mine) | _bits(container)
+        return RoaringBitmap(containers)
+
+    def intersection(self, other: "RoaringBitmap") -> "RoaringBitmap":
+        """Get set of docIDs in both bitmaps."""
+        containers = {}
+        for key, container in self.containers.items():
+            if key not in other.containers:
+                continue
+            theirs = other.containers[key]
+            if container.dtype == np.uint16 or theirs.dtype == np.uint16:
+                low = np.intersect1d(
+                    _low(container), _low(theirs), assume_unique=True
+                )
+            else:
+                low = _low(container & theirs)
+            if len(low):
+                containers[key] = _container(low)
+        return RoaringBitmap(containers)
+
+    def difference(self, other: "RoaringBitmap") -> "RoaringBitmap":
+        """Get set of docIDs in this bitmap, but not in the other."""
+        containers = {}
+        for key, container in self.containers.items():
+            if key not in other.containers:
+                containers[key] = container
+                continue
+            theirs = other.containers[key]
+            if container.dtype == np.uint16:
+                low = np.setdiff1d(container, _low(theirs), assume_unique=True)
+                if len(low):
+                    containers[key] = low.astype(np.uint16)
+                continue
+            container = _normalize(container & ~_bits(theirs))
+            if _cardinality(container):
+                containers[key] = container
+        return RoaringBitmap(containers)
@@ -1,169 +1,797 @@
 """This module implements Single-pass in-memory Indexing.
 """
 import argparse
+import heapq
 import os
-import shelve
+import re
+import resource
 import string
+import struct
 import sys
+from bisect import bisect_left, bisect_right
+from contextlib import nullcontext
+from math import log2
+from multiprocessing import Pool
+from compression import decode_positions, decode_postings, encode_postings
+from compression import has_positions
+from doc_meta import list_docs, write_doc_meta
+from doc_store import DocStore, write_doc_store
 from gensim.parsing.porter import PorterStemmer
-from typing import List, Dict, Tuple, Iterator
+from index_store import IndexWriter, ShelveIndexWriter, write_segments
+from typing import List, Dict, Tuple, Iterator, Iterable, NamedTuple
+from typing import Optional, Sequence
+
+Positions = Optional[List[List[int]]]
+# Term, docIDs, term frequencies, positions and byte offsets of the term
+Record = Tuple[str, List[int], List[int], Positions, Positions]
+
+# Block record header: length of term, length of encoded posting list
+RECORD_HEADER = struct.Struct("<HI")
+# Sparse block index record: length of term, offset of record in block
+SAMPLE_HEADER = struct.Struct("<HQ")
+# Every SAMPLE_EVERY-th term of a block goes to its sparse index
+SAMPLE_EVERY = 64
+# Blocks with fewer sampled terms are sampled by all their terms, when
+# split points of merge are chosen
+MIN_BLOCK_SAMPLES = 16
+# Maximum number of blocks that are merged (and opened) at once
+MERGE_FAN_IN = 256
+# Whitespace separated chunk of text, a token when punctuation is removed
+CHUNK = re.compile(r"\S+")
+# How often (in tokens) process memory is measured in 'rss' memory mode
+RSS_CHECK_EVERY = 10000
+
+
+class BlockStats(NamedTuple):
+    """Statistics of a block of SPIMI-Invert.
+
+    Attributes:
+        terms: Number of terms in block.
+        postings: Number of postings in block.
+        peak_memory: Peak memory used by block dictionary in bytes.
 
+    """
+
+    terms: int
+    postings: int
+    peak_memory: int
+
+
+def process_memory() -> int:
+    """Get resident set size of current process in bytes."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # Peak resident set size, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
 
-def token_stream(files: List[str]) -> Iterator[Tuple[int, str]]:
-    """Convert text files to a stream of docID-tokens pairs.
+
+def token_stream(
+    docs: Sequence[bytes],
+    start_docId: int = 0,
+    end_docId: Optional[int] = None,
+) -> Iterator[Tuple[int, str]]:
+    """Convert documents to a stream of docID-tokens pairs.
 
     Args:
-        files: List of filepaths.
+        docs: Documents bytes indexed by docID, e.g. `doc_store.DocStore`.
+        start_docId: DocID of the first document.
+        end_docId: DocID after the last document, the end of docs if None.
 
     Yields:
         Pair of docID, token.
 
     """
-    for fileno, filepath in enumerate(files):
-        with open(filepath, "r") as f:
-            for line in f:
-                line = line.translate(
-                    str.maketrans("", "", string.punctuation)
-                ).rstrip()
-                for token in line.split():
-                    yield fileno, token
+    table = str.maketrans("", "", string.punctuation)
+    if end_docId is None:
+        end_docId = len(docs)
+    for docId in range(start_docId, end_docId):
+        for token in docs[docId].decode("utf-8").translate(table).split():
+            yield docId, token
+
+
+def token_offsets(
+    docs: Sequence[bytes],
+    start_docId: int = 0,
+    end_docId: Optional[int] = None,
+) -> Iterator[Tuple[int, str, int]]:
+    """Convert documents to a stream of docID-token-offset triples.
+
+    Tokens are the same as of `token_stream`, every token comes with byte
+    offset of its first character in the document.
+
+    Args:
+        docs: Documents bytes indexed by docID, e.g. `doc_store.DocStore`.
+        start_docId: DocID of the first document.
+        end_docId: DocID after the last document, the end of docs if None.
+
+    Yields:
+        Triple of docID, token, byte offset.
+
+    """
+    table = str.maketrans("", "", string.punctuation)
+    if end_docId is None:
+        end_docId = len(docs)
+    for docId in range(start_docId, end_docId):
+        data = docs[docId]
+        text = data.decode("utf-8")
+        is_ascii = len(text) == len(data)
+        # Byte offset of symbol of text, that was converted last
+        symbol = offset = 0
+        for match in CHUNK.finditer(text):
+            chunk = match.group()
+            token = chunk.translate(table)
+            if not token:
+                continue
+            start = match.start() + len(chunk)
+            start -= len(chunk.lstrip(string.punctuation))
+            if not is_ascii:
+                offset += len(text[symbol:start].encode("utf-8"))
+                symbol, start = start, offset
+            yield docId, token, start
+
+
+def write_block(path: str, dictionary: Dict[str, Dict[int, int]]) -> None:
+    """Write block of SPIMI-Invert to disk.
+
+    Block is a sequence of records (term, encoded posting list), sorted by
+    term, so it can be read back one term at a time.
+
+    Args:
+        path: Block filepath.
+        dictionary: Dictionary of term -> {docID: term frequency}, with
+            docIDs in ascending order. If positions are collected, term
+            frequency is replaced with a list of interleaved positions and
+            byte offsets of the term in document.
+
+    """
+    records = sorted(dictionary.items())
+    write_records(path, (_record(term, posting) for term, posting in records))
+
+
+def _record(term: str, posting: Dict[int, int]) -> Record:
+    """Convert posting dictionary of a term to a record of block."""
+    doc_ids = list(posting.keys())
+    values = list(posting.values())
+    if not values or isinstance(values[0], int):
+        return term, doc_ids, values, None, None
+    return (
+        term,
+        doc_ids,
+        [len(v) // 2 for v in values],
+        [v[0::2] for v in values],
+        [v[1::2] for v in values],
+    )
+
+
+def write_records(path: str, records: Iterable[Record]) -> None:
+    """Write sorted (term, docIDs, term frequencies, ...) records to block.
+
+    Every SAMPLE_EVERY-th term and its offset are also written to sparse
+    index `path.idx`, that is used to seek inside the block and to sample
+    terms distribution.
+
+    Args:
+        path: Block filepath.
+        records: Records, sorted by term.
+
+    """
+    with open(path, "wb") as f, open(path + ".idx", "wb") as f_idx:
+        for i, (term, doc_ids, tfs, positions, offsets) in enumerate(
+            records
+        ):
+            data = encode_postings(
+                doc_ids, tfs, positions=positions, offsets=offsets
+            )
+            term = term.encode("utf-8")
+            if i % SAMPLE_EVERY == 0:
+                f_idx.write(SAMPLE_HEADER.pack(len(term), f.tell()))
+                f_idx.write(term)
+            f.write(RECORD_HEADER.pack(len(term), len(data)))
+            f.write(term)
+            f.write(data)
+
+
+def read_block_samples(path: str) -> Tuple[List[str], List[int]]:
+    """Read sparse index of a block.
+
+    Args:
+        path: Block filepath.
+
+    Returns:
+        Sampled terms, sorted, and offsets of their records in the block.
+
+    """
+    terms, offsets = [], []
+    with open(path + ".idx", "rb") as f:
+        while True:
+            header = f.read(SAMPLE_HEADER.size)
+            if not header:
+                break
+            term_len, offset = SAMPLE_HEADER.unpack(header)
+            terms.append(f.read(term_len).decode("utf-8"))
+            offsets.append(offset)
+    return terms, offsets
+
+
+def read_block_sizes(path: str) -> Tuple[List[str], List[int]]:
+    """Read all terms of a block and sizes of their records.
+
+    Posting lists are skipped, not read.
+
+    Args:
+        path: Block filepath.
+
+    Returns:
+        Terms, sorted, and sizes of their records in bytes.
+
+    """
+    terms, sizes = [], []
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if not header:
+                break
+            term_len, data_len = RECORD_HEADER.unpack(header)
+            terms.append(f.read(term_len).decode("utf-8"))
+            sizes.append(RECORD_HEADER.size + term_len + data_len)
+            f.seek(data_len, os.SEEK_CUR)
+    return terms, sizes
+
+
+def sample_block_volume(path: str) -> Tuple[List[str], List[int]]:
+    """Sample terms of a block with volume of postings they stand for.
+
+    Sampled terms of sparse index stand for records up to the next sampled
+    term. If block has only a few sampled terms, all its terms are read.
+
+    Args:
+        path: Block filepath.
+
+    Returns:
+        Sampled terms, sorted, and volume of their records in bytes.
+
+    """
+    terms, offsets = read_block_samples(path)
+    if len(terms) < MIN_BLOCK_SAMPLES:
+        return read_block_sizes(path)
+    offsets.append(os.path.getsize(path))
+    return terms, [end - start for start, end in zip(offsets, offsets[1:])]
+
+
+def read_block(
+    path: str,
+    start_term: Optional[str] = None,
+    end_term: Optional[str] = None,
+) -> Iterator[Tuple[str, bytes]]:
+    """Read block of SPIMI-Invert record by record.
+
+    Args:
+        path: Block filepath.
+        start_term: If given, read only terms >= start_term, seeking to
+            them with the sparse index of the block.
+        end_term: If given, read only terms < end_term.
+
+    Yields:
+        Pair of term, encoded posting list, in sorted order of terms.
+
+    """
+    with open(path, "rb") as f:
+        if start_term is not None:
+            terms, offsets = read_block_samples(path)
+            i = bisect_right(terms, start_term) - 1
+            if i >= 0:
+                f.seek(offsets[i])
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if not header:
+                break
+            term_len, data_len = RECORD_HEADER.unpack(header)
+            term = f.read(term_len).decode("utf-8")
+            if end_term is not None and term >= end_term:
+                break
+            if start_term is not None and term < start_term:
+                f.seek(data_len, os.SEEK_CUR)
+                continue
+            yield term, f.read(data_len)
 
 
 def spimi_invert(
-    files: List[str],
+    docs: Sequence[bytes],
     stemmer: PorterStemmer,
     blocks_dir: str,
     memory_available: int,
-) -> List[str]:
+    start_docId: int = 0,
+    end_docId: Optional[int] = None,
+    block_prefix: str = "block",
+    memory_mode: str = "estimate",
+    positions: bool = False,
+) -> Tuple[List[str], List[int], List[BlockStats]]:
     """SPIMI-Invert procedure.
 
     Collect terms, docIDs, term-frequencies into a block (dictionary
     of dictionaries) that fits in available memory, write each block's
     dictionary to disk, and start a new dictionary for the next block.
+    Length of every document is counted along the way.
+
+    Memory used by a block is estimated from sizes of the dictionary
+    itself, of every term string and posting dictionary, and of docIDs, as
+    they are added. In 'rss' memory mode resident set size of the process
+    is also measured, and its growth since the start of the block is used
+    if it exceeds the estimate.
 
     Args:
-        files: List of filepaths.
+        docs: Documents bytes indexed by docID, e.g. `doc_store.DocStore`.
         stemmer: Gensim porter stemmer.
         blocks_dir: Directory where blocks are saved.
         memory_available: Available memory in bytes.
+        start_docId: DocID of the first document to invert.
+        end_docId: DocID after the last document, the end of docs if None.
+        block_prefix: Prefix of blocks' filenames.
+        memory_mode: 'estimate' or 'rss'.
+        positions: Collect positions and byte offsets of terms in
+            documents, see `token_offsets`.
 
     Returns:
-        List of filenames of saved blocks.
+        List of filenames of saved blocks, number of tokens in every
+        document and statistics of every block.
 
     """
-    memory_used = 0
+    if end_docId is None:
+        end_docId = len(docs)
+    if positions:
+        stream = token_offsets(docs, start_docId, end_docId)
+    else:
+        pairs = token_stream(docs, start_docId, end_docId)
+        stream = ((d, t, None) for d, t in pairs)
+    doc_lengths = [0] * (end_docId - start_docId)
     outputed_blocks = []
+    block_stats = []
     block_index = 0
     dictionary = {}
-    for docId, token in token_stream(files):
-        memory_used += sys.getsizeof(token)
+    estimated = peak_memory = sys.getsizeof(dictionary)
+    measured = 0
+    base_memory = process_memory()
+    postings = 0
+    last_docId = -1
+    for tokens, (docId, token, offset) in enumerate(stream, 1):
+        position = doc_lengths[docId - start_docId]
+        doc_lengths[docId - start_docId] += 1
+        if docId != last_docId:
+            # docID object is shared by all posting dictionaries
+            estimated += sys.getsizeof(docId)
+            last_docId = docId
 
         term = stemmer.stem(token)
-        if term not in dictionary.keys():
-            dictionary[term] = {}
-        if docId not in dictionary[term].keys():
-            dictionary[term][docId] = 0
-        dictionary[term][docId] += 1  # save term freq. in document
+        posting = dictionary.get(term)
+        if posting is None:
+            size = sys.getsizeof(dictionary)
+            posting = dictionary[term] = {}
+            estimated += (
+                sys.getsizeof(dictionary)
+                - size
+                + sys.getsizeof(term)
+                + sys.getsizeof(posting)
+            )
+        if positions:
+            occurrences = posting.get(docId)
+            if occurrences is None:
+                size = sys.getsizeof(posting)
+                occurrences = posting[docId] = []
+                estimated += sys.getsizeof(posting) - size
+                estimated += sys.getsizeof(occurrences)
+                postings += 1
+            size = sys.getsizeof(occurrences)
+            occurrences.append(position)
+            occurrences.append(offset)
+            estimated += (
+                sys.getsizeof(occurrences)
+                - size
+                + sys.getsizeof(position)
+                + sys.getsizeof(offset)
+            )
+        elif docId in posting:
+            posting[docId] += 1  # save term freq. in document
+        else:
+            size = sys.getsizeof(posting)
+            posting[docId] = 1
+            estimated += sys.getsizeof(posting) - size
+            postings += 1
+
+        if memory_mode == "rss" and tokens % RSS_CHECK_EVERY == 0:
+            measured = process_memory() - base_memory
+        memory_used = max(estimated, measured)
+        peak_memory = max(peak_memory, memory_used)
 
         if memory_used > memory_available:
             # Sort terms and write to disk
-            with shelve.open(blocks_dir + "block" + str(block_index)) as f:
-                for k in sorted(dictionary.keys()):
-                    f[k] = dictionary[k]
-            outputed_blocks.append("block" + str(block_index))
+            block = block_prefix + str(block_index)
+            write_block(blocks_dir + block, dictionary)
+            outputed_blocks.append(block)
+            block_stats.append(
+                BlockStats(len(dictionary), postings, peak_memory)
+            )
             block_index += 1
-            memory_used = 0
             dictionary = {}
+            estimated = peak_memory = sys.getsizeof(dictionary)
+            measured = 0
+            base_memory = process_memory()
+            postings = 0
+            last_docId = -1
 
     # Save last block
     if dictionary:
-        with shelve.open(blocks_dir + "block" + str(block_index)) as f:
-            for k in sorted(dictionary.keys()):
-                f[k] = dictionary[k]
-        outputed_blocks.append("block" + str(block_index))
-    return outputed_blocks
+        block = block_prefix + str(block_index)
+        write_block(blocks_dir + block, dictionary)
+        outputed_blocks.append(block)
+        block_stats.append(BlockStats(len(dictionary), postings, peak_memory))
+    return outputed_blocks, doc_lengths, block_stats
 
 
-def merge_dicts(
-    dict1: Dict[int, int], dict2: Dict[int, int]
-) -> Dict[int, int]:
-    """Merge ans sort two dictionaries.
+def split_ranges(store: DocStore, parts: int) -> List[int]:
+    """Split documents of store into contiguous ranges of similar size.
 
     Args:
-        dict1: One dictionary.
-        dict2: Another dictionary.
+        store: Documents store.
+        parts: Number of ranges.
 
     Returns:
-        Merged dictionary.
+        Start docID of every range, and number of documents.
 
     """
-    if dict1 == {}:
-        return dict2
-    # Merge
-    for k, v in dict2.items():
-        if k in dict1.keys():
-            dict1[k] += v
-        else:
-            dict1[k] = v
-    # Sort
-    return {k: dict1[k] for k in sorted(dict1)}
-
-
-def merge_all_blocks(
-    outputed_blocks: List[str], blocks_dir: str = "blocks/"
-) -> None:
-    """Merge the resulting blocks of SPIMI-Invert.
+    # Offsets of documents ends in concatenated texts
+    sizes = store.doc_offsets[1:]
+    total = sizes[-1] if sizes else 0
+    bounds = [0]
+    for i in range(1, parts):
+        bound = bisect_left(sizes, total * i / parts) + 1
+        if bounds[-1] < bound < len(store):
+            bounds.append(bound)
+    bounds.append(len(store))
+    return bounds
+
+
+def _spimi_invert_range(
+    store_path: str,
+    start_docId: int,
+    end_docId: int,
+    blocks_dir: str,
+    memory_available: int,
+    block_prefix: str,
+    memory_mode: str,
+    positions: bool,
+) -> Tuple[List[str], List[int], List[BlockStats]]:
+    """Run SPIMI-Invert in a worker process, with its own stemmer."""
+    store = DocStore(store_path)
+    try:
+        return spimi_invert(
+            store,
+            PorterStemmer(),
+            blocks_dir,
+            memory_available,
+            start_docId,
+            end_docId,
+            block_prefix,
+            memory_mode,
+            positions,
+        )
+    finally:
+        store.close()
+
+
+def parallel_spimi_invert(
+    store_path: str,
+    blocks_dir: str,
+    memory_available: int,
+    workers: int,
+    memory_mode: str = "estimate",
+    positions: bool = False,
+) -> Tuple[List[str], List[int], List[BlockStats]]:
+    """Run SPIMI-Invert on contiguous docID ranges in a process pool.
 
-    Open all blocks simultaneously, then read a term from each block,
-    choose minimal term and write merged posting lists corresponding
-    to this term to disk. Then read next term only from blocks where
-    minimal term was. Repeat until all blocks are emptied.
+    Every worker inverts its own range of documents into its own sorted
+    blocks. Blocks are returned in docID order, so they are merged the
+    same way as blocks of a single SPIMI-Invert.
 
     Args:
-        outputed_blocks: List of filenames of saved blocks.
+        store_path: Packed documents store, see `doc_store`.
         blocks_dir: Directory where blocks are saved.
+        memory_available: Available memory in bytes, shared by workers.
+        workers: Number of worker processes.
+        memory_mode: 'estimate' or 'rss', see `spimi_invert`.
+        positions: Collect positions and byte offsets of terms.
+
+    Returns:
+        List of filenames of saved blocks, number of tokens in every
+        document and statistics of every block.
 
     """
-    files = [shelve.open(blocks_dir + b) for b in outputed_blocks]
-    iterators = [iter(sorted(f.keys())) for f in files]
-    buffer = [None for i in iterators]
+    store = DocStore(store_path)
+    bounds = split_ranges(store, workers)
+    store.close()
+    jobs = [
+        (
+            store_path,
+            start,
+            end,
+            blocks_dir,
+            memory_available // workers,
+            "block{}_".format(i),
+            memory_mode,
+            positions,
+        )
+        for i, (start, end) in enumerate(zip(bounds, bounds[1:]))
+    ]
+    outputed_blocks, doc_lengths, block_stats = [], [], []
+    with Pool(workers) as pool:
+        for blocks, lengths, stats in pool.starmap(_spimi_invert_range, jobs):
+            outputed_blocks.extend(blocks)
+            doc_lengths.extend(lengths)
+            block_stats.extend(stats)
+    return outputed_blocks, doc_lengths, block_stats
+
+
+def merge_blocks(
+    paths: List[str],
+    start_term: Optional[str] = None,
+    end_term: Optional[str] = None,
+) -> Iterator[Record]:
+    """K-way merge of sorted blocks.
+
+    Priority queue holds the current term of every block. Minimal term is
+    popped together with its posting lists from all blocks, and then next
+    term is read only from those blocks. Blocks are given in docID order,
+    so posting lists of a term are concatenated without sorting.
 
-    output = shelve.open("index")
-    while True:
-        # Iterate in reverse order for removing
-        for i in range(len(iterators))[::-1]:
-            # Skip if buffer for this block is not empty
-            if buffer[i] is not None:
-                continue
+    Args:
+        paths: Filepaths of blocks, in docID order.
+        start_term: If given, merge only terms >= start_term.
+        end_term: If given, merge only terms < end_term.
 
-            # Read next (term, posting_list) from block
-            try:
-                k = next(iterators[i])
-                buffer[i] = (k, files[i][k])  # put into buffer
-            except (
-                StopIteration,
-                KeyError,
-            ):  # remove emptied block from lists
-                iterators.pop(i)
-                buffer.pop(i)
-                continue
+    Yields:
+        Term, merged docIDs, term frequencies, positions and byte offsets
+        (None if blocks don't store them), in sorted order of terms.
 
-        # Stop if no more blocks left to merge
-        if not iterators:
+    """
+    blocks = [read_block(path, start_term, end_term) for path in paths]
+    # Block number breaks ties between equal terms, keeping docID order
+    heap = []
+    for i, block in enumerate(blocks):
+        for term, data in block:
+            heap.append((term, i, data))
             break
+    heapq.heapify(heap)
+
+    while heap:
+        min_term = heap[0][0]
+        doc_ids, tfs = [], []
+        positions = offsets = None
+        while heap and heap[0][0] == min_term:
+            _, i, data = heap[0]
+            block_doc_ids, block_tfs = decode_postings(data)
+            if has_positions(data):
+                block_positions, block_offsets = decode_positions(data)
+                if positions is None:
+                    positions, offsets = [], []
+            # Document may be split between two consecutive blocks
+            if doc_ids and doc_ids[-1] == block_doc_ids[0]:
+                tfs[-1] += block_tfs[0]
+                block_doc_ids, block_tfs = block_doc_ids[1:], block_tfs[1:]
+                if positions is not None:
+                    positions[-1].extend(block_positions[0])
+                    offsets[-1].extend(block_offsets[0])
+                    block_positions = block_positions[1:]
+                    block_offsets = block_offsets[1:]
+            doc_ids.extend(block_doc_ids)
+            tfs.extend(block_tfs)
+            if positions is not None:
+                positions.extend(block_positions)
+                offsets.extend(block_offsets)
+
+            # Read next (term, posting_list) from the same block
+            record = next(blocks[i], None)
+            if record is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (record[0], i, record[1]))
+        yield min_term, doc_ids, tfs, positions, offsets
+
+
+def sample_split_points(paths: List[str], parts: int) -> List[str]:
+    """Choose terms that split merged index into ranges of similar size.
+
+    Ranges are balanced by volume of postings of sampled terms, see
+    `sample_block_volume`. If volume is so skewed, that there are fewer
+    split points than needed, terms are split evenly by their number.
+
+    Args:
+        paths: Filepaths of blocks.
+        parts: Number of ranges.
+
+    Returns:
+        Sorted distinct terms, every range starts with one of them, except
+        for the first range. There are fewer than parts - 1 of them only if
+        there are not enough distinct terms.
+
+    """
+    volume = {}
+    for path in paths:
+        for term, size in zip(*sample_block_volume(path)):
+            volume[term] = volume.get(term, 0) + size
+    terms = sorted(volume)
+    if not terms:
+        return []
+    total = sum(volume.values())
+    split_points = []
+    cumulative = 0
+    for term in terms:
+        # Volume of the ranges before the term
+        if cumulative * parts >= total * (len(split_points) + 1) > 0:
+            split_points.append(term)
+            if len(split_points) == parts - 1:
+                break
+        cumulative += volume[term]
+    if len(split_points) < parts - 1:
+        split_points = sorted(
+            {terms[len(terms) * i // parts] for i in range(1, parts)}
+        )
+        split_points = [term for term in split_points if term != terms[0]]
+    return split_points
+
+
+def encode_weighted_postings(
+    doc_ids: List[int],
+    tfs: List[int],
+    doc_lengths: Optional[List[int]],
+    positions: Positions = None,
+    offsets: Positions = None,
+) -> bytes:
+    """Encode merged posting list with precomputed idf and tf-idf weights.
+
+    Args:
+        doc_ids: DocIDs, sorted in ascending order.
+        tfs: Term frequencies in corresponding documents.
+        doc_lengths: Number of tokens in every document. If None, weights
+            are not stored.
+        positions: Positions of the term in documents, if collected.
+        offsets: Byte offsets of the term in documents, if collected.
+
+    Returns:
+        Encoded posting list.
+
+    """
+    if doc_lengths is None:
+        return encode_postings(
+            doc_ids, tfs, positions=positions, offsets=offsets
+        )
+    idf = log2(len(doc_lengths) / len(doc_ids))
+    weights = [tf / doc_lengths[d] * idf for d, tf in zip(doc_ids, tfs)]
+    return encode_postings(doc_ids, tfs, idf, weights, positions, offsets)
 
-        # Merge and save postings corresponding to minimal term
-        min_term = min([b[0] for b in buffer])
-        dictionary = {}
-        for i, (termId, doc_dict) in enumerate(buffer):
-            if termId == min_term:
-                dictionary = merge_dicts(dictionary, doc_dict)
-                buffer[i] = None  # clear buffer
-        output[min_term] = dictionary
-
-    for f in files:
-        f.close()
+
+def _merge_group(paths: List[str], path: str) -> None:
+    """Merge group of blocks into a bigger intermediate block."""
+    write_records(path, merge_blocks(paths))
+
+
+def _merge_range(
+    paths: List[str],
+    start_term: Optional[str],
+    end_term: Optional[str],
+    segment_path: str,
+    doc_lengths: Optional[List[int]],
+) -> Optional[str]:
+    """Merge terms in [start_term, end_term) into an index segment.
+
+    Returns:
+        First term of the segment, None if there are no terms in range.
+
+    """
+    output = IndexWriter(segment_path)
+    first_term = None
+    for term, doc_ids, tfs, positions, offsets in merge_blocks(
+        paths, start_term, end_term
+    ):
+        if first_term is None:
+            first_term = term
+        data = encode_weighted_postings(
+            doc_ids, tfs, doc_lengths, positions, offsets
+        )
+        output.add(term, data, len(doc_ids))
     output.close()
+    return first_term
+
+
+def merge_all_blocks(
+    outputed_blocks: List[str],
+    blocks_dir: str = "blocks/",
+    index_path: str = "index",
+    index_format: str = "mmap",
+    fan_in: int = MERGE_FAN_IN,
+    workers: int = 1,
+    doc_lengths: Optional[List[int]] = None,
+) -> None:
+    """Merge the resulting blocks of SPIMI-Invert.
+
+    Blocks are streamed through a k-way merge (see `merge_blocks`), so
+    memory used is bounded by posting list of a single term, and merge
+    takes O(total postings * log blocks). If there are more than `fan_in`
+    blocks, consecutive groups of blocks are first merged into bigger
+    intermediate blocks, to bound the number of open files.
+
+    With several workers, groups are merged in a process pool, and final
+    merge is partitioned by term ranges: split points are sampled from
+    sparse indexes of blocks, every range is merged by its own process
+    into an index segment, and segments are tied together by a directory
+    (see `index_store.SegmentedIndex`).
+
+    Merged posting lists are written in compact binary format, see
+    `compression.encode_postings`. If lengths of documents are given,
+    precomputed idf and tf-idf weights are stored as well. Positions and
+    byte offsets of terms are kept, if blocks store them.
+
+    Args:
+        outputed_blocks: List of filenames of saved blocks, in docID order.
+        blocks_dir: Directory where blocks are saved.
+        index_path: Index name.
+        index_format: 'mmap' for read-only memory-mapped index (see
+            `index_store`) or 'shelve'. Shelve index is always merged by
+            one process.
+        fan_in: Maximum number of blocks merged at once.
+        workers: Number of merging processes.
+        doc_lengths: Number of tokens in every document.
+
+    """
+    # Workers are terminated, even if merge fails
+    with Pool(workers) if workers > 1 else nullcontext() as pool:
+        paths = [blocks_dir + b for b in outputed_blocks]
+        merge_pass = 0
+        while len(paths) > fan_in:
+            jobs = [
+                (
+                    paths[i:i + fan_in],
+                    blocks_dir
+                    + "merge{}_{}".format(merge_pass, i // fan_in),
+                )
+                for i in range(0, len(paths), fan_in)
+            ]
+            if pool:
+                pool.starmap(_merge_group, jobs)
+            else:
+                for job in jobs:
+                    _merge_group(*job)
+            paths = [path for _, path in jobs]
+            merge_pass += 1
+
+        if pool and index_format == "mmap":
+            split_points = sample_split_points(paths, workers)
+            bounds = [None] + split_points + [None]
+            segments = [
+                "{}.seg{}".format(index_path, i)
+                for i in range(len(bounds) - 1)
+            ]
+            first_terms = pool.starmap(
+                _merge_range,
+                [
+                    (paths, start_term, end_term, segment, doc_lengths)
+                    for start_term, end_term, segment in zip(
+                        bounds, bounds[1:], segments
+                    )
+                ],
+            )
+            write_segments(index_path, segments, first_terms)
+        else:
+            if index_format == "shelve":
+                output = ShelveIndexWriter(index_path)
+            else:
+                output = IndexWriter(index_path)
+            for term, doc_ids, tfs, positions, offsets in merge_blocks(paths):
+                data = encode_weighted_postings(
+                    doc_ids, tfs, doc_lengths, positions, offsets
+                )
+                output.add(term, data, len(doc_ids))
+            output.close()
 
 
 def arg_parse() -> argparse.Namespace:
@@ -183,6 +811,15 @@ def arg_parse() -> argparse.Namespace:
         default=10,
         type=int,
     )
+    parser.add_argument(
+        "--memory_mode",
+        dest="memory_mode",
+        help="How memory used by a block is accounted: estimated size of "
+        "block dictionary, or also measured resident set size of process",
+        choices=["estimate", "rss"],
+        default="estimate",
+        type=str,
+    )
     parser.add_argument(
         "--temp_dir",
         dest="blocks_dir",
@@ -190,31 +827,100 @@ def arg_parse() -> argparse.Namespace:
         default="blocks/",
         type=str,
     )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        help="Number of processes for SPIMI-Invert and merge",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--index", dest="index", help="Index name", default="index", type=str
+    )
+    parser.add_argument(
+        "--meta",
+        dest="meta",
+        help="File where documents metadata is saved",
+        default="docs.meta",
+        type=str,
+    )
+    parser.add_argument(
+        "--store",
+        dest="store",
+        help="File where documents are packed",
+        default="docs.store",
+        type=str,
+    )
+    parser.add_argument(
+        "--compress",
+        help="Compress packed documents by blocks",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--positions",
+        help="Store positions and byte offsets of terms in documents, "
+        "used for snippets of results",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--format",
+        dest="index_format",
+        help="Index format",
+        choices=["mmap", "shelve"],
+        default="mmap",
+        type=str,
+    )
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = arg_parse()
     # Get list of documents and use index as docID
-    docs = [
-        dir + "/" + f
-        for dir in os.listdir(args.root)
-        for f in os.listdir(args.root + dir)
-    ]
-    docs = sorted(docs)
-    with open("docs_list.txt", "w") as f:   # TODO file name to args
-        for d in docs:
-            f.write(d+'\n')
-
+    docs = list_docs(args.root)
     files = [args.root + d for d in docs]
-    stemmer = PorterStemmer()
+    # Pack documents, they are read from the store from now on
+    write_doc_store(args.store, files, args.compress)
     # Generate fitting in memory blocks using SPIMI-Invert
     memory_available = args.memory_mb * 1024 * 1024
     try:
         os.mkdir(args.blocks_dir)
     except FileExistsError:
         pass
-    outputed_blocks = spimi_invert(
-        files, stemmer, args.blocks_dir, memory_available
+    if args.workers > 1:
+        outputed_blocks, doc_lengths, block_stats = parallel_spimi_invert(
+            args.store,
+            args.blocks_dir,
+            memory_available,
+            args.workers,
+            args.memory_mode,
+            args.positions,
+        )
+    else:
+        store = DocStore(args.store)
+        outputed_blocks, doc_lengths, block_stats = spimi_invert(
+            store,
+            PorterStemmer(),
+            args.blocks_dir,
+            memory_available,
+            memory_mode=args.memory_mode,
+            positions=args.positions,
+        )
+        store.close()
+    for block, stats in zip(outputed_blocks, block_stats):
+        print(
+            "{}: {} terms, {} postings, peak memory {:.2f} Mb".format(
+                block,
+                stats.terms,
+                stats.postings,
+                stats.peak_memory / 1024 / 1024,
+            )
+        )
+    write_doc_meta(args.meta, docs, doc_lengths)
+    merge_all_blocks(
+        outputed_blocks,
+        args.blocks_dir,
+        args.index,
+        args.index_format,
+        workers=args.workers,
+        doc_lengths=doc_lengths,
     )
-    merge_all_blocks(outputed_blocks, args.blocks_dir)
@@ -0,0 +1,105 @@
+"""This module implements in-process caches of the query engine.
+
+Values are evicted in least recently used order when their total size
+exceeds the budget of bytes. Query traffic is skewed, so a small cache of
+decoded posting lists of the most frequent terms and of results of the
+most frequent queries takes most of the load off the index.
+"""
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class LRUCache:
+    """Least recently used cache with a budget of bytes.
+
+    Attributes:
+        capacity: Budget of bytes, 0 disables cache.
+        sizeof: Function that gets size of a value in bytes.
+        entries: Values and their sizes, from least recently used.
+        size: Total size of values.
+        hits: Number of lookups that found a value.
+        misses: Number of lookups that didn't.
+
+    """
+
+    def __init__(self, capacity: int, sizeof: Callable[[Any], int]) -> None:
+        """Initialize empty LRUCache.
+
+        Args:
+            capacity: Budget of bytes, 0 disables cache.
+            sizeof: Function that gets size of a value in bytes.
+
+        """
+        self.capacity = capacity
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.entries
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Look value up and mark it as recently used.
+
+        Args:
+            key: Key.
+
+        Returns:
+            Cached value, None if it is not cached.
+
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Cache value, evicting least recently used ones to fit budget.
+
+        Value bigger than the whole budget is not cached.
+
+        Args:
+            key: Key.
+            value: Value.
+
+        """
+        nbytes = self.sizeof(value)
+        if not self.capacity or nbytes > self.capacity:
+            return
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        while self.size + nbytes > self.capacity:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= evicted
+        self.entries[key] = (value, nbytes)
+        self.size += nbytes
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of lookups that found a value."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        """Get statistics of cache usage."""
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+        }
+
+    def clear(self) -> None:
+        """Drop all values, statistics are kept."""
+        self.entries.clear()
+        self.size = 0
@@ -0,0 +1,468 @@
+"""This module implements compact binary encoding of posting lists.
+
+Posting list of a term is stored as a header (flags byte, document
+frequency), then a sorted list of docIDs, encoded as gaps between
+consecutive docIDs, and term frequencies. All numbers are compressed with
+variable byte encoding.
+
+Posting lists of the final index also store precomputed weights, and are
+split into blocks of BLOCK_SIZE postings, so that whole blocks can be
+skipped without decoding. Header is followed by idf of the term and the
+maximal tf-idf weight, and a table with last docID (as a gap from the
+last docID of previous block), size of docIDs and maximal weight of every
+block. Every block holds gaps of its docIDs and tf-idf weights of its
+postings, each quantized to one byte relative to the maximal weight of
+the term. Term frequencies follow all the blocks.
+
+Posting lists may also store positions of the term in documents (number of
+tokens before it) and byte offsets of its occurrences in document files.
+They go to a separate section after term frequencies, split into blocks
+of BLOCK_SIZE postings, with a table of sizes of the blocks. Every posting
+in a block holds its term frequency, gaps of positions and gaps of byte
+offsets. Offset of the section is stored in the last 4 bytes of posting
+list, so positions of a posting are decoded without decoding the rest.
+"""
+import struct
+import sys
+from bisect import bisect_left
+from itertools import accumulate
+from typing import List, Optional, Tuple, Union
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+# Flags of posting list
+HAS_WEIGHTS = 1
+HAS_POSITIONS = 2
+# Idf of term and maximal tf-idf weight of its postings
+WEIGHTS_HEADER = struct.Struct("<ff")
+# Number of quantization levels of tf-idf weight
+WEIGHT_LEVELS = 255
+# Number of postings in a block of posting list with weights
+BLOCK_SIZE = 128
+# Offset of positions section, at the end of posting list with positions
+POSITIONS_TRAILER = struct.Struct("<I")
+# DocID of exhausted cursor, greater than any real docID
+END_DOC = sys.maxsize
+
+
+def vbyte_encode(numbers: List[int], out: bytearray) -> None:
+    """Variable byte encode a list of non-negative integers.
+
+    Every number is split into 7-bit groups, most significant group first.
+    The high bit is set in the last byte of a number to mark its end.
+
+    Args:
+        numbers: List of non-negative integers.
+        out: Byte array where encoded numbers are appended.
+
+    """
+    for n in numbers:
+        if n < 128:
+            out.append(n | 128)
+            continue
+        groups = []
+        while n >= 128:
+            groups.append(n & 127)
+            n >>= 7
+        groups.append(n)
+        groups.reverse()
+        groups[-1] |= 128
+        out.extend(groups)
+
+
+def vbyte_decode(
+    data: Buffer, count: int, pos: int = 0
+) -> Tuple[List[int], int]:
+    """Decode variable byte encoded integers.
+
+    Args:
+        data: Encoded bytes.
+        count: How many integers to decode.
+        pos: Position in data to start decoding from.
+
+    Returns:
+        List of decoded integers and position right after the last one.
+
+    """
+    numbers = []
+    append = numbers.append
+    n = 0
+    while count:
+        b = data[pos]
+        pos += 1
+        if b < 128:
+            n = (n << 7) | b
+        else:
+            append((n << 7) | (b & 127))
+            n = 0
+            count -= 1
+    return numbers, pos
+
+
+def _gaps(numbers: List[int]) -> List[int]:
+    """Get gaps between consecutive numbers, sorted in ascending order."""
+    gaps = []
+    last = 0
+    for n in numbers:
+        gaps.append(n - last)
+        last = n
+    return gaps
+
+
+def encode_postings(
+    doc_ids: List[int],
+    tfs: List[int],
+    idf: Optional[float] = None,
+    weights: Optional[List[float]] = None,
+    positions: Optional[List[List[int]]] = None,
+    offsets: Optional[List[List[int]]] = None,
+) -> bytes:
+    """Encode posting list of a term.
+
+    Args:
+        doc_ids: DocIDs, sorted in ascending order.
+        tfs: Term frequencies in corresponding documents.
+        idf: Idf of the term, stored if weights are given.
+        weights: Tf-idf weights of postings, stored quantized in blocks.
+        positions: Positions of the term in every document, sorted.
+        offsets: Byte offsets of the term in every document, stored if
+            positions are given.
+
+    Returns:
+        Encoded posting list.
+
+    """
+    gaps = _gaps(doc_ids)
+    flags = 0 if weights is None else HAS_WEIGHTS
+    if positions is not None:
+        flags |= HAS_POSITIONS
+    out = bytearray([flags])
+    vbyte_encode([len(doc_ids)], out)
+    if weights is None:
+        vbyte_encode(gaps, out)
+        vbyte_encode(tfs, out)
+        _encode_positions(positions, offsets, out)
+        return bytes(out)
+
+    max_weight = max(weights, default=0.0)
+    out.extend(WEIGHTS_HEADER.pack(idf, max_weight))
+    scale = WEIGHT_LEVELS / max_weight if max_weight > 0 else 0.0
+    quantized = [max(1, round(w * scale)) for w in weights]
+    table = []
+    blocks = bytearray()
+    last_docId = 0
+    for start in range(0, len(doc_ids), BLOCK_SIZE):
+        end = min(start + BLOCK_SIZE, len(doc_ids))
+        size = len(blocks)
+        vbyte_encode(gaps[start:end], blocks)
+        table.append(doc_ids[end - 1] - last_docId)
+        table.append(len(blocks) - size)
+        table.append(max(quantized[start:end]))
+        last_docId = doc_ids[end - 1]
+        blocks.extend(quantized[start:end])
+    vbyte_encode(table, out)
+    out.extend(blocks)
+    vbyte_encode(tfs, out)
+    _encode_positions(positions, offsets, out)
+    return bytes(out)
+
+
+def _encode_positions(
+    positions: Optional[List[List[int]]],
+    offsets: Optional[List[List[int]]],
+    out: bytearray,
+) -> None:
+    """Append positions section and its offset to encoded posting list."""
+    if positions is None:
+        return
+    section = len(out)
+    table = []
+    blocks = bytearray()
+    for start in range(0, len(positions), BLOCK_SIZE):
+        size = len(blocks)
+        for doc_positions, doc_offsets in zip(
+            positions[start:start + BLOCK_SIZE],
+            offsets[start:start + BLOCK_SIZE],
+        ):
+            vbyte_encode([len(doc_positions)], blocks)
+            vbyte_encode(_gaps(doc_positions), blocks)
+            vbyte_encode(_gaps(doc_offsets), blocks)
+        table.append(len(blocks) - size)
+    vbyte_encode(table, out)
+    out.extend(blocks)
+    out.extend(POSITIONS_TRAILER.pack(section))
+
+
+def _decode_header(
+    data: Buffer,
+) -> Tuple[int, int, Optional[Tuple[float, float]], int]:
+    """Decode header of posting list.
+
+    Returns:
+        Flags, document frequency, (idf, maximal weight) if posting list
+        has weights, and position right after the header.
+
+    """
+    flags = data[0]
+    (df,), pos = vbyte_decode(data, 1, 1)
+    weights_header = None
+    if flags & HAS_WEIGHTS:
+        weights_header = WEIGHTS_HEADER.unpack_from(data, pos)
+        pos += WEIGHTS_HEADER.size
+    return flags, df, weights_header, pos
+
+
+def _decode_block_table(
+    data: Buffer, df: int, pos: int
+) -> Tuple[List[int], List[int], List[int], int]:
+    """Decode table of blocks of posting list with weights.
+
+    Args:
+        data: Encoded posting list.
+        df: Document frequency.
+        pos: Position of the table.
+
+    Returns:
+        Last docID of every block, maximal quantized weight of every
+        block, start of every block relative to the first one (with one
+        extra for the end of the last block), and position of the first
+        block.
+
+    """
+    n_blocks = (df + BLOCK_SIZE - 1) // BLOCK_SIZE
+    table, pos = vbyte_decode(data, 3 * n_blocks, pos)
+    block_last = list(accumulate(table[0::3]))
+    sizes = [size + BLOCK_SIZE for size in table[1::3]]
+    if n_blocks:
+        sizes[-1] -= n_blocks * BLOCK_SIZE - df
+    block_starts = [0]
+    block_starts.extend(accumulate(sizes))
+    return block_last, table[2::3], block_starts, pos
+
+
+def decode_postings(data: Buffer) -> Tuple[List[int], List[int]]:
+    """Decode posting list of a term.
+
+    Args:
+        data: Encoded posting list.
+
+    Returns:
+        DocIDs, sorted in ascending order, and corresponding term
+        frequencies.
+
+    """
+    flags, df, _, pos = _decode_header(data)
+    if flags & HAS_WEIGHTS:
+        doc_ids, _ = decode_weights(data)
+        _, _, block_starts, pos = _decode_block_table(data, df, pos)
+        tfs, _ = vbyte_decode(data, df, pos + block_starts[-1])
+        return doc_ids, tfs
+    gaps, pos = vbyte_decode(data, df, pos)
+    tfs, _ = vbyte_decode(data, df, pos)
+    return list(accumulate(gaps)), tfs
+
+
+def has_weights(data: Buffer) -> bool:
+    """Check if posting list stores precomputed tf-idf weights."""
+    return bool(data[0] & HAS_WEIGHTS)
+
+
+def has_positions(data: Buffer) -> bool:
+    """Check if posting list stores positions and byte offsets."""
+    return bool(data[0] & HAS_POSITIONS)
+
+
+def decode_positions(
+    data: Buffer, indexes: Optional[List[int]] = None
+) -> Tuple[List[List[int]], List[List[int]]]:
+    """Decode positions and byte offsets of postings.
+
+    Only blocks that hold requested postings are decoded.
+
+    Args:
+        data: Encoded posting list with positions.
+        indexes: Indexes of postings in posting list, sorted in ascending
+            order. If None, all postings are decoded.
+
+    Returns:
+        Positions of the term in corresponding documents and byte offsets
+        of its occurrences.
+
+    """
+    _, df, _, _ = _decode_header(data)
+    (pos,) = POSITIONS_TRAILER.unpack_from(
+        data, len(data) - POSITIONS_TRAILER.size
+    )
+    n_blocks = (df + BLOCK_SIZE - 1) // BLOCK_SIZE
+    sizes, pos = vbyte_decode(data, n_blocks, pos)
+    block_starts = list(accumulate(sizes, initial=pos))
+    if indexes is None:
+        indexes = range(df)
+    positions, offsets = [], []
+    current = df  # Index of posting, that starts at pos
+    for i in indexes:
+        if current > i or current // BLOCK_SIZE != i // BLOCK_SIZE:
+            current = i - i % BLOCK_SIZE
+            pos = block_starts[i // BLOCK_SIZE]
+        while True:
+            (tf,), pos = vbyte_decode(data, 1, pos)
+            if current == i:
+                break
+            # Skip positions and offsets of preceding posting
+            _, pos = vbyte_decode(data, 2 * tf, pos)
+            current += 1
+        gaps, pos = vbyte_decode(data, tf, pos)
+        positions.append(list(accumulate(gaps)))
+        gaps, pos = vbyte_decode(data, tf, pos)
+        offsets.append(list(accumulate(gaps)))
+        current += 1
+    return positions, offsets
+
+
+def decode_df(data: Buffer) -> int:
+    """Get document frequency of the term of posting list."""
+    _, df, _, _ = _decode_header(data)
+    return df
+
+
+def decode_idf(data: Buffer) -> float:
+    """Get stored idf of the term of posting list with weights."""
+    _, _, (idf, _), _ = _decode_header(data)
+    return idf
+
+
+def decode_weights(data: Buffer) -> Tuple[List[int], List[float]]:
+    """Decode docIDs and precomputed tf-idf weights of posting list.
+
+    Args:
+        data: Encoded posting list with weights.
+
+    Returns:
+        DocIDs, sorted in ascending order, and tf-idf weights of term in
+        corresponding documents.
+
+    """
+    _, df, (_, max_weight), pos = _decode_header(data)
+    _, _, block_starts, pos = _decode_block_table(data, df, pos)
+    gaps, quantized = [], []
+    for start in range(0, df, BLOCK_SIZE):
+        count = min(BLOCK_SIZE, df - start)
+        block_gaps, pos = vbyte_decode(data, count, pos)
+        gaps.extend(block_gaps)
+        quantized.extend(data[pos:pos + count])
+        pos += count
+    scale = max_weight / WEIGHT_LEVELS
+    return list(accumulate(gaps)), [q * scale for q in quantized]
+
+
+class PostingCursor:
+    """Cursor over posting list with weights, that skips whole blocks.
+
+    Blocks are decoded lazily, only when cursor stops inside them.
+
+    Attributes:
+        df: Document frequency.
+        idf: Idf of the term.
+        max_score: Maximal tf-idf weight of the term.
+        doc: Current docID, END_DOC if cursor is exhausted.
+
+    """
+
+    def __init__(self, data: Buffer) -> None:
+        """Initialize PostingCursor and move it to the first posting.
+
+        Args:
+            data: Encoded posting list with weights.
+
+        """
+        _, self.df, (self.idf, self.max_score), pos = _decode_header(data)
+        (
+            self.block_last,
+            block_max,
+            self.block_starts,
+            self.blocks_pos,
+        ) = _decode_block_table(data, self.df, pos)
+        self.scale = self.max_score / WEIGHT_LEVELS
+        self.block_max = [q * self.scale for q in block_max]
+        self.data = data
+        self.block = -1
+        self.doc_ids = []
+        self.weights = []
+        self.pos = 0
+        self.doc = END_DOC
+        if self.df:
+            self._load(0)
+
+    def _load(self, block: int) -> None:
+        """Decode block and move cursor to its first posting."""
+        count = min(BLOCK_SIZE, self.df - block * BLOCK_SIZE)
+        pos = self.blocks_pos + self.block_starts[block]
+        gaps, pos = vbyte_decode(self.data, count, pos)
+        gaps[0] += self.block_last[block - 1] if block else 0
+        self.doc_ids = list(accumulate(gaps))
+        self.weights = self.data[pos:pos + count]
+        self.block = block
+        self.pos = 0
+        self.doc = self.doc_ids[0]
+
+    def score(self) -> float:
+        """Get tf-idf weight of current posting."""
+        return self.weights[self.pos] * self.scale
+
+    def index(self) -> int:
+        """Get index of current posting in posting list."""
+        return self.block * BLOCK_SIZE + self.pos
+
+    def next(self) -> int:
+        """Move cursor to the next posting.
+
+        Returns:
+            New current docID.
+
+        """
+        self.pos += 1
+        if self.pos < len(self.doc_ids):
+            self.doc = self.doc_ids[self.pos]
+        elif self.block + 1 < len(self.block_last):
+            self._load(self.block + 1)
+        else:
+            self.doc = END_DOC
+        return self.doc
+
+    def advance(self, target: int) -> int:
+        """Move cursor to the first posting with docID >= target.
+
+        Args:
+            target: DocID.
+
+        Returns:
+            New current docID.
+
+        """
+        if target <= self.doc:
+            return self.doc
+        if self.block_last[self.block] < target:
+            block = bisect_left(self.block_last, target, self.block + 1)
+            if block == len(self.block_last):
+                self.doc = END_DOC
+                return self.doc
+            self._load(block)
+        self.pos = bisect_left(self.doc_ids, target, self.pos)
+        self.doc = self.doc_ids[self.pos]
+        return self.doc
+
+    def block_bound(self, target: int) -> Tuple[int, float]:
+        """Get bounds of the block that would contain target, no decoding.
+
+        Args:
+            target: DocID, not less than current one.
+
+        Returns:
+            Last docID of the block and maximal weight in the block.
+            (END_DOC, 0) if there is no such block.
+
+        """
+        block = bisect_left(self.block_last, target, max(self.block, 0))
+        if block == len(self.block_last):
+            return END_DOC, 0.0
+        return self.block_last[block], self.block_max[block]
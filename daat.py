@@ -0,0 +1,385 @@
+"""This module implements document-at-a-time evaluation of query plans.
+
+Every operator of query plan is a cursor over its hits in order of docIDs,
+with the same interface as `compression.PostingCursor`:
+    doc: Current docID, END_DOC if cursor is exhausted.
+    next(): Move to the next hit.
+    advance(target): Move to the first hit with docID >= target.
+    score(): Tf-idf score of the current hit.
+    max_score: Upper bound of scores.
+    block_bound(target): Last docID and upper bound of scores of the
+        range of docIDs, that starts at target.
+Hits stream out of the root cursor one document at a time, so memory used
+by a query is bounded by the number of its terms and decoded blocks of
+their posting lists, not by the size of intermediate results.
+"""
+import heapq
+from bisect import bisect_left
+from compression import END_DOC
+from posting_arrays import PostingArrays
+from query_planner import POSITIONAL, Node
+from typing import Callable, Iterator, List, Optional, Tuple
+
+Posting = Tuple[int, float]
+
+
+class ArrayCursor:
+    """Cursor over decoded posting list.
+
+    Used for posting lists without stored weights and for missing terms.
+
+    Attributes:
+        doc_ids: DocIDs of postings.
+        scores: Scores of postings.
+        pos: Position of current posting.
+        max_score: Maximal score.
+        doc: Current docID.
+
+    """
+
+    def __init__(self, posting: PostingArrays) -> None:
+        """Initialize ArrayCursor and move it to the first posting.
+
+        Args:
+            posting: Posting list.
+
+        """
+        self.doc_ids = posting.doc_ids.tolist()
+        self.scores = posting.scores.tolist()
+        self.max_score = max(self.scores, default=0.0)
+        self.pos = 0
+        self.doc = self.doc_ids[0] if self.doc_ids else END_DOC
+
+    def _move(self, pos: int) -> int:
+        """Move to posting at position pos."""
+        self.pos = pos
+        if pos < len(self.doc_ids):
+            self.doc = self.doc_ids[pos]
+        else:
+            self.doc = END_DOC
+        return self.doc
+
+    def score(self) -> float:
+        return self.scores[self.pos]
+
+    def next(self) -> int:
+        return self._move(self.pos + 1)
+
+    def advance(self, target: int) -> int:
+        if target <= self.doc:
+            return self.doc
+        return self._move(bisect_left(self.doc_ids, target, self.pos))
+
+    def block_bound(self, target: int) -> Tuple[int, float]:
+        return END_DOC, self.max_score
+
+
+class AndCursor:
+    """Intersection of cursors, leapfrogging over their docIDs.
+
+    Attributes:
+        children: Cursors, the rarest first.
+        max_score: Sum of maximal scores of children.
+        doc: Current docID.
+
+    """
+
+    def __init__(self, children: List) -> None:
+        """Initialize AndCursor and move it to the first common docID.
+
+        Args:
+            children: Cursors, ordered by number of hits.
+
+        """
+        self.children = children
+        self.max_score = sum(c.max_score for c in children)
+        self.doc = END_DOC
+        self._align(children[0].doc)
+
+    def _align(self, doc: int) -> int:
+        """Move to the first docID >= doc, that is in all children."""
+        while doc != END_DOC:
+            for child in self.children:
+                child_doc = child.advance(doc)
+                if child_doc != doc:
+                    doc = child_doc
+                    break
+            else:
+                break
+        self.doc = doc
+        return doc
+
+    def score(self) -> float:
+        score = 0.0
+        for child in self.children:
+            score += child.score()
+        return score
+
+    def next(self) -> int:
+        return self._align(self.children[0].next())
+
+    def advance(self, target: int) -> int:
+        if target <= self.doc:
+            return self.doc
+        return self._align(target)
+
+    def block_bound(self, target: int) -> Tuple[int, float]:
+        last, bound = END_DOC, 0.0
+        for child in self.children:
+            child_last, child_bound = child.block_bound(target)
+            last = min(last, child_last)
+            bound += child_bound
+        return last, bound
+
+
+class OrCursor:
+    """Union of cursors.
+
+    Attributes:
+        children: Cursors.
+        max_score: Sum of maximal scores of children.
+        doc: Current docID, the least one of children.
+
+    """
+
+    def __init__(self, children: List) -> None:
+        """Initialize OrCursor.
+
+        Args:
+            children: Cursors.
+
+        """
+        self.children = children
+        self.max_score = sum(c.max_score for c in children)
+        self.doc = min(c.doc for c in children)
+
+    def score(self) -> float:
+        score = 0.0
+        for child in self.children:
+            if child.doc == self.doc:
+                score += child.score()
+        return score
+
+    def next(self) -> int:
+        for child in self.children:
+            if child.doc == self.doc:
+                child.next()
+        self.doc = min(c.doc for c in self.children)
+        return self.doc
+
+    def advance(self, target: int) -> int:
+        if target <= self.doc:
+            return self.doc
+        self.doc = min(c.advance(target) for c in self.children)
+        return self.doc
+
+    def block_bound(self, target: int) -> Tuple[int, float]:
+        last, bound = END_DOC, 0.0
+        for child in self.children:
+            if child.doc == END_DOC:
+                continue
+            child_last, child_bound = child.block_bound(target)
+            last = min(last, child_last)
+            bound += child_bound
+        return last, bound
+
+
+class NotCursor:
+    """Complement of cursor, hits have zero scores.
+
+    Attributes:
+        child: Cursor.
+        n_docs: Number of documents in corpus.
+        max_score: Zero.
+        doc: Current docID.
+
+    """
+
+    def __init__(self, child, n_docs: int) -> None:
+        """Initialize NotCursor and move it to the first docID.
+
+        Args:
+            child: Cursor of excluded documents.
+            n_docs: Number of documents in corpus.
+
+        """
+        self.child = child
+        self.n_docs = n_docs
+        self.max_score = 0.0
+        self.doc = -1
+        self._skip(0)
+
+    def _skip(self, doc: int) -> int:
+        """Move to the first docID >= doc, that is not in child."""
+        while doc < self.n_docs and self.child.advance(doc) == doc:
+            doc += 1
+        self.doc = doc if doc < self.n_docs else END_DOC
+        return self.doc
+
+    def score(self) -> float:
+        return 0.0
+
+    def next(self) -> int:
+        return self._skip(self.doc + 1)
+
+    def advance(self, target: int) -> int:
+        if target <= self.doc:
+            return self.doc
+        return self._skip(target)
+
+    def block_bound(self, target: int) -> Tuple[int, float]:
+        return END_DOC, 0.0
+
+
+class DiffCursor:
+    """Cursor with excluded documents. x AND NOT y.
+
+    Attributes:
+        child: Cursor.
+        excluded: Cursors of excluded documents.
+        max_score: Maximal score of child.
+        doc: Current docID.
+
+    """
+
+    def __init__(self, child, excluded: List) -> None:
+        """Initialize DiffCursor and move it to the first docID.
+
+        Args:
+            child: Cursor.
+            excluded: Cursors of excluded documents.
+
+        """
+        self.child = child
+        self.excluded = excluded
+        self.max_score = child.max_score
+        self.doc = END_DOC
+        self._skip()
+
+    def _skip(self) -> int:
+        """Move child to its first docID, that is not excluded."""
+        doc = self.child.doc
+        while doc != END_DOC and any(
+            e.advance(doc) == doc for e in self.excluded
+        ):
+            doc = self.child.next()
+        self.doc = doc
+        return doc
+
+    def score(self) -> float:
+        return self.child.score()
+
+    def next(self) -> int:
+        self.child.next()
+        return self._skip()
+
+    def advance(self, target: int) -> int:
+        if target <= self.doc:
+            return self.doc
+        self.child.advance(target)
+        return self._skip()
+
+    def block_bound(self, target: int) -> Tuple[int, float]:
+        return self.child.block_bound(target)
+
+
+def build_cursor(
+    node: Node,
+    term_cursor: Callable,
+    n_docs: int,
+    positional_cursor: Optional[Callable] = None,
+):
+    """Make cursor of query plan.
+
+    Args:
+        node: Root of query plan, see `query_planner.plan`.
+        term_cursor: Function that gets cursor of a query token.
+        n_docs: Number of documents in corpus.
+        positional_cursor: Function that gets cursor of PHRASE or NEAR
+            node.
+
+    Returns:
+        Cursor over query hits.
+
+    Raises:
+        ValueError: If plan has PHRASE or NEAR nodes, and there is no
+            positional_cursor.
+
+    """
+    if node.op == "TERM":
+        return term_cursor(node.token)
+    if node.op in POSITIONAL:
+        if positional_cursor is None:
+            raise ValueError("{} is not supported".format(node.op))
+        return positional_cursor(node)
+    children = [
+        build_cursor(c, term_cursor, n_docs, positional_cursor)
+        for c in node.children
+    ]
+    if node.op == "NOT":
+        return NotCursor(children[0], n_docs)
+    if node.op == "OR":
+        return OrCursor(children)
+    cursor = children[0] if len(children) == 1 else AndCursor(children)
+    if node.excluded:
+        excluded = [
+            build_cursor(c, term_cursor, n_docs, positional_cursor)
+            for c in node.excluded
+        ]
+        cursor = DiffCursor(cursor, excluded)
+    return cursor
+
+
+def iter_hits(cursor) -> Iterator[Posting]:
+    """Stream hits of cursor.
+
+    Args:
+        cursor: Cursor over query hits.
+
+    Yields:
+        (docID, tf-idf score) in order of docIDs.
+
+    """
+    while cursor.doc != END_DOC:
+        yield cursor.doc, cursor.score()
+        cursor.next()
+
+
+def daat_top_k(cursor, k: int) -> List[Posting]:
+    """Find k best hits of cursor.
+
+    When k hits are found, ranges of docIDs whose upper bound of score
+    can't beat the k-th best score are skipped, so the evaluation stops
+    early, e.g. right after k hits of a complement, whose scores are zero.
+
+    Args:
+        cursor: Cursor over query hits.
+        k: How many best hits to find.
+
+    Returns:
+        List of k best (docID, score), sorted by score in descending order
+        and by docID among equal scores.
+
+    """
+    if k <= 0:
+        return []
+    heap = []  # min-heap of (score, -docID) of k best documents
+    threshold = 0.0
+    while cursor.doc != END_DOC:
+        doc = cursor.doc
+        if len(heap) >= k:
+            last, bound = cursor.block_bound(doc)
+            if bound <= threshold:
+                if last == END_DOC:
+                    break
+                cursor.advance(last + 1)
+                continue
+        score = cursor.score()
+        if len(heap) < k:
+            heapq.heappush(heap, (score, -doc))
+        elif score > threshold:
+            heapq.heapreplace(heap, (score, -doc))
+        if len(heap) >= k:
+            threshold = heap[0][0]
+        cursor.next()
+    return [(-docId, score) for score, docId in sorted(heap, reverse=True)]
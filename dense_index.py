@@ -0,0 +1,296 @@
+"""This module implements dense retrieval with approximate nearest neighbours.
+
+Boolean search finds only documents with exact lexical matches of query
+terms. Dense retrieval finds documents whose embeddings are close to the
+query embedding, without scanning all embeddings of corpus: embeddings of
+corpus (see `embed_job.py`) are put into a faiss index, which is built
+once and saved next to them. Embeddings are L2-normalized, so inner
+product is cosine similarity. Two kinds of index are supported:
+    ivf: Embeddings are clustered with k-means into inverted lists, query
+        scans only `probe` lists with the closest centroids.
+    hnsw: Embeddings are linked into a navigable small world graph, query
+        explores `probe` best candidates of the graph.
+In both cases bigger `probe` gives better recall and bigger latency.
+
+Results of dense and lexical retrieval are fused with reciprocal rank
+fusion, which needs only ranks, so tf-idf scores and cosine similarities
+don't have to be calibrated against each other.
+"""
+import argparse
+import faiss
+import numpy as np
+import os
+from embedder import check_embeddings_version
+from typing import List, Optional, Sequence, Tuple
+
+INDEX_KINDS = ("ivf", "hnsw")
+# Rank constant of reciprocal rank fusion
+RRF_K = 60
+# Training points of k-means per inverted list, faiss needs at least 39
+TRAIN_PER_LIST = 64
+MIN_TRAIN_PER_LIST = 39
+# Embeddings normalized and added to index at once
+ADD_CHUNK = 16384
+# Default number of inverted lists or graph candidates explored per query
+PROBE = 16
+
+
+def _normalized(embeddings: np.ndarray) -> np.ndarray:
+    """Get float32 copy of embeddings with unit L2 norm, zeros stay zeros."""
+    embeddings = np.array(embeddings, dtype=np.float32, order="C", ndmin=2)
+    faiss.normalize_L2(embeddings)
+    return embeddings
+
+
+def build_dense_index(
+    embeddings: np.ndarray,
+    kind: str = "ivf",
+    n_lists: int = 0,
+    hnsw_m: int = 32,
+    ef_construction: int = 200,
+    probe: int = PROBE,
+) -> faiss.Index:
+    """Build approximate nearest neighbours index over embeddings.
+
+    Embeddings are normalized and added in chunks, so they may be a memory
+    map of a file larger than memory.
+
+    Args:
+        embeddings: Numpy array of (N, 768) of texts embeddings, rows by
+            docID.
+        kind: Kind of index, "ivf" or "hnsw".
+        n_lists: Number of inverted lists of IVF, about 4 * sqrt(N) if not
+            positive (less for small corpus, so that k-means has enough
+            training points).
+        hnsw_m: Number of neighbours of a node of HNSW graph.
+        ef_construction: Candidates explored while HNSW graph is built.
+        probe: Default number of inverted lists (IVF) or graph candidates
+            (HNSW) explored per query, it is saved with index.
+
+    Returns:
+        Faiss index with inner product metric, ids are docIDs.
+
+    Raises:
+        ValueError: If kind of index is unknown.
+
+    """
+    n_docs, dim = embeddings.shape
+    if kind == "ivf":
+        if n_lists <= 0:
+            n_lists = min(
+                int(4 * np.sqrt(n_docs)), n_docs // MIN_TRAIN_PER_LIST
+            )
+        n_lists = max(1, min(n_lists, n_docs))
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFFlat(
+            quantizer, dim, n_lists, faiss.METRIC_INNER_PRODUCT
+        )
+        n_train = min(n_docs, n_lists * TRAIN_PER_LIST)
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(n_docs, n_train, replace=False))
+        index.train(_normalized(embeddings[sample]))
+        index.nprobe = probe
+    elif kind == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ef_construction
+        index.hnsw.efSearch = probe
+    else:
+        raise ValueError("Unknown kind of index {}".format(kind))
+    for start in range(0, n_docs, ADD_CHUNK):
+        index.add(_normalized(embeddings[start:start + ADD_CHUNK]))
+    return index
+
+
+class DenseIndex:
+    """Persisted approximate nearest neighbours index of corpus embeddings.
+
+    Searches don't change the index, so it may be shared between threads.
+
+    Attributes:
+        index: Faiss index, IVF or HNSW.
+        probe: Default number of inverted lists (IVF) or graph candidates
+            (HNSW) explored per query.
+
+    """
+
+    def __init__(self, path: str, probe: int = 0) -> None:
+        """Initialize DenseIndex by reading index file.
+
+        Args:
+            path: Index file, written by `save_dense_index`.
+            probe: Default number of inverted lists or graph candidates
+                explored per query, the one saved with index if not
+                positive.
+
+        """
+        self.index = faiss.read_index(path)
+        if probe <= 0:
+            if isinstance(self.index, faiss.IndexHNSW):
+                probe = self.index.hnsw.efSearch
+            else:
+                probe = faiss.extract_index_ivf(self.index).nprobe
+        self.probe = probe
+
+    def __len__(self) -> int:
+        return self.index.ntotal
+
+    def search_params(self, probe: int) -> faiss.SearchParameters:
+        """Get search parameters of index for given effort."""
+        if isinstance(self.index, faiss.IndexHNSW):
+            return faiss.SearchParametersHNSW(efSearch=max(probe, 1))
+        return faiss.SearchParametersIVF(nprobe=max(probe, 1))
+
+    def search(
+        self, query_emb: np.ndarray, k: int, probe: Optional[int] = None
+    ) -> List[Tuple[int, float]]:
+        """Find documents with embeddings closest to query embedding.
+
+        Args:
+            query_emb: Query embedding.
+            k: How many documents to find.
+            probe: Number of inverted lists or graph candidates explored,
+                default of index if None.
+
+        Returns:
+            List of (docID, cosine similarity), sorted by similarity. It may
+            be shorter than k, if not enough documents are explored.
+
+        """
+        if k <= 0 or not len(self):
+            return []
+        if probe is None:
+            probe = self.probe
+        # HNSW can't find more documents than it explores
+        if isinstance(self.index, faiss.IndexHNSW):
+            probe = max(probe, k)
+        sims, ids = self.index.search(
+            _normalized(query_emb), k, params=self.search_params(probe)
+        )
+        return [
+            (docId, sim)
+            for docId, sim in zip(ids[0].tolist(), sims[0].tolist())
+            if docId >= 0
+        ]
+
+
+def save_dense_index(index: faiss.Index, path: str) -> None:
+    """Write index built by `build_dense_index` to file."""
+    faiss.write_index(index, path)
+
+
+def load_dense_index(path: str, probe: int = 0) -> Optional[DenseIndex]:
+    """Read dense index, None if there is no such file, see `DenseIndex`."""
+    if not os.path.exists(path):
+        return None
+    return DenseIndex(path, probe)
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[Sequence[int]],
+    k: int = RRF_K,
+    weights: Optional[Sequence[float]] = None,
+) -> List[Tuple[int, float]]:
+    """Fuse rankings of documents with reciprocal rank fusion.
+
+    Every document gets sum of weight / (k + rank) over rankings it is in,
+    ranks start from 1.
+
+    Args:
+        rankings: Lists of docIDs, best first.
+        k: Rank constant, bigger values flatten the difference between
+            top and lower ranks.
+        weights: Weight of every ranking, 1 for all if None.
+
+    Returns:
+        List of (docID, fused score), sorted by score in descending order
+        and by docID among equal scores.
+
+    """
+    if weights is None:
+        weights = [1.0] * len(rankings)
+    scores = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, docId in enumerate(ranking, 1):
+            scores[docId] = scores.get(docId, 0.0) + weight / (k + rank)
+    return sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+
+
+def arg_parse() -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Building dense index")
+    parser.add_argument(
+        "--emb",
+        dest="emb_file",
+        help="Numpy file with embeddings for all texts",
+        default="embeddings.npy",
+        type=str,
+    )
+    parser.add_argument(
+        "--ann",
+        dest="ann_file",
+        help="Dense index file",
+        default="embeddings.faiss",
+        type=str,
+    )
+    parser.add_argument(
+        "--kind",
+        dest="kind",
+        help="Kind of index",
+        choices=INDEX_KINDS,
+        default="ivf",
+        type=str,
+    )
+    parser.add_argument(
+        "--lists",
+        dest="n_lists",
+        help="Number of inverted lists of IVF, about 4 * sqrt(N) if 0",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--probe",
+        dest="probe",
+        help="Default number of inverted lists (IVF) or graph candidates "
+        "(HNSW) explored per query",
+        default=PROBE,
+        type=int,
+    )
+    parser.add_argument(
+        "--m",
+        dest="hnsw_m",
+        help="Number of neighbours of a node of HNSW graph",
+        default=32,
+        type=int,
+    )
+    parser.add_argument(
+        "--ef",
+        dest="ef_construction",
+        help="Candidates explored while HNSW graph is built",
+        default=200,
+        type=int,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = arg_parse()
+    embeddings = np.load(args.emb_file, mmap_mode="r")
+    check_embeddings_version(args.emb_file)
+    index = build_dense_index(
+        embeddings,
+        args.kind,
+        args.n_lists,
+        args.hnsw_m,
+        args.ef_construction,
+        args.probe,
+    )
+    save_dense_index(index, args.ann_file)
+    print(
+        "{} embeddings are indexed into {}".format(
+            index.ntotal, args.ann_file
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
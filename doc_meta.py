@@ -0,0 +1,170 @@
+"""This module implements storage of documents metadata.
+
+Metadata is collected while building the index and saved in one binary
+file, so querying scripts don't have to walk and reread the corpus. File
+consists of a header (magic, number of documents, number of bands) and
+arrays of uint32:
+    lengths: Number of tokens in every document.
+    band_starts: First docID of every band, and total number of documents.
+    band_offsets: Offsets of band names in names blob, one extra.
+    title_offsets: Offsets of song filenames in titles blob, one extra.
+followed by UTF-8 encoded band names blob and titles blob.
+
+DocIDs are positions of documents 'band/song.txt' in sorted list, so
+songs of every band occupy a contiguous range of docIDs.
+"""
+import os
+import struct
+from array import array
+from bisect import bisect_right
+from typing import Dict, Iterator, List, Tuple
+
+META_MAGIC = b"DMET"
+HEADER = struct.Struct("<4sII")
+
+
+def list_docs(root: str) -> List[str]:
+    """Get sorted list of documents in corpus, index is used as docID.
+
+    Args:
+        root: Directory where songs lyrics is.
+
+    Returns:
+        Sorted list of paths 'band/song.txt', relative to root.
+
+    """
+    docs = [
+        dir + "/" + f
+        for dir in os.listdir(root)
+        for f in os.listdir(os.path.join(root, dir))
+    ]
+    return sorted(docs)
+
+
+def write_doc_meta(path: str, docs: List[str], lengths: List[int]) -> None:
+    """Save documents metadata.
+
+    Args:
+        path: Metadata file path.
+        docs: Sorted list of documents 'band/song.txt'.
+        lengths: Number of tokens in every document.
+
+    """
+    band_starts = array("I")
+    band_offsets = array("I", [0])
+    title_offsets = array("I", [0])
+    names = bytearray()
+    titles = bytearray()
+    last_band = None
+    for docId, doc in enumerate(docs):
+        band, title = doc.split("/")
+        if band != last_band:
+            band_starts.append(docId)
+            names.extend(band.encode("utf-8"))
+            band_offsets.append(len(names))
+            last_band = band
+        titles.extend(title.encode("utf-8"))
+        title_offsets.append(len(titles))
+    band_starts.append(len(docs))
+
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(META_MAGIC, len(docs), len(band_starts) - 1))
+        array("I", lengths).tofile(f)
+        band_starts.tofile(f)
+        band_offsets.tofile(f)
+        title_offsets.tofile(f)
+        f.write(names)
+        f.write(titles)
+
+
+class DocMeta:
+    """Documents metadata, loaded with a single read.
+
+    Behaves like a read-only list of documents filenames 'band/song.txt'.
+
+    Attributes:
+        lengths: Number of tokens in every document.
+        band_names: Names of bands, sorted.
+        band_starts: First docID of every band, and number of documents.
+        title_offsets: Offsets of song filenames in titles blob.
+        titles: Concatenated song filenames.
+
+    """
+
+    def __init__(self, path: str) -> None:
+        """Initialize DocMeta by reading metadata file.
+
+        Args:
+            path: Metadata file path.
+
+        """
+        with open(path, "rb") as f:
+            data = memoryview(f.read())
+        magic, n_docs, n_bands = HEADER.unpack_from(data)
+        if magic != META_MAGIC:
+            raise ValueError("{} is not a metadata file".format(path))
+
+        start = HEADER.size
+        end = start + 4 * n_docs
+        self.lengths = data[start:end].cast("I")
+        start, end = end, end + 4 * (n_bands + 1)
+        self.band_starts = data[start:end].cast("I")
+        start, end = end, end + 4 * (n_bands + 1)
+        band_offsets = data[start:end].cast("I")
+        start, end = end, end + 4 * (n_docs + 1)
+        self.title_offsets = data[start:end].cast("I")
+        names = data[end:end + band_offsets[-1]]
+        self.band_names = [
+            str(names[band_offsets[i]:band_offsets[i + 1]], "utf-8")
+            for i in range(n_bands)
+        ]
+        self.titles = data[end + band_offsets[-1]:]
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def __getitem__(self, docId: int) -> str:
+        """Get filename 'band/song.txt' of a document."""
+        return self.band(docId) + "/" + self.title(docId)
+
+    def __iter__(self) -> Iterator[str]:
+        for docId in range(len(self)):
+            yield self[docId]
+
+    def band(self, docId: int) -> str:
+        """Get band name of a document."""
+        if not 0 <= docId < len(self):
+            raise IndexError(docId)
+        return self.band_names[bisect_right(self.band_starts, docId) - 1]
+
+    def title(self, docId: int) -> str:
+        """Get song filename of a document."""
+        start, end = self.title_offsets[docId], self.title_offsets[docId + 1]
+        return str(self.titles[start:end], "utf-8")
+
+    def bands(self) -> Dict[str, Tuple[int, int]]:
+        """Get bands and corresponding start docID and end docID."""
+        return {
+            band: (self.band_starts[i], self.band_starts[i + 1])
+            for i, band in enumerate(self.band_names)
+        }
+
+    def index(self, doc: str) -> int:
+        """Get docID of a document.
+
+        Args:
+            doc: Filename 'band/song.txt'.
+
+        Returns:
+            DocID.
+
+        Raises:
+            ValueError: If document is not in corpus.
+
+        """
+        band, _, title = doc.partition("/")
+        start, end = self.bands().get(band, (0, 0))
+        for docId in range(start, end):
+            if self.title(docId) == title:
+                return docId
+        raise ValueError("{} is not in corpus".format(doc))
@@ -0,0 +1,305 @@
+"""This module implements packed storage of documents texts.
+
+Thousands of small files of the corpus are packed into one file, so
+reading a document is a lookup in offset table and a slice of memory map,
+instead of opening a file. Store consists of a header (magic, number of
+documents, number of blocks, flags, offset of tables), data and tables:
+    doc_offsets: Offset of every document in concatenated texts (uint64,
+        one extra for the end of the last document).
+    block_docs: First docID of every block (uint32, one extra).
+    block_offsets: Offset of every block in data (uint64, one extra).
+Documents are kept in raw bytes, as they are in files. With compression
+consecutive documents are grouped into blocks of about BLOCK_SIZE bytes,
+every block is compressed with zlib, and recently used decompressed blocks
+are cached.
+
+Stores have the interface of read-only list of documents bytes indexed by
+docID. `DirectoryStore` has the same interface over a directory of files,
+it is used if corpus is not packed.
+"""
+import mmap
+import os
+import struct
+import threading
+import zlib
+from array import array
+from bisect import bisect_right
+from cache import LRUCache
+from typing import Iterator, List, Sequence, Union
+
+STORE_MAGIC = b"DSTR"
+HEADER = struct.Struct("<4sIIIQ")
+# Flags of store
+COMPRESSED = 1
+# Size of uncompressed block of documents in bytes
+BLOCK_SIZE = 64 * 1024
+# Budget of decompressed blocks cache in bytes
+BLOCK_CACHE_SIZE = 4 * 2 ** 20
+
+
+def universal_newlines(data: bytes) -> str:
+    """Decode document the same way, as a file opened in text mode."""
+    return data.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+
+
+class DocStoreWriter:
+    """Class that writes packed store, document by document.
+
+    Documents must be added in order of docIDs. Without compression they
+    are written right away, as a single block.
+
+    Attributes:
+        path: Store filepath.
+        compress: Compress blocks of documents.
+        block_size: Size of uncompressed block in bytes.
+        doc_offsets: Offset of every document in concatenated texts.
+        block_docs: First docID of every block.
+        block_offsets: Offset of every block in data.
+        block: Documents of current block, not written yet.
+
+    """
+
+    def __init__(
+        self, path: str, compress: bool = False, block_size: int = BLOCK_SIZE
+    ) -> None:
+        """Initialize DocStoreWriter and open store file.
+
+        Args:
+            path: Store filepath.
+            compress: Compress blocks of documents with zlib.
+            block_size: Size of uncompressed block in bytes.
+
+        """
+        self.path = path
+        self.compress = compress
+        self.block_size = block_size
+        self.doc_offsets = array("Q", [0])
+        self.block_docs = array("I", [] if compress else [0])
+        self.block_offsets = array("Q", [0])
+        self.block = bytearray()
+        self.f = open(path, "wb")
+        self.f.write(HEADER.pack(STORE_MAGIC, 0, 0, 0, 0))
+
+    def add(self, data: bytes) -> None:
+        """Append document.
+
+        Args:
+            data: Document bytes.
+
+        """
+        if not self.compress:
+            self.f.write(data)
+            self.doc_offsets.append(self.doc_offsets[-1] + len(data))
+            return
+        if len(self.block_docs) < len(self.block_offsets):
+            # Start a new block
+            self.block_docs.append(len(self.doc_offsets) - 1)
+        self.block.extend(data)
+        self.doc_offsets.append(self.doc_offsets[-1] + len(data))
+        if len(self.block) >= self.block_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        """Write current block."""
+        data = zlib.compress(self.block)
+        self.f.write(data)
+        self.block_offsets.append(self.block_offsets[-1] + len(data))
+        self.block = bytearray()
+
+    def close(self) -> None:
+        """Write the last block, tables and header, and close store."""
+        if not self.compress:
+            self.block_offsets.append(self.doc_offsets[-1])
+        elif len(self.block_docs) == len(self.block_offsets):
+            self._flush()
+        self.block_docs.append(len(self.doc_offsets) - 1)
+        tables = self.f.tell()
+        self.doc_offsets.tofile(self.f)
+        self.block_docs.tofile(self.f)
+        self.block_offsets.tofile(self.f)
+        self.f.seek(0)
+        self.f.write(
+            HEADER.pack(
+                STORE_MAGIC,
+                len(self.doc_offsets) - 1,
+                len(self.block_docs) - 1,
+                COMPRESSED if self.compress else 0,
+                tables,
+            )
+        )
+        self.f.close()
+
+
+def write_doc_store(
+    path: str,
+    files: List[str],
+    compress: bool = False,
+    block_size: int = BLOCK_SIZE,
+) -> None:
+    """Pack files into store, in one pass.
+
+    Args:
+        path: Store filepath.
+        files: Filepaths, in order of docIDs.
+        compress: Compress blocks of documents with zlib.
+        block_size: Size of uncompressed block in bytes.
+
+    """
+    writer = DocStoreWriter(path, compress, block_size)
+    for filepath in files:
+        with open(filepath, "rb") as f:
+            writer.add(f.read())
+    writer.close()
+
+
+class DocStore:
+    """Read-only memory-mapped packed store.
+
+    Behaves like a read-only list of documents bytes indexed by docID.
+
+    Attributes:
+        map: Memory-mapped store file.
+        compressed: Blocks of documents are compressed.
+        doc_offsets: Offset of every document in concatenated texts.
+        block_docs: First docID of every block.
+        block_offsets: Offset of every block in data.
+        data: Blocks of documents.
+        blocks: Cache of decompressed blocks.
+        lock: Lock of the cache, store may be shared between threads.
+
+    """
+
+    def __init__(self, path: str) -> None:
+        """Initialize DocStore by mapping store file.
+
+        Args:
+            path: Store filepath.
+
+        """
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n_docs, n_blocks, flags, tables = HEADER.unpack_from(self.map)
+        if magic != STORE_MAGIC:
+            raise ValueError("{} is not a document store".format(path))
+        self.compressed = bool(flags & COMPRESSED)
+
+        view = memoryview(self.map)
+        start, end = tables, tables + 8 * (n_docs + 1)
+        self.doc_offsets = view[start:end].cast("Q")
+        start, end = end, end + 4 * (n_blocks + 1)
+        self.block_docs = view[start:end].cast("I")
+        start, end = end, end + 8 * (n_blocks + 1)
+        self.block_offsets = view[start:end].cast("Q")
+        self.data = view[HEADER.size:tables]
+        self.blocks = LRUCache(BLOCK_CACHE_SIZE, len)
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.doc_offsets) - 1
+
+    def __getitem__(self, docId: int) -> bytes:
+        """Get document bytes.
+
+        Raises:
+            IndexError: If there is no such document.
+
+        """
+        if not 0 <= docId < len(self):
+            raise IndexError(docId)
+        start, end = self.doc_offsets[docId], self.doc_offsets[docId + 1]
+        if not self.compressed:
+            return bytes(self.data[start:end])
+        block = bisect_right(self.block_docs, docId) - 1
+        block_start = self.doc_offsets[self.block_docs[block]]
+        return self._block(block)[start - block_start:end - block_start]
+
+    def __iter__(self) -> Iterator[bytes]:
+        for docId in range(len(self)):
+            yield self[docId]
+
+    def _block(self, block: int) -> bytes:
+        """Get decompressed block of documents."""
+        with self.lock:
+            data = self.blocks.get(block)
+            if data is None:
+                start = self.block_offsets[block]
+                end = self.block_offsets[block + 1]
+                data = zlib.decompress(self.data[start:end])
+                self.blocks.put(block, data)
+            return data
+
+    def text(self, docId: int) -> str:
+        """Get document text, decoded with universal newlines."""
+        return universal_newlines(self[docId])
+
+    def close(self) -> None:
+        """Release memory map."""
+        for view in (
+            self.doc_offsets,
+            self.block_docs,
+            self.block_offsets,
+            self.data,
+        ):
+            view.release()
+        self.map.close()
+
+
+class DirectoryStore:
+    """Store over a directory of documents files, that are not packed.
+
+    Attributes:
+        root: Directory of documents.
+        docs: List-like of documents filenames indexed by docID.
+
+    """
+
+    def __init__(self, root: str, docs: Sequence[str]) -> None:
+        """Initialize DirectoryStore.
+
+        Args:
+            root: Directory of documents.
+            docs: List-like of documents filenames indexed by docID, e.g.
+                `doc_meta.DocMeta`.
+
+        """
+        self.root = root
+        self.docs = docs
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def __getitem__(self, docId: int) -> bytes:
+        """Get document bytes."""
+        with open(os.path.join(self.root, self.docs[docId]), "rb") as f:
+            return f.read()
+
+    def __iter__(self) -> Iterator[bytes]:
+        for docId in range(len(self)):
+            yield self[docId]
+
+    def text(self, docId: int) -> str:
+        """Get document text, decoded with universal newlines."""
+        return universal_newlines(self[docId])
+
+    def close(self) -> None:
+        pass
+
+
+Store = Union[DocStore, DirectoryStore]
+
+
+def open_doc_store(path: str, root: str, docs: Sequence[str]) -> Store:
+    """Open packed store, or directory of documents if it is not packed.
+
+    Args:
+        path: Store filepath.
+        root: Directory of documents.
+        docs: List-like of documents filenames indexed by docID.
+
+    Returns:
+        DocStore or DirectoryStore.
+
+    """
+    if os.path.exists(path):
+        return DocStore(path)
+    return DirectoryStore(root, docs)
@@ -11,87 +11,44 @@ import numpy as np
 import os
 import pickle
 from collections import defaultdict
-from embedder import Embedder, get_text_reduced
+from doc_meta import DocMeta
+from doc_store import Store, open_doc_store
+from embed_job import checkpoint_path, embed_corpus
+from embedder import BACKENDS, check_embeddings_version
 from sklearn.preprocessing import normalize
-from tqdm import trange
 from typing import List, Dict, Tuple
 
 
-def calc_embeddings(
-    docs: List[str], batch_size: int, root: str
-) -> np.ndarray:
-    """Calculate embeddings (in batches).
-
-    Args:
-        docs: List of documents filenames.
-        batch_size: Batch size.
-        root: Root directory.
-
-    Returns:
-        Numpy array of (N, 768) of texts embeddings.
-
-    """
-    embedder = Embedder()
-    all_embeddings = np.zeros((len(docs), 768), dtype=np.float32)
-
-    iters = len(docs) // batch_size
-    if len(docs) % batch_size > 0:
-        iters += 1
-
-    for i in trange(iters):
-        batch = docs[i * batch_size: (i + 1) * batch_size]
-        filenames = [os.path.join(root, doc) for doc in batch]
-        texts = [get_text_reduced(x, maxlen=512) for x in filenames]
-        embeddings = embedder.embed(texts)
-        all_embeddings[i * batch_size: (i + 1) * batch_size] = embeddings
-    return all_embeddings
-
-
-def get_embeddings(docs: List[str], args: argparse.Namespace) -> np.ndarray:
+def get_embeddings(store: Store, args: argparse.Namespace) -> np.ndarray:
     """Load cached (or calculate) embeddings and normalize them.
 
+    Embeddings are calculated by `embed_job.embed_corpus`, which resumes
+    interrupted calculation.
+
     Args:
-        docs: List of documents filenames.
+        store: Documents store, see `doc_store.open_doc_store`.
         args: Command-line arguments.
 
     Returns:
         Numpy array of (N, 768) of normalized embeddings.
 
+    Raises:
+        ValueError: If cached embeddings are made by older Embedder.
+
     """
-    try:
-        all_embeddings = np.load(args.emb_file)
-    except FileNotFoundError:
+    ckpt = checkpoint_path(args.emb_file)
+    if not os.path.exists(args.emb_file) or os.path.exists(ckpt):
         print("Embeddings not found. Calculating embeddings...")
-        all_embeddings = calc_embeddings(docs, args.batch_size, args.root)
-        np.save(args.emb_file, all_embeddings)
+        embed_corpus(
+            store, args.emb_file, args.batch_size, args.backend, args.threads
+        )
+    check_embeddings_version(args.emb_file)
+    all_embeddings = np.load(args.emb_file)
     all_embeddings = all_embeddings.astype(np.float32)
     all_embeddings = normalize(all_embeddings, axis=1)
     return all_embeddings
 
 
-def get_bands(docs: List[str]) -> Dict[str, Tuple[int, int]]:
-    """Get unique bands and corresponding start docID and end docID.
-
-    Args:
-        docs: List of documents filenames.
-
-    Returns:
-        Dictionary of bands' start and end docIDs.
-
-    """
-    bands = {}
-    last_band = ""
-    for i, d in enumerate(docs):
-        band = d.split("/")[0]
-        if last_band != band:
-            if last_band != "":
-                start = bands[last_band]
-                bands[last_band] = (start, i)
-            last_band = band
-            bands[band] = i
-    return bands
-
-
 def get_band_duplicates(
     duplicates: Dict[int, List[int]],
     band_name: str,
@@ -153,6 +110,20 @@ def arg_parse() -> argparse.Namespace:
     parser.add_argument(
         "--index", dest="index", help="Index file", default="index", type=str
     )
+    parser.add_argument(
+        "--meta",
+        dest="meta",
+        help="Documents metadata file",
+        default="docs.meta",
+        type=str,
+    )
+    parser.add_argument(
+        "--store",
+        dest="store",
+        help="Packed documents file",
+        default="docs.store",
+        type=str,
+    )
     parser.add_argument(
         "--emb",
         dest="emb_file",
@@ -174,6 +145,20 @@ def arg_parse() -> argparse.Namespace:
         default=10,
         type=int,
     )
+    parser.add_argument(
+        "--backend",
+        dest="backend",
+        help="Inference backend of embedder",
+        choices=BACKENDS,
+        default="torch",
+    )
+    parser.add_argument(
+        "--threads",
+        dest="threads",
+        help="Number of CPU threads of embedder, default if 0",
+        default=0,
+        type=int,
+    )
     parser.add_argument(
         "--k",
         dest="k",
@@ -219,12 +204,8 @@ def arg_parse() -> argparse.Namespace:
 
 def main():
     args = arg_parse()
-    docs = [
-        os.path.join(dir, f)
-        for dir in os.listdir(args.root)
-        for f in os.listdir(os.path.join(args.root, dir))
-    ]
-    docs = sorted(docs)
+    meta = DocMeta(args.meta)
+    docs = list(meta)
 
     try:
         # Load duplicates dict
@@ -232,7 +213,9 @@ def main():
             duplicates = pickle.load(f)
     except FileNotFoundError:
         # Get BERT embeddings for all texts
-        all_embeddings = get_embeddings(docs, args)
+        store = open_doc_store(args.store, args.root, meta)
+        all_embeddings = get_embeddings(store, args)
+        store.close()
         # kNN then with faiss
         print("Duplicates dict not found. Calculating duplicates dict...")
         index = faiss.IndexFlatIP(768)
@@ -259,7 +242,7 @@ def main():
 
     # Print duplicates in some band's songs
     if args.band_name != "":
-        bands = get_bands(docs)
+        bands = meta.bands()
         d = get_band_duplicates(duplicates, args.band_name, bands)
         if d:
             print_duplicates(docs, d)
@@ -268,8 +251,8 @@ def main():
     if args.find_file != "":
         try:
             # Search file in duplicates dict
-            name = os.path.join(*args.find_file.split("/")[-2:])
-            idx = docs.index(name)
+            name = "/".join(args.find_file.split("/")[-2:])
+            idx = meta.index(name)
 
             if not duplicates[idx]:
                 print("No duplicates found")
@@ -0,0 +1,218 @@
+"""This module benchmarks inference backends of Embedder.
+
+A sample of corpus is embedded with the full precision model and with
+every selected backend (see `embedder.BACKENDS`). For every backend
+throughput is reported, and agreement of its embeddings with the full
+precision ones: cosine similarity of embeddings of the same text, and
+overlap of k nearest neighbours of every text within the sample, which
+is what search and duplicate detection depend on.
+"""
+import argparse
+import json
+import numpy as np
+import time
+from doc_meta import DocMeta
+from doc_store import open_doc_store
+from embedder import BACKENDS, MAX_TOKENS, Embedder, get_text_reduced
+from typing import Any, Dict, List
+
+# Texts embedded before timing, so that one-time costs are not measured
+WARMUP = 8
+
+
+def normalized(embeddings: np.ndarray) -> np.ndarray:
+    """Get embeddings with unit L2 norm, zeros stay zeros."""
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embeddings / norms
+
+
+def nearest(embeddings: np.ndarray, k: int) -> np.ndarray:
+    """Get k nearest neighbours of normalized embeddings, except itself."""
+    sims = embeddings @ embeddings.T
+    np.fill_diagonal(sims, -np.inf)
+    return np.argsort(-sims, axis=1, kind="stable")[:, :k]
+
+
+def run_backend(
+    embedder: Embedder, texts: List[str], token_budget: int
+) -> Dict[str, Any]:
+    """Embed texts and measure throughput.
+
+    Args:
+        embedder: Embedder with some backend.
+        texts: Texts of sample.
+        token_budget: Maximal number of padded tokens in a batch.
+
+    Returns:
+        Embeddings, number of tokens, time in seconds, texts and tokens
+        per second.
+
+    """
+    embedder.embed_batched(texts[:WARMUP], token_budget)
+    before = embedder.stats()
+    start = time.perf_counter()
+    embeddings = embedder.embed_batched(texts, token_budget)
+    seconds = time.perf_counter() - start
+    tokens = embedder.stats()["tokens"] - before["tokens"]
+    return {
+        "embeddings": embeddings,
+        "tokens": tokens,
+        "seconds": seconds,
+        "texts_per_sec": len(texts) / seconds,
+        "tokens_per_sec": tokens / seconds,
+    }
+
+
+def agreement(
+    embeddings: np.ndarray, baseline: np.ndarray, k: int
+) -> Dict[str, float]:
+    """Get agreement of embeddings with baseline embeddings.
+
+    Args:
+        embeddings: Embeddings of sample by some backend.
+        baseline: Full precision embeddings of the same texts.
+        k: Number of nearest neighbours to compare.
+
+    Returns:
+        Mean and minimal cosine similarity of embeddings of the same text,
+        and mean overlap of k nearest neighbours.
+
+    """
+    embeddings = normalized(embeddings)
+    baseline = normalized(baseline)
+    cos_sim = np.sum(embeddings * baseline, axis=1)
+    k = min(k, len(baseline) - 1)
+    overlap = 1.0
+    if k > 0:
+        found = nearest(embeddings, k)
+        expected = nearest(baseline, k)
+        overlap = np.mean(
+            [len(np.intersect1d(x, y)) / k for x, y in zip(found, expected)]
+        )
+    return {
+        "cos_mean": float(cos_sim.mean()),
+        "cos_min": float(cos_sim.min()),
+        "knn_overlap": float(overlap),
+    }
+
+
+def arg_parse() -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Benchmark of embedder")
+    parser.add_argument(
+        "--root",
+        dest="root",
+        help="Lyrics root directory",
+        default="lyrics/",
+        type=str,
+    )
+    parser.add_argument(
+        "--meta",
+        dest="meta",
+        help="Documents metadata file",
+        default="docs.meta",
+        type=str,
+    )
+    parser.add_argument(
+        "--store",
+        dest="store",
+        help="Packed documents file",
+        default="docs.store",
+        type=str,
+    )
+    parser.add_argument(
+        "--n",
+        dest="n_docs",
+        help="Number of documents in sample",
+        default=1000,
+        type=int,
+    )
+    parser.add_argument(
+        "--backends",
+        dest="backends",
+        help="Backends to compare with full precision model",
+        nargs="+",
+        choices=BACKENDS,
+        default=[b for b in BACKENDS if b != "torch"],
+    )
+    parser.add_argument(
+        "--threads",
+        dest="threads",
+        help="Number of CPU threads of the model, default if 0",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--onnx",
+        dest="onnx_file",
+        help="File of exported ONNX model",
+        default="distilbert.onnx",
+        type=str,
+    )
+    parser.add_argument(
+        "--bs",
+        dest="batch_size",
+        help="Batch size, in texts of maximal length",
+        default=16,
+        type=int,
+    )
+    parser.add_argument(
+        "--k",
+        dest="k",
+        help="Number of nearest neighbours to compare",
+        default=10,
+        type=int,
+    )
+    parser.add_argument(
+        "--out",
+        dest="out",
+        help="JSON file of results",
+        default=None,
+        type=str,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = arg_parse()
+    meta = DocMeta(args.meta)
+    store = open_doc_store(args.store, args.root, meta)
+    rng = np.random.default_rng(0)
+    n_docs = min(args.n_docs, len(store))
+    sample = np.sort(rng.choice(len(store), n_docs, replace=False))
+    texts = [
+        get_text_reduced(store.text(int(d)), maxlen=512) for d in sample
+    ]
+    store.close()
+    token_budget = args.batch_size * MAX_TOKENS
+
+    results = {}
+    baseline = None
+    for backend in ["torch"] + [b for b in args.backends if b != "torch"]:
+        embedder = Embedder(backend, args.threads, args.onnx_file)
+        result = run_backend(embedder, texts, token_budget)
+        embeddings = result.pop("embeddings")
+        if baseline is None:
+            baseline = embeddings
+        result.update(agreement(embeddings, baseline, args.k))
+        results[backend] = result
+        print(
+            "{:<12} {:8.1f} texts/s {:10.0f} tokens/s  cos mean {:.5f} "
+            "min {:.5f}  {}-NN overlap {:.3f}".format(
+                backend,
+                result["texts_per_sec"],
+                result["tokens_per_sec"],
+                result["cos_mean"],
+                result["cos_min"],
+                args.k,
+                result["knn_overlap"],
+            )
+        )
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,411 @@
+"""This module implements the resumable job that embeds the whole corpus.
+
+Three stages of the job overlap:
+    reading: A thread reads documents from store and reduces their texts.
+    tokenization: Chunks of texts are tokenized by worker processes.
+    inference: The model embeds tokenized chunks, see
+        `Embedder.embed_tokens_batched`, while next chunks are read and
+        tokenized.
+Embeddings are written right away into the output numpy file, which is
+memory-mapped, so the whole (N, 768) array is never held in memory.
+
+Progress is kept in a checkpoint next to the output, a bitmap of docIDs
+whose embeddings are written (rows are flushed before the checkpoint).
+If the job is interrupted, it is resumed from the checkpoint on the next
+run. In incremental mode an existing output without a checkpoint is
+reused: its nonzero rows are taken as done, and it is extended if corpus
+has more documents, so only missing docIDs are embedded. Output made by
+an older Embedder (see `embedder.EMBEDDINGS_VERSION`) is not reused, it
+is embedded anew. The checkpoint is removed when all documents are
+embedded.
+"""
+import argparse
+import numpy as np
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from doc_meta import DocMeta
+from doc_store import Store, open_doc_store
+from embedder import BACKENDS, MAX_TOKENS, Embedder, get_text_reduced
+from embedder import EMBEDDINGS_VERSION, check_embeddings_version
+from embedder import load_tokenizer, read_embeddings_version, tokenize
+from embedder import write_embeddings_version
+from multiprocessing import get_context
+from tqdm import tqdm
+from typing import Iterator, List, Optional, Tuple
+
+# Documents embedded and checkpointed together, they are sorted by length
+CHUNK_SIZE = 1024
+# Chunks read and tokenized ahead of inference
+PREFETCH = 4
+# Embeddings copied at once from an existing output
+COPY_CHUNK = 65536
+
+# Tokenizer of worker process
+_tokenizer = None
+
+
+def checkpoint_path(path: str) -> str:
+    """Get checkpoint filepath of output."""
+    return path + ".ckpt.npy"
+
+
+def load_checkpoint(path: str, n_docs: int) -> Optional[np.ndarray]:
+    """Read checkpoint of output.
+
+    Args:
+        path: Output filepath.
+        n_docs: Number of documents in corpus.
+
+    Returns:
+        Boolean array of docIDs whose embeddings are written, None if there
+        is no checkpoint.
+
+    """
+    try:
+        bits = np.load(checkpoint_path(path))
+    except FileNotFoundError:
+        return None
+    return np.unpackbits(bits, count=n_docs).astype(bool)
+
+
+def save_checkpoint(path: str, done: np.ndarray) -> None:
+    """Replace checkpoint of output atomically.
+
+    Args:
+        path: Output filepath.
+        done: Boolean array of docIDs whose embeddings are written.
+
+    """
+    ckpt = checkpoint_path(path)
+    tmp = ckpt + ".tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, np.packbits(done))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, ckpt)
+
+
+def open_output(
+    path: str, n_docs: int, incremental: bool = False
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Open output memory map, with docIDs whose embeddings are written.
+
+    Args:
+        path: Output filepath.
+        n_docs: Number of documents in corpus.
+        incremental: Reuse existing output, that has no checkpoint and is
+            made by the current Embedder.
+
+    Returns:
+        Writable memory map of (N, 768) float32 array, and boolean array of
+        docIDs whose embeddings are written.
+
+    Raises:
+        ValueError: If output doesn't match documents of corpus or is
+            made by older Embedder.
+
+    """
+    done = load_checkpoint(path, n_docs)
+    if done is not None:
+        check_embeddings_version(path)
+        embeddings = np.lib.format.open_memmap(path, mode="r+")
+        if embeddings.shape != (n_docs, 768):
+            raise ValueError(
+                "{} has shape {}, but corpus has {} documents".format(
+                    path, embeddings.shape, n_docs
+                )
+            )
+        return embeddings, done
+
+    if (
+        incremental
+        and os.path.exists(path)
+        and read_embeddings_version(path) == EMBEDDINGS_VERSION
+    ):
+        old = np.load(path, mmap_mode="r")
+        if old.ndim != 2 or old.shape[1] != 768 or len(old) > n_docs:
+            raise ValueError(
+                "{} has shape {}, but corpus has {} documents".format(
+                    path, old.shape, n_docs
+                )
+            )
+        # Copy into a new file, because output may grow or change dtype
+        tmp = path + ".tmp.npy"
+        embeddings = np.lib.format.open_memmap(
+            tmp, mode="w+", dtype=np.float32, shape=(n_docs, 768)
+        )
+        done = np.zeros(n_docs, dtype=bool)
+        for start in range(0, len(old), COPY_CHUNK):
+            rows = np.asarray(old[start:start + COPY_CHUNK])
+            embeddings[start:start + len(rows)] = rows
+            done[start:start + len(rows)] = np.any(rows != 0, axis=1)
+        embeddings.flush()
+        del old, embeddings
+        os.replace(tmp, path)
+    else:
+        np.lib.format.open_memmap(
+            path, mode="w+", dtype=np.float32, shape=(n_docs, 768)
+        ).flush()
+        done = np.zeros(n_docs, dtype=bool)
+    write_embeddings_version(path)
+    save_checkpoint(path, done)
+    return np.lib.format.open_memmap(path, mode="r+"), done
+
+
+def read_chunks(
+    store: Store, doc_ids: np.ndarray, chunk_size: int
+) -> Iterator[Tuple[np.ndarray, List[str]]]:
+    """Read reduced texts of documents, in chunks.
+
+    Args:
+        store: Documents store, see `doc_store.open_doc_store`.
+        doc_ids: DocIDs of documents to read.
+        chunk_size: Number of documents in a chunk.
+
+    Yields:
+        DocIDs of chunk and their texts.
+
+    """
+    for start in range(0, len(doc_ids), chunk_size):
+        chunk = doc_ids[start:start + chunk_size]
+        texts = [
+            get_text_reduced(store.text(int(d)), maxlen=512) for d in chunk
+        ]
+        yield chunk, texts
+
+
+def prefetch(chunks: Iterator, size: int) -> Iterator:
+    """Run iterator in a background thread, ahead of consumer.
+
+    Args:
+        chunks: Iterator, e.g. `read_chunks`.
+        size: Maximal number of items read ahead.
+
+    Yields:
+        Items of iterator. Exception of iterator is raised in consumer.
+
+    """
+    items = queue.Queue(size)
+    end = object()
+    errors = []
+
+    def produce():
+        try:
+            for item in chunks:
+                items.put(item)
+        except Exception as e:
+            errors.append(e)
+        items.put(end)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    while True:
+        item = items.get()
+        if item is end:
+            break
+        yield item
+    thread.join()
+    if errors:
+        raise errors[0]
+
+
+def _init_tokenizer() -> None:
+    """Load tokenizer in worker process."""
+    global _tokenizer
+    _tokenizer = load_tokenizer()
+
+
+def _tokenize(texts: List[str]) -> List[List[int]]:
+    """Tokenize texts in worker process."""
+    return tokenize(_tokenizer, texts)
+
+
+def tokenizer_pool(workers: int) -> Executor:
+    """Get pool of tokenization workers.
+
+    Args:
+        workers: Number of worker processes, a single thread if 0.
+
+    Returns:
+        Executor with tokenizer loaded in every worker.
+
+    """
+    if workers <= 0:
+        return ThreadPoolExecutor(1, initializer=_init_tokenizer)
+    # Workers don't inherit threads of the model, that are not fork-safe
+    return ProcessPoolExecutor(
+        workers, mp_context=get_context("spawn"), initializer=_init_tokenizer
+    )
+
+
+def embed_corpus(
+    store: Store,
+    path: str,
+    batch_size: int = 16,
+    backend: str = "torch",
+    threads: int = 0,
+    workers: int = 2,
+    incremental: bool = False,
+    chunk_size: int = CHUNK_SIZE,
+) -> int:
+    """Embed documents of corpus into numpy file, resuming from checkpoint.
+
+    Args:
+        store: Documents store, see `doc_store.open_doc_store`.
+        path: Output numpy file, rows by docID.
+        batch_size: Batch size, in texts of maximal length.
+        backend: Inference backend of embedder, see `embedder.BACKENDS`.
+        threads: Number of CPU threads of embedder, default if 0.
+        workers: Number of tokenization processes, a thread if 0.
+        incremental: Embed only docIDs missing from existing output.
+        chunk_size: Number of documents embedded and checkpointed together.
+
+    Returns:
+        Number of embedded documents.
+
+    Raises:
+        ValueError: If output doesn't match documents of corpus.
+
+    """
+    n_docs = len(store)
+    embeddings, done = open_output(path, n_docs, incremental)
+    missing = np.flatnonzero(~done)
+    if not len(missing):
+        os.remove(checkpoint_path(path))
+        return 0
+
+    embedder = Embedder(backend, threads)
+    token_budget = batch_size * MAX_TOKENS
+    progress = tqdm(total=len(missing), unit="doc")
+    start = time.perf_counter()
+    tokens = 0
+    pending = deque()  # chunks with futures of their tokens, in order
+
+    def embed_next():
+        nonlocal tokens
+        chunk, future = pending.popleft()
+        tokenized = future.result()
+        embeddings[chunk] = embedder.embed_tokens_batched(
+            tokenized, token_budget
+        )
+        # Rows must be on disk before they are marked as done
+        embeddings.flush()
+        done[chunk] = True
+        save_checkpoint(path, done)
+        tokens += sum(len(x) for x in tokenized)
+        progress.update(len(chunk))
+        elapsed = time.perf_counter() - start
+        progress.set_postfix(tokens_per_sec=int(tokens / elapsed))
+
+    with tokenizer_pool(workers) as pool:
+        chunks = read_chunks(store, missing, chunk_size)
+        for chunk, texts in prefetch(chunks, PREFETCH):
+            pending.append((chunk, pool.submit(_tokenize, texts)))
+            if len(pending) >= PREFETCH:
+                embed_next()
+        while pending:
+            embed_next()
+    progress.close()
+    os.remove(checkpoint_path(path))
+    return len(missing)
+
+
+def arg_parse() -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Embedding of corpus")
+    parser.add_argument(
+        "--root",
+        dest="root",
+        help="Lyrics root directory",
+        default="lyrics/",
+        type=str,
+    )
+    parser.add_argument(
+        "--meta",
+        dest="meta",
+        help="Documents metadata file",
+        default="docs.meta",
+        type=str,
+    )
+    parser.add_argument(
+        "--store",
+        dest="store",
+        help="Packed documents file",
+        default="docs.store",
+        type=str,
+    )
+    parser.add_argument(
+        "--emb",
+        dest="emb_file",
+        help="Numpy file with embeddings for all texts",
+        default="embeddings.npy",
+        type=str,
+    )
+    parser.add_argument(
+        "--incremental",
+        help="Embed only documents missing from existing embeddings file",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        help="Number of tokenization processes, a thread if 0",
+        default=2,
+        type=int,
+    )
+    parser.add_argument(
+        "--chunk",
+        dest="chunk_size",
+        help="Documents embedded and checkpointed together",
+        default=CHUNK_SIZE,
+        type=int,
+    )
+    parser.add_argument(
+        "--backend",
+        dest="backend",
+        help="Inference backend of embedder",
+        choices=BACKENDS,
+        default="torch",
+    )
+    parser.add_argument(
+        "--threads",
+        dest="threads",
+        help="Number of CPU threads of embedder, default if 0",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--bs",
+        dest="batch_size",
+        help="Batch size, in texts of maximal length",
+        default=16,
+        type=int,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = arg_parse()
+    meta = DocMeta(args.meta)
+    store = open_doc_store(args.store, args.root, meta)
+    n = embed_corpus(
+        store,
+        args.emb_file,
+        args.batch_size,
+        args.backend,
+        args.threads,
+        args.workers,
+        args.incremental,
+        args.chunk_size,
+    )
+    store.close()
+    print("{} documents are embedded into {}".format(n, args.emb_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,78 +2,420 @@
 
 This module implements Embedder class, that uses pretrained DistilBERT
 to get text embeddings.
+
+Every batch is padded to its longest text, so texts of very different
+lengths in one batch waste most of the attention cost on padding. Many
+texts are embedded with `Embedder.embed_batched`: texts are sorted by
+number of tokens and cut into batches with a budget of padded tokens, so
+batches of short texts are big and batches of long texts are small.
+
+Model runs on one of inference backends:
+    torch: Full precision PyTorch model, on GPU if it is available.
+    int8: PyTorch model with linear layers dynamically quantized to int8,
+        on CPU.
+    torchscript: PyTorch model traced into TorchScript graph, on CPU.
+    onnx: Model exported to ONNX, run with onnxruntime on CPU. Exported
+        model is saved, so it is exported only once.
+Number of CPU threads of the model is configurable. Quality of backends
+against the full precision model is measured by `embed_benchmark.py`.
 """
 import logging
 import numpy as np
+import os
+import threading
+import time
 import torch
 import transformers as ppb
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple
+
+# Maximal number of tokens of DistilBERT, with special tokens
+MAX_TOKENS = 512
+# Default budget of padded tokens in a batch
+TOKEN_BUDGET = 16 * MAX_TOKENS
+BACKENDS = ("torch", "int8", "torchscript", "onnx")
+# Optional packages of onnx backend, they are not in requirements.txt
+ONNX_PACKAGES = "onnx onnxscript onnxruntime"
+PRETRAINED_WEIGHTS = "distilbert-base-uncased"
+# Version of embeddings files, it changes with pooling of hidden states:
+# in version 1 hidden states of padding were summed too, in version 2 only
+# hidden states of tokens are summed
+EMBEDDINGS_VERSION = 2
+
 
+def get_text_reduced(text: str, maxlen: int = -1) -> str:
+    """Squash text into one line, without empty lines.
 
-def get_text_reduced(filename: str, maxlen: int = -1) -> str:
-    with open(filename, "r") as f:
-        lines = [line.rstrip() for line in f]
-        text = " ".join(x for x in lines if x != "")
-        if maxlen > 0:
-            text = " ".join(text.split()[:maxlen])
+    Args:
+        text: Document text, e.g. from `doc_store.DocStore.text`.
+        maxlen: Maximal number of words to keep, all if not positive.
+
+    Returns:
+        Reduced text.
+
+    """
+    lines = [line.rstrip() for line in text.split("\n")]
+    text = " ".join(x for x in lines if x != "")
+    if maxlen > 0:
+        text = " ".join(text.split()[:maxlen])
     return text
 
 
+def version_path(path: str) -> str:
+    """Get filepath of version marker of embeddings file."""
+    return path + ".version"
+
+
+def read_embeddings_version(path: str) -> int:
+    """Get version of embeddings file, 1 if it has no version marker."""
+    try:
+        with open(version_path(path), "r") as f:
+            return int(f.read())
+    except FileNotFoundError:
+        return 1
+
+
+def write_embeddings_version(path: str) -> None:
+    """Mark embeddings file with the current EMBEDDINGS_VERSION."""
+    with open(version_path(path), "w") as f:
+        f.write(str(EMBEDDINGS_VERSION))
+
+
+def check_embeddings_version(path: str) -> None:
+    """Check that embeddings file is made by the current Embedder.
+
+    Args:
+        path: Numpy file with embeddings of all texts.
+
+    Raises:
+        ValueError: If embeddings have another version, they must be
+            regenerated with `embed_job.py`.
+
+    """
+    version = read_embeddings_version(path)
+    if version != EMBEDDINGS_VERSION:
+        raise ValueError(
+            "{} has embeddings of version {}, but version {} is expected, "
+            "regenerate it with embed_job.py".format(
+                path, version, EMBEDDINGS_VERSION
+            )
+        )
+
+
+def load_tokenizer() -> Any:
+    """Load pretrained DistilBERT tokenizer."""
+    logging.getLogger("transformers.tokenization_utils").setLevel(
+        logging.ERROR
+    )
+    return ppb.DistilBertTokenizer.from_pretrained(PRETRAINED_WEIGHTS)
+
+
+def tokenize(tokenizer: Any, texts: List[str]) -> List[List[int]]:
+    """Tokenize texts, truncated to MAX_TOKENS with special tokens.
+
+    Args:
+        tokenizer: Pretrained DistilBERT tokenizer.
+        texts: List of texts, striped of '\n' and squashed into one string.
+
+    Returns:
+        Token ids of every text.
+
+    """
+    tokenized = []
+    for x in texts:
+        ids = tokenizer.encode(x, add_special_tokens=True)
+        if len(ids) > MAX_TOKENS:
+            # Keep the closing [SEP] token
+            ids = ids[:MAX_TOKENS - 1] + ids[-1:]
+        tokenized.append(ids)
+    return tokenized
+
+
+class HiddenStates(torch.nn.Module):
+    """Model wrapper that returns only hidden states of tokens.
+
+    Output of the wrapper is a tensor, whatever type of output of the
+    model is in the installed version of transformers, so it can be traced
+    and exported.
+
+    Attributes:
+        model: Pretrained DistilBERT model.
+
+    """
+
+    def __init__(self, model: torch.nn.Module) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(
+        self, input_ids: torch.Tensor, attention_mask: torch.Tensor
+    ) -> torch.Tensor:
+        return self.model(input_ids, attention_mask)[0]
+
+
 class Embedder:
     """Class that is used to get dense text embeddings.
 
     Attributes:
+        backend: Inference backend, one of BACKENDS.
         device: Specifies, should pytorch use cpu or gpu.
         tokenizer: Pretrained DistilBERT tokenizer.
-        model: Pretrained DistilBERT model.
+        model: Pretrained DistilBERT model wrapped into `HiddenStates`,
+            quantized or traced, or onnxruntime session, depending on
+            backend.
+        texts: Number of embedded texts.
+        tokens: Number of tokens of embedded texts.
+        padded_tokens: Number of tokens fed to the model, with padding.
+        seconds: Time spent in tokenization and the model.
+        lock: Lock of statistics, embedder may be shared between threads.
 
     """
 
-    def __init__(self):
-        """Initialize Embedder by loading models and weights."""
-        logging.getLogger("transformers.tokenization_utils").setLevel(
-            logging.ERROR
-        )
+    def __init__(
+        self,
+        backend: str = "torch",
+        threads: int = 0,
+        onnx_path: str = "distilbert.onnx",
+    ) -> None:
+        """Initialize Embedder by loading models and weights.
 
-        model_class = ppb.DistilBertModel
-        tokenizer_class = ppb.DistilBertTokenizer
-        pretrained_weights = "distilbert-base-uncased"
+        Args:
+            backend: Inference backend, one of BACKENDS.
+            threads: Number of CPU threads of the model, default of the
+                framework if not positive.
+            onnx_path: File of exported ONNX model, it is exported if there
+                is no such file.
 
-        self.device = torch.device(
-            "cuda" if torch.cuda.is_available() else "cpu"
-        )
-        self.tokenizer = tokenizer_class.from_pretrained(pretrained_weights)
-        self.model = model_class.from_pretrained(pretrained_weights).to(
-            self.device
+        Raises:
+            ValueError: If backend is unknown.
+
+        """
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend {}".format(backend))
+
+        self.backend = backend
+        if threads > 0:
+            torch.set_num_threads(threads)
+        cuda = backend == "torch" and torch.cuda.is_available()
+        self.device = torch.device("cuda" if cuda else "cpu")
+        self.tokenizer = load_tokenizer()
+        model = ppb.DistilBertModel.from_pretrained(PRETRAINED_WEIGHTS)
+        model = HiddenStates(model).to(self.device)
+        model.eval()
+        if backend == "int8":
+            model = torch.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        elif backend == "torchscript":
+            with torch.no_grad():
+                model = torch.jit.trace(model, self._example())
+        elif backend == "onnx":
+            model = self._onnx_session(model, onnx_path, threads)
+        self.model = model
+        self.texts = self.tokens = self.padded_tokens = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def tokenize(self, texts: List[str]) -> List[List[int]]:
+        """Tokenize texts with the tokenizer of embedder, see `tokenize`."""
+        return tokenize(self.tokenizer, texts)
+
+    @staticmethod
+    def _example() -> Tuple[torch.Tensor, torch.Tensor]:
+        """Get example inputs of the model for tracing and export."""
+        input_ids = torch.ones((2, 8), dtype=torch.long)
+        return input_ids, torch.ones_like(input_ids)
+
+    def _onnx_session(self, model: Any, path: str, threads: int) -> Any:
+        """Export model to ONNX if needed, and open onnxruntime session.
+
+        Args:
+            model: Pretrained DistilBERT model wrapped into `HiddenStates`.
+            path: File of exported ONNX model.
+            threads: Number of intra-op threads, default if not positive.
+
+        Returns:
+            Onnxruntime inference session on CPU.
+
+        Raises:
+            ImportError: If optional packages of the backend are missing.
+
+        """
+        try:
+            # Imported here, because it is needed only for this backend
+            import onnxruntime
+
+            if not os.path.exists(path):
+                self._onnx_export(model, path)
+        except ImportError as e:
+            raise ImportError(
+                "onnx backend needs optional packages, install them with "
+                "'pip install {}': {}".format(ONNX_PACKAGES, e)
+            ) from e
+        options = onnxruntime.SessionOptions()
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        return onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
         )
 
-    def embed(self, texts: List[str]) -> np.ndarray:
-        """Get dense embeddings for a collection of texts.
+    def _onnx_export(self, model: Any, path: str) -> None:
+        """Export model to ONNX file, with dynamic batch and length."""
+        axes = {0: "batch", 1: "sequence"}
+        with torch.no_grad():
+            torch.onnx.export(
+                model,
+                self._example(),
+                path,
+                input_names=["input_ids", "attention_mask"],
+                output_names=["last_hidden_state"],
+                dynamic_axes={
+                    "input_ids": axes,
+                    "attention_mask": axes,
+                    "last_hidden_state": axes,
+                },
+            )
+
+    def _infer(self, padded: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        """Run the model on a padded batch.
 
         Args:
-            texts: List of texts, striped of '\n' and squashed into one string.
+            padded: Token ids, padded with zeros, (N, L).
+            mask: Attention mask of tokens, (N, L).
 
         Returns:
-            Numpy array of shape (N, 768) with text embeddings.
+            Numpy array of (N, L, 768) of hidden states of tokens.
 
         """
-        # Tokenize
-        tokenized = [
-            self.tokenizer.encode(x, add_special_tokens=True) for x in texts
-        ]
+        if self.backend == "onnx":
+            inputs = {
+                "input_ids": padded.astype(np.int64),
+                "attention_mask": mask.astype(np.int64),
+            }
+            return self.model.run(None, inputs)[0]
+        input_ids = torch.tensor(padded).to(self.device)
+        attention_mask = torch.tensor(mask).to(self.device)
+        with torch.no_grad():
+            return self.model(input_ids, attention_mask).cpu().numpy()
+
+    def embed_tokens(self, tokenized: List[List[int]]) -> np.ndarray:
+        """Get dense embeddings for a batch of tokenized texts.
 
+        Embedding is the sum of hidden states of tokens, padding is
+        excluded, so it doesn't depend on other texts of the batch.
+
+        Args:
+            tokenized: Token ids of every text, see `tokenize`.
+
+        Returns:
+            Numpy array of shape (N, 768) with text embeddings.
+
+        """
         # Pad to make everything the same length
         max_len = max(len(x) for x in tokenized)
         padded = np.array([x + [0] * (max_len - len(x)) for x in tokenized])
         mask = np.where(padded != 0, 1, 0)  # mask out padding
 
         # Feed to BERT
-        input_ids = torch.tensor(padded).to(self.device)
-        mask = torch.tensor(mask).to(self.device)
-        with torch.no_grad():
-            last_hidden_states = self.model(input_ids, attention_mask=mask)
+        hidden = self._infer(padded, mask)
+
+        # Sum hidden states of tokens, see EMBEDDINGS_VERSION
+        mask = mask[:, :, None].astype(hidden.dtype)
+        embedding = np.sum(hidden * mask, axis=1)
+        self._count(tokenized, padded.size)
+        return embedding
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Get dense embeddings for a collection of texts, in one batch.
 
-        # Get embedding
-        # TODO it's emb. of [CLS] token, try different
-        embedding = np.sum(last_hidden_states[0].cpu().numpy(), axis=1)
+        Args:
+            texts: List of texts, striped of '\n' and squashed into one string.
+
+        Returns:
+            Numpy array of shape (N, 768) with text embeddings.
+
+        """
+        start = time.perf_counter()
+        embedding = self.embed_tokens(self.tokenize(texts))
+        self._time(start)
         return embedding
+
+    def embed_batched(
+        self, texts: List[str], token_budget: int = TOKEN_BUDGET
+    ) -> np.ndarray:
+        """Get dense embeddings for any number of texts, in batches.
+
+        Texts are sorted by number of tokens, and consecutive texts are
+        put into a batch while the batch padded to its longest text fits
+        into the budget of tokens. A text longer than the budget makes a
+        batch of its own.
+
+        Args:
+            texts: List of texts, striped of '\n' and squashed into one string.
+            token_budget: Maximal number of padded tokens in a batch.
+
+        Returns:
+            Numpy array of shape (N, 768) with text embeddings, in order of
+            texts.
+
+        """
+        start = time.perf_counter()
+        tokenized = self.tokenize(texts)
+        self._time(start)
+        return self.embed_tokens_batched(tokenized, token_budget)
+
+    def embed_tokens_batched(
+        self, tokenized: List[List[int]], token_budget: int = TOKEN_BUDGET
+    ) -> np.ndarray:
+        """Get dense embeddings for any number of tokenized texts, in batches.
+
+        Args:
+            tokenized: Token ids of every text, see `tokenize`.
+            token_budget: Maximal number of padded tokens in a batch.
+
+        Returns:
+            Numpy array of shape (N, 768) with text embeddings, in order of
+            texts, see `embed_batched`.
+
+        """
+        start = time.perf_counter()
+        embeddings = np.zeros((len(tokenized), 768), dtype=np.float32)
+        order = sorted(range(len(tokenized)), key=lambda i: len(tokenized[i]))
+        batch_start = 0
+        for i in range(1, len(order) + 1):
+            # Batch is padded to the length of its last text
+            if i < len(order):
+                size = (i + 1 - batch_start) * len(tokenized[order[i]])
+                if size <= token_budget:
+                    continue
+            batch = order[batch_start:i]
+            embeddings[batch] = self.embed_tokens(
+                [tokenized[j] for j in batch]
+            )
+            batch_start = i
+        self._time(start)
+        return embeddings
+
+    def _count(self, tokenized: List[List[int]], padded_tokens: int) -> None:
+        """Add embedded batch to statistics."""
+        with self.lock:
+            self.texts += len(tokenized)
+            self.tokens += sum(len(x) for x in tokenized)
+            self.padded_tokens += padded_tokens
+
+    def _time(self, start: float) -> None:
+        """Add time since start to statistics."""
+        with self.lock:
+            self.seconds += time.perf_counter() - start
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        """Get statistics of embedded texts and throughput."""
+        with self.lock:
+            return {
+                "texts": self.texts,
+                "tokens": self.tokens,
+                "padded_tokens": self.padded_tokens,
+                "seconds": self.seconds,
+                "tokens_per_sec": (
+                    self.tokens / self.seconds if self.seconds else None
+                ),
+            }
@@ -0,0 +1,395 @@
+"""This module implements on-disk storage of the inverted index.
+
+Read-only index consists of two files:
+    <name>.dict: Sorted term dictionary. Header (magic, number of terms),
+        then postings offsets (uint64, one extra for the end of the last
+        posting list), terms offsets (uint32, one extra), document
+        frequencies (uint32) and finally all terms in UTF-8, concatenated.
+    <name>.post: Encoded posting lists, concatenated in the order of terms.
+
+Both files are opened with `mmap`, so a lookup is a binary search over the
+dictionary plus a zero-copy slice of postings file, and several processes
+share the same pages of OS page cache.
+
+Index merged in parallel is split by term ranges into several such
+segments, tied together by the directory `<name>.segs`, JSON list of
+segments names and their first terms.
+
+Index of one name is kept in one format only: writer of every format
+removes files of the other formats, so that stale index is never opened
+instead of the new one (see `open_index`).
+"""
+import glob
+import json
+import mmap
+import os
+import re
+import shelve
+import struct
+from array import array
+from bisect import bisect_right
+from itertools import chain
+from typing import Iterator, List, Optional, Union
+
+DICT_MAGIC = b"TDIC"
+HEADER = struct.Struct("<4sI")
+# Suffixes of shelve database files, they depend on dbm module in use
+SHELVE_SUFFIXES = ("", ".db", ".dat", ".dir", ".bak")
+SEGMENT_FILE = re.compile(r"\.seg\d+\.(dict|post)$")
+
+
+def _remove(paths: List[str]) -> None:
+    """Remove files, that exist."""
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def _shelve_files(path: str) -> List[str]:
+    """Get possible files of shelve index."""
+    return [path + suffix for suffix in SHELVE_SUFFIXES]
+
+
+def _segment_files(path: str) -> List[str]:
+    """Get existing files of segments of index."""
+    return [
+        f
+        for f in glob.glob(glob.escape(path) + ".seg*")
+        if SEGMENT_FILE.match(f[len(path):])
+    ]
+
+
+class IndexWriter:
+    """Class that writes read-only index, term by term.
+
+    Terms must be added in sorted order.
+
+    Attributes:
+        path: Index name, files `path.dict` and `path.post` are written.
+        post_offsets: Offset of every posting list in postings file.
+        term_offsets: Offset of every term in terms blob.
+        dfs: Document frequency of every term.
+        terms: Concatenated terms.
+
+    """
+
+    def __init__(self, path: str) -> None:
+        """Initialize IndexWriter and open postings file.
+
+        Args:
+            path: Index name.
+
+        """
+        self.path = path
+        self.post_offsets = array("Q", [0])
+        self.term_offsets = array("I", [0])
+        self.dfs = array("I")
+        self.terms = bytearray()
+        self.last_term = None
+        self.postings = open(path + ".post", "wb")
+
+    def add(self, term: str, data: bytes, df: int) -> None:
+        """Append posting list of a term.
+
+        Args:
+            term: Term, greater than every previously added term.
+            data: Encoded posting list.
+            df: Document frequency of the term.
+
+        """
+        if self.last_term is not None and term <= self.last_term:
+            raise ValueError("Terms must be added in sorted order")
+        self.last_term = term
+        self.postings.write(data)
+        self.post_offsets.append(self.post_offsets[-1] + len(data))
+        self.terms.extend(term.encode("utf-8"))
+        self.term_offsets.append(len(self.terms))
+        self.dfs.append(df)
+
+    def close(self) -> None:
+        """Close postings file and write term dictionary."""
+        self.postings.close()
+        with open(self.path + ".dict", "wb") as f:
+            f.write(HEADER.pack(DICT_MAGIC, len(self.dfs)))
+            self.post_offsets.tofile(f)
+            self.term_offsets.tofile(f)
+            self.dfs.tofile(f)
+            f.write(self.terms)
+        # Previously built index of other format would shadow us
+        _remove([self.path + ".segs"] + _segment_files(self.path))
+        _remove(_shelve_files(self.path))
+
+
+def write_segments(
+    path: str, segments: List[str], first_terms: List[Optional[str]]
+) -> None:
+    """Write directory of index segments.
+
+    Empty segments are removed, as well as a previously built index with
+    the same name that is not segmented, or has segments not listed in
+    the directory.
+
+    Args:
+        path: Index name.
+        segments: Names of segments, sorted by their terms ranges.
+        first_terms: First term of every segment, None if it is empty.
+
+    """
+    directory = []
+    for segment, first_term in zip(segments, first_terms):
+        if first_term is None:
+            os.remove(segment + ".dict")
+            os.remove(segment + ".post")
+        else:
+            directory.append([os.path.basename(segment), first_term])
+    with open(path + ".segs", "w") as f:
+        json.dump(directory, f)
+    listed = {
+        os.path.join(os.path.dirname(path), name) + ext
+        for name, _ in directory
+        for ext in (".dict", ".post")
+    }
+    _remove([f for f in _segment_files(path) if f not in listed])
+    _remove([path + ".dict", path + ".post"] + _shelve_files(path))
+
+
+class ShelveIndexWriter:
+    """Class that writes index into `shelve` database, term by term.
+
+    Attributes:
+        path: Index name.
+        index: Shelve file descriptor.
+
+    """
+
+    def __init__(self, path: str) -> None:
+        """Initialize ShelveIndexWriter by creating new shelve database.
+
+        Args:
+            path: Index name.
+
+        """
+        self.path = path
+        self.index = shelve.open(path, flag="n")
+
+    def add(self, term: str, data: bytes, df: int) -> None:
+        """Save posting list of a term.
+
+        Args:
+            term: Term.
+            data: Encoded posting list.
+            df: Document frequency of the term, it is not stored.
+
+        """
+        self.index[term] = data
+
+    def close(self) -> None:
+        """Close shelve database and remove index of other format."""
+        self.index.close()
+        _remove([self.path + ".dict", self.path + ".post"])
+        _remove([self.path + ".segs"] + _segment_files(self.path))
+
+
+def _map_file(path: str) -> Union[mmap.mmap, bytes]:
+    """Memory map file for reading, empty file can't be mapped."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class MmapIndex:
+    """Read-only memory-mapped index.
+
+    Supports the subset of `shelve` interface used for querying: lookup
+    of posting list by term, `in` and `keys()`.
+
+    Attributes:
+        dict_map: Memory-mapped term dictionary.
+        post_map: Memory-mapped postings file.
+        post_offsets: Postings offsets of terms.
+        term_offsets: Offsets of terms in terms blob.
+        dfs: Document frequencies of terms.
+        terms: Concatenated terms.
+        postings: Concatenated posting lists.
+
+    """
+
+    def __init__(self, path: str) -> None:
+        """Initialize MmapIndex by mapping index files.
+
+        Args:
+            path: Index name.
+
+        """
+        self.dict_map = _map_file(path + ".dict")
+        self.post_map = _map_file(path + ".post")
+        magic, n_terms = HEADER.unpack_from(self.dict_map)
+        if magic != DICT_MAGIC:
+            raise ValueError("{}.dict is not a term dictionary".format(path))
+
+        view = memoryview(self.dict_map)
+        start = HEADER.size
+        end = start + 8 * (n_terms + 1)
+        self.post_offsets = view[start:end].cast("Q")
+        start, end = end, end + 4 * (n_terms + 1)
+        self.term_offsets = view[start:end].cast("I")
+        start, end = end, end + 4 * n_terms
+        self.dfs = view[start:end].cast("I")
+        self.terms = view[end:]
+        self.postings = memoryview(self.post_map)
+
+    def __len__(self) -> int:
+        return len(self.dfs)
+
+    def find(self, term: str) -> int:
+        """Binary search term in dictionary.
+
+        Args:
+            term: Term.
+
+        Returns:
+            Position of the term in dictionary, -1 if it is not found.
+
+        """
+        key = term.encode("utf-8")
+        terms, offsets = self.terms, self.term_offsets
+        lo, hi = 0, len(self.dfs)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if bytes(terms[offsets[mid]:offsets[mid + 1]]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.dfs) and terms[offsets[lo]:offsets[lo + 1]] == key:
+            return lo
+        return -1
+
+    def __getitem__(self, term: str) -> memoryview:
+        """Get encoded posting list of a term without copying.
+
+        Args:
+            term: Term.
+
+        Returns:
+            Slice of postings file.
+
+        Raises:
+            KeyError: If term is not in index.
+
+        """
+        i = self.find(term)
+        if i < 0:
+            raise KeyError(term)
+        return self.postings[self.post_offsets[i]:self.post_offsets[i + 1]]
+
+    def __contains__(self, term: str) -> bool:
+        return self.find(term) >= 0
+
+    def df(self, term: str) -> int:
+        """Get document frequency of a term, 0 if it is not in index."""
+        i = self.find(term)
+        return self.dfs[i] if i >= 0 else 0
+
+    def keys(self) -> Iterator[str]:
+        """Iterate over terms in sorted order."""
+        offsets = self.term_offsets
+        for i in range(len(self.dfs)):
+            yield bytes(self.terms[offsets[i]:offsets[i + 1]]).decode("utf-8")
+
+    def close(self) -> None:
+        """Release memory maps."""
+        for view in (
+            self.post_offsets,
+            self.term_offsets,
+            self.dfs,
+            self.terms,
+            self.postings,
+        ):
+            view.release()
+        for m in (self.dict_map, self.post_map):
+            if isinstance(m, mmap.mmap):
+                m.close()
+
+
+class SegmentedIndex:
+    """Read-only index, split by term ranges into memory-mapped segments.
+
+    Attributes:
+        first_terms: First term of every segment, sorted.
+        segments: Memory-mapped segments.
+
+    """
+
+    def __init__(self, path: str) -> None:
+        """Initialize SegmentedIndex by mapping all segments.
+
+        Args:
+            path: Index name.
+
+        """
+        with open(path + ".segs", "r") as f:
+            directory = json.load(f)
+        root = os.path.dirname(path)
+        self.first_terms = [first_term for _, first_term in directory]
+        self.segments = [
+            MmapIndex(os.path.join(root, name)) for name, _ in directory
+        ]
+
+    def __len__(self) -> int:
+        return sum(len(segment) for segment in self.segments)
+
+    def segment(self, term: str) -> Optional[MmapIndex]:
+        """Get segment, whose terms range contains the term."""
+        i = bisect_right(self.first_terms, term) - 1
+        return self.segments[i] if i >= 0 else None
+
+    def __getitem__(self, term: str) -> memoryview:
+        """Get encoded posting list of a term without copying.
+
+        Raises:
+            KeyError: If term is not in index.
+
+        """
+        segment = self.segment(term)
+        if segment is None:
+            raise KeyError(term)
+        return segment[term]
+
+    def __contains__(self, term: str) -> bool:
+        segment = self.segment(term)
+        return segment is not None and term in segment
+
+    def df(self, term: str) -> int:
+        """Get document frequency of a term, 0 if it is not in index."""
+        segment = self.segment(term)
+        return segment.df(term) if segment is not None else 0
+
+    def keys(self) -> Iterator[str]:
+        """Iterate over terms in sorted order."""
+        return chain.from_iterable(s.keys() for s in self.segments)
+
+    def close(self) -> None:
+        """Release memory maps of all segments."""
+        for segment in self.segments:
+            segment.close()
+
+
+def open_index(
+    path: str,
+) -> Union[SegmentedIndex, MmapIndex, shelve.Shelf]:
+    """Open index for reading.
+
+    Args:
+        path: Index name.
+
+    Returns:
+        Segmented or single memory-mapped index if its files exist,
+        otherwise shelve database.
+
+    """
+    if os.path.exists(path + ".segs"):
+        return SegmentedIndex(path)
+    if os.path.exists(path + ".dict"):
+        return MmapIndex(path)
+    return shelve.open(path)
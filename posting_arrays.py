@@ -0,0 +1,342 @@
+"""This module implements posting lists as parallel NumPy arrays.
+
+Posting list is a sorted array of docIDs and an array of tf-idf scores of
+the same length. Boolean operations are vectorized and give the same
+results as operations on lists of (docID, score) tuples from
+`merge_operations`: documents are located in the other posting list with
+binary search over its docIDs, so intersection and difference with a much
+longer list cost about O(short * log(long)).
+
+Complement of a posting list (NOT x) is not materialized: it is stored as
+a compressed bitmap of excluded documents, so it takes memory proportional
+to the posting list of x, not to the corpus. Operators switch between
+sorted arrays and bitmaps depending on types of their arguments.
+"""
+import numpy as np
+from bitmaps import RoaringBitmap
+from compression import PostingCursor
+from typing import List, Tuple, Union
+
+Posting = Tuple[int, float]
+
+# Intersect with a stored posting list by skipping through it with a
+# cursor, if it is that many times longer
+SKIP_RATIO = 8
+
+
+class PostingArrays:
+    """Posting list of a term or of a query.
+
+    Attributes:
+        doc_ids: DocIDs, sorted in ascending order, int64.
+        scores: Tf-idf scores of corresponding documents, float64.
+
+    """
+
+    __slots__ = ("doc_ids", "scores")
+
+    def __init__(self, doc_ids: np.ndarray, scores: np.ndarray) -> None:
+        """Initialize PostingArrays.
+
+        Args:
+            doc_ids: Sorted array of docIDs.
+            scores: Array of scores of the same length.
+
+        """
+        self.doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        self.scores = np.asarray(scores, dtype=np.float64)
+
+    @classmethod
+    def empty(cls) -> "PostingArrays":
+        """Get empty posting list."""
+        return cls(np.empty(0, np.int64), np.empty(0, np.float64))
+
+    @classmethod
+    def from_list(cls, posting: List[Posting]) -> "PostingArrays":
+        """Convert list of (docID, score), sorted by docID."""
+        if not posting:
+            return cls.empty()
+        doc_ids, scores = zip(*posting)
+        return cls(doc_ids, scores)
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory taken by arrays."""
+        return self.doc_ids.nbytes + self.scores.nbytes
+
+    def to_list(self) -> List[Posting]:
+        """Convert to list of (docID, score), sorted by docID."""
+        return list(zip(self.doc_ids.tolist(), self.scores.tolist()))
+
+    def top(self, count: int) -> List[Posting]:
+        """Get best postings, as `heapq.nlargest` by score would.
+
+        Args:
+            count: How many postings to get.
+
+        Returns:
+            List of (docID, score), sorted by score in descending order
+            and by docID among equal scores.
+
+        """
+        order = np.lexsort((self.doc_ids, -self.scores))[:count]
+        return list(
+            zip(self.doc_ids[order].tolist(), self.scores[order].tolist())
+        )
+
+
+class ComplementPostings:
+    """Posting list of all documents of corpus, except excluded ones.
+
+    Attributes:
+        excluded: Documents that are not in posting list.
+        boost: Postings with scores, disjoint with excluded documents, other
+            documents have zero scores.
+        n_docs: Number of documents in corpus.
+
+    """
+
+    __slots__ = ("excluded", "boost", "n_docs")
+
+    def __init__(
+        self, excluded: RoaringBitmap, boost: PostingArrays, n_docs: int
+    ) -> None:
+        """Initialize ComplementPostings.
+
+        Args:
+            excluded: Documents that are not in posting list.
+            boost: Postings with scores, disjoint with excluded documents.
+            n_docs: Number of documents in corpus.
+
+        """
+        self.excluded = excluded
+        self.boost = boost
+        self.n_docs = n_docs
+
+    def __len__(self) -> int:
+        return self.n_docs - len(self.excluded)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory taken by bitmap and boosted postings."""
+        return self.excluded.nbytes + self.boost.nbytes
+
+    def to_arrays(self) -> PostingArrays:
+        """Materialize posting list, it takes memory proportional to corpus."""
+        mask = np.ones(self.n_docs, dtype=bool)
+        mask[self.excluded.to_array()] = False
+        doc_ids = np.flatnonzero(mask)
+        return or_arrays(
+            PostingArrays(doc_ids, np.zeros(len(doc_ids))), self.boost
+        )
+
+    def to_list(self) -> List[Posting]:
+        """Convert to list of (docID, score), sorted by docID."""
+        return self.to_arrays().to_list()
+
+    def top(self, count: int) -> List[Posting]:
+        """Get best postings, as `heapq.nlargest` by score would.
+
+        Documents with zero scores follow boosted ones in order of docIDs,
+        so only first of them are checked against excluded documents.
+
+        Args:
+            count: How many postings to get.
+
+        Returns:
+            List of (docID, score), sorted by score in descending order
+            and by docID among equal scores.
+
+        """
+        positive = self.boost.scores > 0
+        boosted = PostingArrays(
+            self.boost.doc_ids[positive], self.boost.scores[positive]
+        )
+        result = boosted.top(count)
+        need = min(count, len(self)) - len(result)
+        if need <= 0:
+            return result
+        limit = min(self.n_docs, need + len(self.excluded) + len(boosted))
+        doc_ids = np.arange(limit)
+        doc_ids = doc_ids[~self.excluded.contains(doc_ids)]
+        doc_ids = doc_ids[~_locate(doc_ids, boosted.doc_ids)[1]]
+        result.extend((docId, 0.0) for docId in doc_ids[:need].tolist())
+        return result
+
+
+Postings = Union[PostingArrays, ComplementPostings]
+
+
+def _locate(
+    doc_ids: np.ndarray, other_ids: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Binary search docIDs in another sorted array of docIDs.
+
+    Returns:
+        Positions of docIDs in other array, and mask of found ones.
+
+    """
+    pos = np.searchsorted(other_ids, doc_ids)
+    if not len(other_ids):
+        return pos, np.zeros(len(doc_ids), dtype=bool)
+    found = other_ids[np.minimum(pos, len(other_ids) - 1)] == doc_ids
+    return pos, found
+
+
+def _remove(posting: PostingArrays, docs: RoaringBitmap) -> PostingArrays:
+    """Remove documents from posting list."""
+    keep = ~docs.contains(posting.doc_ids)
+    return PostingArrays(posting.doc_ids[keep], posting.scores[keep])
+
+
+def and_arrays(posting1: Postings, posting2: Postings) -> Postings:
+    """Intersection of posting lists. x AND y.
+
+    Args:
+        posting1: Posting list.
+        posting2: Another posting list.
+
+    Returns:
+        Posting list of documents containig both terms.
+
+    """
+    if isinstance(posting1, ComplementPostings):
+        posting1, posting2 = posting2, posting1
+    if isinstance(posting1, ComplementPostings):
+        return ComplementPostings(
+            posting1.excluded.union(posting2.excluded),
+            or_arrays(
+                _remove(posting1.boost, posting2.excluded),
+                _remove(posting2.boost, posting1.excluded),
+            ),
+            posting1.n_docs,
+        )
+    if isinstance(posting2, ComplementPostings):
+        result = _remove(posting1, posting2.excluded)
+        pos, found = _locate(result.doc_ids, posting2.boost.doc_ids)
+        result.scores[found] += posting2.boost.scores[pos[found]]
+        return result
+
+    if len(posting2) < len(posting1):
+        posting1, posting2 = posting2, posting1
+    pos, found = _locate(posting1.doc_ids, posting2.doc_ids)
+    return PostingArrays(
+        posting1.doc_ids[found],
+        posting1.scores[found] + posting2.scores[pos[found]],
+    )
+
+
+def or_arrays(posting1: Postings, posting2: Postings) -> Postings:
+    """Union of posting lists. x OR y.
+
+    Args:
+        posting1: Posting list.
+        posting2: Another posting list.
+
+    Returns:
+        Posting list of documents containig either terms.
+
+    """
+    if isinstance(posting1, ComplementPostings):
+        posting1, posting2 = posting2, posting1
+    if isinstance(posting1, ComplementPostings):
+        return ComplementPostings(
+            posting1.excluded.intersection(posting2.excluded),
+            or_arrays(posting1.boost, posting2.boost),
+            posting1.n_docs,
+        )
+    if isinstance(posting2, ComplementPostings):
+        return ComplementPostings(
+            posting2.excluded.difference(
+                RoaringBitmap.from_array(posting1.doc_ids)
+            ),
+            or_arrays(posting1, posting2.boost),
+            posting2.n_docs,
+        )
+
+    doc_ids = np.union1d(posting1.doc_ids, posting2.doc_ids)
+    scores = np.zeros(len(doc_ids))
+    scores[np.searchsorted(doc_ids, posting1.doc_ids)] += posting1.scores
+    scores[np.searchsorted(doc_ids, posting2.doc_ids)] += posting2.scores
+    return PostingArrays(doc_ids, scores)
+
+
+def not_arrays(posting: Postings, max_docId: int) -> Postings:
+    """Complement of posting list. NOT x.
+
+    Args:
+        posting: Posting list.
+        max_docId: Last docID.
+
+    Returns:
+        Posting list of documents not containig term, with zero scores.
+
+    """
+    if isinstance(posting, ComplementPostings):
+        doc_ids = posting.excluded.to_array()
+        return PostingArrays(doc_ids, np.zeros(len(doc_ids)))
+    return ComplementPostings(
+        RoaringBitmap.from_array(posting.doc_ids),
+        PostingArrays.empty(),
+        max_docId,
+    )
+
+
+def not_and_arrays(not_posting: Postings, posting: Postings) -> Postings:
+    """Optimized NOT x AND y.
+
+    Args:
+        not_posting: Posting list of term after NOT.
+        posting: Another posting list.
+
+    Returns:
+        Posting list of documents containig term y and not x.
+
+    """
+    if isinstance(not_posting, ComplementPostings):
+        return and_arrays(not_arrays(not_posting, not_posting.n_docs), posting)
+    if isinstance(posting, ComplementPostings):
+        excluded = posting.excluded.union(
+            RoaringBitmap.from_array(not_posting.doc_ids)
+        )
+        return ComplementPostings(
+            excluded, _remove(posting.boost, excluded), posting.n_docs
+        )
+
+    if len(not_posting) < len(posting):
+        pos, found = _locate(not_posting.doc_ids, posting.doc_ids)
+        keep = np.ones(len(posting), dtype=bool)
+        keep[pos[found]] = False
+    else:
+        _, found = _locate(posting.doc_ids, not_posting.doc_ids)
+        keep = ~found
+    return PostingArrays(posting.doc_ids[keep], posting.scores[keep])
+
+
+def and_cursor_arrays(
+    posting: PostingArrays, cursor: PostingCursor
+) -> PostingArrays:
+    """Intersection of posting list with a stored one. x AND y.
+
+    Stored posting list is not decoded: cursor skips whole blocks of it
+    with their last docIDs.
+
+    Args:
+        posting: Posting list, SKIP_RATIO times shorter than the stored
+            one or more.
+        cursor: Cursor over stored posting list with weights.
+
+    Returns:
+        Posting list of documents containig both terms.
+
+    """
+    doc_ids, scores = [], []
+    postings = zip(posting.doc_ids.tolist(), posting.scores.tolist())
+    for docId, score in postings:
+        if cursor.advance(docId) == docId:
+            doc_ids.append(docId)
+            scores.append(score + cursor.score())
+    return PostingArrays(doc_ids, scores)
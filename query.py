@@ -1,15 +1,32 @@
 """This module implements index querying.
 """
 import argparse
-import os
+import numpy as np
 import re
-import shelve
+from bisect import bisect_left
+from cache import LRUCache
+from compression import PostingCursor
+from compression import decode_df, decode_postings, decode_weights
+from compression import decode_positions, has_positions, has_weights
+from daat import ArrayCursor, build_cursor, daat_top_k
+from doc_meta import DocMeta
+from doc_store import open_doc_store
 from gensim.parsing.porter import PorterStemmer
+from index_store import open_index
 from math import log2
-from merge_operations import or_postings, and_postings, not_postings
-from typing import List, Dict, Tuple
+from operator import attrgetter
+from posting_arrays import SKIP_RATIO, Postings, PostingArrays
+from posting_arrays import and_cursor_arrays
+from posting_arrays import or_arrays, and_arrays, not_arrays
+from posting_arrays import not_and_arrays
+from query_planner import POSITIONAL, Node, explain, is_term, normalize
+from query_planner import parse, plan, tokenize
+from top_k import wand_top_k
+from typing import Any, Dict, List, Optional, Tuple
 
 Posting = Tuple[int, float]
+# Word at the start of text snippet
+WORD = re.compile(r"\w*")
 
 
 class Indexer:
@@ -17,129 +34,595 @@ class Indexer:
 
     Attributes:
         root: Directory where songs lyrics is.
-        docs: List of documents filenames, that is used to get docID.
-        word_count: Length of each document.
+        docs: Documents metadata, list-like of filenames indexed by docID.
+        store: Documents texts, packed store or directory of files.
+        word_count: Length of each document, numpy array.
         stemmer: Gensim porter stemmer.
-        index: Index file descriptor.
+        index: Index file descriptor, memory-mapped index or shelve.
+        posting_cache: Decoded posting lists with tf-idf scores by term.
+        result_cache: Hits of boolean queries by their canonical form.
 
     """
 
     def __init__(
-        self, docs: List[str], index_path: str, root: str = "lyrics/"
+        self,
+        index_path: str,
+        root: str = "lyrics/",
+        meta_path: str = "docs.meta",
+        store_path: str = "docs.store",
+        posting_cache_size: int = 64 * 2 ** 20,
+        result_cache_size: int = 16 * 2 ** 20,
     ) -> None:
         """Initialize Indexer by assigning attributes and opening index file.
 
         Args:
-            docs: List of documents filenames.
             index_path: Path to index file.
             root: Directory where songs lyrics is.
+            meta_path: Documents metadata file, written with the index.
+            store_path: Packed documents, written with the index. If there
+                is no such file, documents are read from root.
+            posting_cache_size: Budget of posting lists cache in bytes.
+            result_cache_size: Budget of query results cache in bytes.
 
         """
         self.root = root
-        self.docs = docs
+        self.docs = DocMeta(meta_path)
+        self.store = open_doc_store(store_path, root, self.docs)
+        self.word_count = np.frombuffer(self.docs.lengths, dtype=np.uint32)
         self.stemmer = PorterStemmer()
-        self.get_word_count()
-        self.index = shelve.open(index_path)
+        self.index = open_index(index_path)
+        nbytes = attrgetter("nbytes")
+        self.posting_cache = LRUCache(posting_cache_size, nbytes)
+        self.result_cache = LRUCache(result_cache_size, nbytes)
 
-    def get_word_count(self) -> None:
-        """Get length of each document."""
-        self.word_count = []
-        for _, doc in enumerate(self.docs):
-            with open(self.root + doc, "r") as f:
-                self.word_count.append(sum(len(line.split()) for line in f))
-
-    def tfidf(self, posting: Dict[int, int]) -> List[Posting]:
+    def tfidf(self, doc_ids: List[int], tfs: List[int]) -> PostingArrays:
         """Calculate tf-idf for documents in posting list.
 
         Args:
-            posting: Posting list with term frequences of some term.
+            doc_ids: DocIDs of posting list, sorted in ascending order.
+            tfs: Term frequences in corresponding documents.
 
         Returns:
-            List of (docID, tf-idf score), sorted by docID.
+            Posting list with tf-idf scores.
 
         """
-        return [
-            (k, v / self.word_count[k] * log2(len(self.docs) / len(posting)))
-            for k, v in sorted(posting.items())
-        ]
+        idf = log2(len(self.docs) / len(doc_ids))
+        doc_ids = np.array(doc_ids, dtype=np.int64)
+        scores = np.array(tfs) / self.word_count[doc_ids] * idf
+        return PostingArrays(doc_ids, scores)
 
-    def query_boolean(self, tokens: List[str]) -> List[Posting]:
-        """Recursively parse boolean query in DNF.
+    def get_posting(self, token: str) -> PostingArrays:
+        """Read posting list of a token from index with tf-idf scores.
+
+        Precomputed tf-idf weights are used if index stores them, otherwise
+        they are calculated.
 
         Args:
-            tokens: List of tokens.
+            token: Query token, it is stemmed before lookup.
 
         Returns:
-            List of (docID, tf-idf score) of query hits.
+            Posting list with tf-idf scores, empty if term is not in index.
 
         """
+        term = self.stemmer.stem(token)
+        posting = self.posting_cache.get(term)
+        if posting is not None:
+            return posting
         try:
-            split_idx = tokens.index("OR")
-            return or_postings(
-                self.query_boolean(tokens[:split_idx]),
-                self.query_boolean(tokens[split_idx + 1:]),
-            )
-        except ValueError:
-            pass
+            data = self.index[term]
+        except KeyError:
+            posting = PostingArrays.empty()
+        else:
+            if has_weights(data):
+                posting = PostingArrays(*decode_weights(data))
+            else:
+                posting = self.tfidf(*decode_postings(data))
+        self.posting_cache.put(term, posting)
+        return posting
+
+    def df(self, token: str) -> int:
+        """Get document frequency of a query token.
+
+        Args:
+            token: Query token, it is stemmed before lookup.
+
+        Returns:
+            Document frequency, 0 if term is not in index.
+
+        """
+        term = self.stemmer.stem(token)
+        if hasattr(self.index, "df"):
+            return self.index.df(term)
         try:
-            split_idx = tokens.index("AND")
-            return and_postings(
-                self.query_boolean(tokens[:split_idx]),
-                self.query_boolean(tokens[split_idx + 1:]),
-            )
-        except ValueError:
-            pass
+            return decode_df(self.index[term])
+        except KeyError:
+            return 0
+
+    def get_cursor(self, token: str) -> Optional[PostingCursor]:
+        """Get cursor over stored posting list of a token.
+
+        Args:
+            token: Query token, it is stemmed before lookup.
+
+        Returns:
+            Cursor, None if term is not in index or its posting list has
+            no weights.
+
+        """
         try:
-            split_idx = tokens.index("NOT")
-            return not_postings(
-                self.query_boolean(tokens[split_idx + 1:]), len(self.docs)
+            data = self.index[self.stemmer.stem(token)]
+        except KeyError:
+            return None
+        return PostingCursor(data) if has_weights(data) else None
+
+    def plan(self, tokens: List[str]) -> Node:
+        """Parse boolean query and make its plan.
+
+        Args:
+            tokens: List of tokens, see `query_planner.tokenize`.
+
+        Returns:
+            Root of query plan.
+
+        Raises:
+            ValueError: If query is malformed.
+
+        """
+        return plan(parse(tokens), self.df, len(self.docs))
+
+    def evaluate(self, node: Node) -> Postings:
+        """Evaluate query plan.
+
+        Operands of AND are intersected from the smallest one. A term,
+        whose posting list is much longer than the result so far and is
+        not cached, is not decoded: cursor skips its blocks, that can't
+        contain any of hits.
+
+        Args:
+            node: Root of query plan.
+
+        Returns:
+            Posting list of query hits.
+
+        """
+        if node.op == "TERM":
+            return self.get_posting(node.token)
+        if node.op in POSITIONAL:
+            return self.evaluate_positional(node)
+        if node.op == "NOT":
+            return not_arrays(self.evaluate(node.children[0]), len(self.docs))
+        if node.op == "OR":
+            result = self.evaluate(node.children[0])
+            for child in node.children[1:]:
+                result = or_arrays(result, self.evaluate(child))
+            return result
+
+        result = self.evaluate(node.children[0])
+        for child in node.children[1:]:
+            if not len(result):
+                return PostingArrays.empty()
+            cursor = None
+            if (
+                child.op == "TERM"
+                and isinstance(result, PostingArrays)
+                and len(result) * SKIP_RATIO < child.size
+                and self.stemmer.stem(child.token) not in self.posting_cache
+            ):
+                cursor = self.get_cursor(child.token)
+            if cursor is not None:
+                result = and_cursor_arrays(result, cursor)
+            else:
+                result = and_arrays(result, self.evaluate(child))
+        for child in node.excluded:
+            if not len(result):
+                break
+            result = not_and_arrays(self.evaluate(child), result)
+        return result
+
+    def term_positions(
+        self, token: str, doc_ids: np.ndarray
+    ) -> List[List[int]]:
+        """Get positions of a query token in documents.
+
+        Args:
+            token: Query token, it is stemmed before lookup.
+            doc_ids: DocIDs of documents, that contain the term, sorted.
+
+        Returns:
+            Positions of the term in every document.
+
+        Raises:
+            ValueError: If index doesn't store positions.
+
+        """
+        term = self.stemmer.stem(token)
+        data = self.index[term]
+        if not has_positions(data):
+            raise ValueError(
+                "Index has no positions, build it with --positions"
+            )
+        if term in self.posting_cache or not has_weights(data):
+            posting = self.get_posting(token)
+            indexes = np.searchsorted(posting.doc_ids, doc_ids).tolist()
+        else:
+            # Cursor skips blocks by the block table and decodes only
+            # blocks of the documents
+            cursor = PostingCursor(data)
+            indexes = []
+            for docId in doc_ids.tolist():
+                cursor.advance(docId)
+                indexes.append(cursor.index())
+        positions, _ = decode_positions(data, indexes)
+        return positions
+
+    def match_positions(
+        self, node: Node, doc_ids: np.ndarray
+    ) -> Tuple[np.ndarray, List[List[int]]]:
+        """Find occurrences of a term or phrase in documents.
+
+        Terms of phrase are checked from the rarest one: its positions give
+        candidate starts of phrase, and positions of every next term are
+        decoded only in documents, where some candidates are left.
+
+        Args:
+            node: Planned TERM or PHRASE node.
+            doc_ids: DocIDs of documents, that contain all the terms.
+
+        Returns:
+            Indexes of documents in doc_ids, where node occurs, and start
+            positions of its occurrences in them.
+
+        Raises:
+            ValueError: If index doesn't store positions.
+
+        """
+        terms = node.children if node.op == "PHRASE" else [node]
+        alive = np.arange(len(doc_ids))
+        starts = None
+        for i in sorted(range(len(terms)), key=lambda i: terms[i].size):
+            positions = self.term_positions(terms[i].token, doc_ids[alive])
+            if starts is None:
+                starts = [[p - i for p in ps] for ps in positions]
+            else:
+                starts = [
+                    [s for s in doc_starts if s + i in ps]
+                    for doc_starts, ps in zip(starts, map(set, positions))
+                ]
+            keep = [j for j, doc_starts in enumerate(starts) if doc_starts]
+            alive = alive[keep]
+            starts = [starts[j] for j in keep]
+            if not keep:
+                break
+        return alive, starts
+
+    def evaluate_positional(self, node: Node) -> PostingArrays:
+        """Evaluate phrase or NEAR.
+
+        Documents, that contain all the terms, are found with posting lists
+        first, then positions of the terms are checked in them.
+
+        Args:
+            node: Planned PHRASE or NEAR node.
+
+        Returns:
+            Posting list of hits, scores are sums of tf-idf of the terms.
+
+        Raises:
+            ValueError: If index doesn't store positions.
+
+        """
+        operands = node.children if node.op == "NEAR" else [node]
+        terms = {}
+        for operand in operands:
+            leaves = operand.children if operand.op == "PHRASE" else [operand]
+            for term in leaves:
+                terms[self.stemmer.stem(term.token)] = term
+        children = sorted(terms.values(), key=attrgetter("size"))
+        candidates = self.evaluate(Node("AND", children=children))
+        if not len(candidates):
+            return PostingArrays.empty()
+        doc_ids = candidates.doc_ids
+        alive, starts = self.match_positions(operands[0], doc_ids)
+        if node.op == "NEAR":
+            right = operands[1]
+            right_alive, right_starts = self.match_positions(
+                right, doc_ids[alive]
             )
-        except ValueError:
-            pass
-        term = self.stemmer.stem(tokens[0])
+            left_length = len(operands[0].children) or 1
+            right_length = len(right.children) or 1
+            keep = [
+                j
+                for j, other_starts in zip(right_alive, right_starts)
+                if spans_near(
+                    starts[j],
+                    left_length,
+                    other_starts,
+                    right_length,
+                    node.distance,
+                )
+            ]
+            alive = alive[keep]
+        return PostingArrays(doc_ids[alive], candidates.scores[alive])
+
+    def term_cursor(self, token: str):
+        """Get cursor over posting list of a token, for DAAT evaluation.
+
+        Args:
+            token: Query token, it is stemmed before lookup.
+
+        Returns:
+            Cursor over stored posting list, or over decoded one if it has
+            no weights or term is not in index.
+
+        """
+        cursor = None
+        if self.stemmer.stem(token) not in self.posting_cache:
+            cursor = self.get_cursor(token)
+        if cursor is None:
+            cursor = ArrayCursor(self.get_posting(token))
+        return cursor
+
+    def query_daat(self, tokens: List[str], k: int) -> List[Posting]:
+        """Find k best hits of boolean query document-at-a-time.
+
+        Intermediate results are not materialized: every operator of query
+        plan is a cursor, and hits stream from the root one by one.
+
+        Args:
+            tokens: List of tokens, see `query_planner.tokenize`.
+            k: How many hits to find.
+
+        Returns:
+            List of k best (docID, tf-idf score), sorted by score.
+
+        Raises:
+            ValueError: If query is malformed.
+
+        """
+        cursor = build_cursor(
+            self.plan(tokens),
+            self.term_cursor,
+            len(self.docs),
+            lambda node: ArrayCursor(self.evaluate_positional(node)),
+        )
+        return daat_top_k(cursor, k)
+
+    def query_boolean(self, tokens: List[str]) -> Postings:
+        """Parse, plan and evaluate boolean query.
+
+        Hits are cached by canonical form of query, so equivalent queries
+        share them.
+
+        Args:
+            tokens: List of tokens, see `query_planner.tokenize`.
+
+        Returns:
+            Posting list of query hits.
+
+        Raises:
+            ValueError: If query is malformed.
+
+        """
+        tree = parse(tokens)
+        key = normalize(tree, self.stemmer.stem)
+        hits = self.result_cache.get(key)
+        if hits is None:
+            hits = self.evaluate(plan(tree, self.df, len(self.docs)))
+            self.result_cache.put(key, hits)
+        return hits
+
+    def cache_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Get statistics of posting lists cache and query results cache."""
+        return {
+            "postings": self.posting_cache.stats(),
+            "results": self.result_cache.stats(),
+        }
+
+    def query_top_k(
+        self, tokens: List[str], k: int
+    ) -> Optional[List[Posting]]:
+        """Find k best hits of disjunctive query with block-max WAND.
+
+        Args:
+            tokens: List of tokens, terms joined with OR.
+            k: How many hits to find.
+
+        Returns:
+            List of k best (docID, tf-idf score), sorted by score. None if
+            query is not a disjunction of terms, or index has no weights.
+
+        Raises:
+            ValueError: If query is malformed.
+
+        """
+        node = parse(tokens)
+        terms = node.children if node.op == "OR" else [node]
+        if any(term.op != "TERM" for term in terms):
+            return None
+        cursors = []
+        for term in terms:
+            try:
+                data = self.index[self.stemmer.stem(term.token)]
+            except KeyError:
+                continue
+            if not has_weights(data):
+                return None
+            cursors.append(PostingCursor(data))
+        return wand_top_k(cursors, k)
+
+    def search(
+        self, query: str, count: int = 10, mode: str = "boolean"
+    ) -> Tuple[List[Posting], Optional[int]]:
+        """Find best hits of boolean query.
+
+        Args:
+            query: Query string.
+            count: How many hits to find, none if not positive.
+            mode: How to evaluate query: "boolean" evaluates all hits,
+                "top_k" finds best hits of disjunctive query with block-max
+                WAND (other queries are evaluated as "boolean"), "daat"
+                finds best hits document-at-a-time.
+
+        Returns:
+            List of best (docID, tf-idf score), sorted by score, and total
+            number of hits, None if it is not known.
+
+        Raises:
+            ValueError: If query is malformed or mode is unknown.
+
+        """
+        tokens = tokenize(query)
+        # Negative count would slice hits from the end
+        count = max(count, 0)
+        if mode == "top_k":
+            hits = self.query_top_k(tokens, count)
+            if hits is not None:
+                return hits, None
+        elif mode == "daat":
+            return self.query_daat(tokens, count), None
+        elif mode != "boolean":
+            raise ValueError("Unknown mode {}".format(mode))
+        hits = self.query_boolean(tokens)
+        return hits.top(count), len(hits)
+
+    def term_offsets(
+        self, token: str, doc_ids: List[int]
+    ) -> Optional[List[List[int]]]:
+        """Get byte offsets of a query token in documents.
+
+        Documents are looked up in docID order with a single cursor, so
+        blocks of posting list are decoded at most once for all of them.
+
+        Args:
+            token: Query token, it is stemmed before lookup.
+            doc_ids: DocIDs, in any order.
+
+        Returns:
+            Byte offsets of the term in every document file, empty if
+            document doesn't contain it. None if term is not in index or
+            its posting list has no positions.
+
+        """
         try:
-            posting = self.tfidf(self.index[term])
+            data = self.index[self.stemmer.stem(token)]
         except KeyError:
-            return []
-        return posting
+            return None
+        if not has_positions(data):
+            return None
+        indexes = {}  # by docID, ascending
+        if has_weights(data):
+            cursor = PostingCursor(data)
+            for docId in sorted(set(doc_ids)):
+                if cursor.advance(docId) == docId:
+                    indexes[docId] = cursor.index()
+        else:
+            posting = self.get_posting(token).doc_ids
+            for docId in sorted(set(doc_ids)):
+                i = int(np.searchsorted(posting, docId))
+                if i < len(posting) and posting[i] == docId:
+                    indexes[docId] = i
+        _, offsets = decode_positions(data, list(indexes.values()))
+        found = dict(zip(indexes, offsets))
+        return [found.get(docId, []) for docId in doc_ids]
+
+    def page_offsets(
+        self, tokens: List[str], doc_ids: List[int]
+    ) -> List[List[Optional[List[int]]]]:
+        """Get byte offsets of query tokens in a page of hits.
+
+        Args:
+            tokens: List of query tokens.
+            doc_ids: DocIDs of hits.
+
+        Returns:
+            Offsets of every token in every document, by document, see
+            `term_offsets`.
+
+        """
+        by_token = [self.term_offsets(token, doc_ids) for token in tokens]
+        return [
+            [None if o is None else o[j] for o in by_token]
+            for j in range(len(doc_ids))
+        ]
 
     def render_file(
-        self, tokens: List[str], filename: str, offset: int = 20
+        self,
+        tokens: List[str],
+        docId: int,
+        offset: int = 20,
+        offsets: Optional[List[Optional[List[int]]]] = None,
     ) -> None:
         """Print song name and text snippet.
 
+        If index stores byte offsets of terms, snippets are read right at
+        the first occurrence of every term, otherwise song text is searched
+        for the terms.
+
         Args:
             tokens: List of query tokens.
-            filename: Song filename.
+            docId: DocID of song.
             offset: How much to extend text snippet in symbols.
+            offsets: Byte offsets of every token in song, see
+                `term_offsets`. They are looked up if not given.
 
         """
+        filename = self.docs[docId]
         # Print band and song name
         print("\033[4m{}\033[0m:".format(pretty_doc(filename)))
+        if offsets is None:
+            offsets = self.page_offsets(tokens, [docId])[0]
+        if any(o is not None for o in offsets):
+            data = self.store[docId]
+            for term_offsets in offsets:
+                if not term_offsets:
+                    print("-")
+                    continue
+                start = term_offsets[0]
+                # Symbol takes at most 4 bytes in UTF-8
+                window = max(0, start - 4 * offset)
+                before = data[window:start].decode("utf-8", "ignore")
+                before = before.replace("\r\n", "\n")
+                end = data.find(b"\n", start)
+                line = data[start:end if end >= 0 else len(data)]
+                line = line.decode("utf-8", "ignore").rstrip("\r")
+                end = WORD.match(line).end()
+                if window > 0 or len(before) > offset:
+                    print("...", end="")
+                print(
+                    "{}\033[1m{}\033[0m{}".format(
+                        before[max(0, len(before) - offset):],
+                        line[:end],
+                        line[end:],
+                    )
+                )
+            return
         # Try to find term in song text
-        with open(self.root + filename) as f:
-            text = "".join(f.readlines())
-            lowered_text = text.lower()
-            for token in tokens:
-                try:
-                    w = self.stemmer.stem(token)
-                    w_match = re.search(r"\b{}\w*\b".format(w), lowered_text)
-                    l_match = re.search(r"\b{}.*?\n".format(w), lowered_text)
-                    if w_match.start() > offset:
-                        print("...", end="")
-                    start = max(0, w_match.start() - offset)
-                    print(
-                        "{}\033[1m{}\033[0m{}".format(
-                            text[start:w_match.start()],
-                            text[w_match.start():w_match.end()],
-                            text[w_match.end():l_match.end() - 1],
-                        )
+        text = self.store.text(docId)
+        lowered_text = text.lower()
+        for token in tokens:
+            try:
+                w = self.stemmer.stem(token)
+                w_match = re.search(r"\b{}\w*\b".format(w), lowered_text)
+                l_match = re.search(r"\b{}.*?\n".format(w), lowered_text)
+                if w_match.start() > offset:
+                    print("...", end="")
+                start = max(0, w_match.start() - offset)
+                print(
+                    "{}\033[1m{}\033[0m{}".format(
+                        text[start:w_match.start()],
+                        text[w_match.start():w_match.end()],
+                        text[w_match.end():l_match.end() - 1],
                     )
-                except AttributeError:
-                    print("-")
+                )
+            except AttributeError:
+                print("-")
 
     def render(
-        self, tokens: List[str], hits: List[Posting], count: int
+        self,
+        tokens: List[str],
+        hits: List[Posting],
+        count: int,
+        total: Optional[int] = None,
     ) -> None:
         """Print the results of query.
 
@@ -147,34 +630,96 @@ class Indexer:
             tokens: List of query tokens.
             hits: Query results as a list of (docID, tf-idf score).
             count: How many hits to print.
+            total: Total number of hits, if it is known.
 
         """
         if not hits:
             print("Nothing found")
             return
-        tokens = [t for t in tokens if t not in ["AND", "OR", "NOT"]]
-        print("{} hits found.\n".format(len(hits)))
-        for docId, v in hits[:count]:
+        tokens = [t for t in tokens if is_term(t)]
+        if total is None:
+            print("Top {} hits.\n".format(len(hits[:count])))
+        else:
+            print("{} hits found.\n".format(total))
+        hits = hits[:count]
+        page = self.page_offsets(tokens, [docId for docId, _ in hits])
+        for (docId, v), offsets in zip(hits, page):
             print("[relevance = {:.3f}]".format(v))
-            self.render_file(tokens, self.docs[docId])
+            self.render_file(tokens, docId, offsets=offsets)
             print()
 
-    def query(self, query: str, count: int = 10) -> None:
+    def query(
+        self,
+        query: str,
+        count: int = 10,
+        top_k: bool = False,
+        show_plan: bool = False,
+        daat: bool = False,
+    ) -> None:
         """Query index and print results, sorted by tf-idf.
 
         Args:
             query: Query string.
             count: How many hits to print.
+            top_k: Find only `count` best hits of disjunctive query with
+                block-max WAND, without evaluating the whole union.
+            show_plan: Print query plan with estimated costs.
+            daat: Find only `count` best hits, evaluating query
+                document-at-a-time with bounded memory.
 
         """
-        tokens = query.split()
-        hits = self.query_boolean(tokens)
-        hits = sorted(hits, key=lambda item: item[1], reverse=True)
-        self.render(tokens, hits, count)
+        tokens = tokenize(query)
+        mode = "top_k" if top_k else "daat" if daat else "boolean"
+        try:
+            if show_plan:
+                print(explain(self.plan(tokens)), end="\n\n")
+            hits, total = self.search(query, count, mode)
+        except ValueError as e:
+            print("Invalid query: {}".format(e))
+            return
+        self.render(tokens, hits, count, total)
 
     def close(self) -> None:
-        """Close index file."""
+        """Close index file and documents store."""
         self.index.close()
+        self.store.close()
+
+
+def spans_near(
+    starts: List[int],
+    length: int,
+    other_starts: List[int],
+    other_length: int,
+    distance: int,
+) -> bool:
+    """Check if occurrences of two terms or phrases are near each other.
+
+    Occurrences are near, if they don't overlap and there are at most
+    distance words between them, in any order. So distance 0 means
+    adjacent occurrences, and an occurrence is never near itself.
+
+    Args:
+        starts: Start positions of occurrences of the first one, sorted.
+        length: Number of terms of the first one.
+        other_starts: Start positions of occurrences of the second one,
+            sorted.
+        other_length: Number of terms of the second one.
+        distance: Maximal number of words between occurrences.
+
+    Returns:
+        True if some occurrences are near each other.
+
+    """
+    for start in starts:
+        # Other one before, then after the occurrence
+        for low, high in (
+            (start - other_length - distance, start - other_length),
+            (start + length, start + length + distance),
+        ):
+            i = bisect_left(other_starts, low)
+            if i < len(other_starts) and other_starts[i] <= high:
+                return True
+    return False
 
 
 def pretty_doc(filename: str) -> str:
@@ -205,6 +750,20 @@ def arg_parse() -> argparse.Namespace:
     parser.add_argument(
         "--index", dest="index", help="Index", default="index", type=str
     )
+    parser.add_argument(
+        "--meta",
+        dest="meta",
+        help="Documents metadata file",
+        default="docs.meta",
+        type=str,
+    )
+    parser.add_argument(
+        "--store",
+        dest="store",
+        help="Packed documents file",
+        default="docs.store",
+        type=str,
+    )
     parser.add_argument(
         "--q", dest="query", help="Query", default="", type=str
     )
@@ -215,19 +774,29 @@ def arg_parse() -> argparse.Namespace:
         default=10,
         type=int,
     )
+    parser.add_argument(
+        "--top_k",
+        help="Find only best hits of OR query with block-max WAND",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--explain",
+        help="Print query plan with estimated costs",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--daat",
+        help="Find only best hits, evaluating query document-at-a-time",
+        action="store_true",
+    )
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = arg_parse()
-    docs = [
-        dir + "/" + f
-        for dir in os.listdir(args.root)
-        for f in os.listdir(args.root + dir)
-    ]
-    docs = sorted(docs)
-
-    index = Indexer(docs, args.index, args.root)
-    index.query(args.query, args.count)
+    index = Indexer(args.index, args.root, args.meta, args.store)
+    index.query(
+        args.query, args.count, args.top_k, args.explain, args.daat
+    )
 
     index.close()
@@ -2,17 +2,28 @@
 
 The key idea is to use boolean search to get some L0 candidates, then
 find embeddings of top-N of those candidates and rerank them according
-to cosine distance to query embedding.
+to cosine distance to query embedding. Embeddings of candidates are taken
+from precomputed embeddings of the whole corpus (see `embed_job.py`), if
+they are available, so only the query goes through the model.
+
+Boolean L0 misses documents without exact lexical matches, so in hybrid
+mode L0 candidates are also found with approximate nearest neighbours
+search over embeddings of corpus (see `dense_index.py`), and both lists
+are fused with reciprocal rank fusion.
 """
 import argparse
 import numpy as np
-import os
 import re
-from embedder import Embedder, get_text_reduced
-from merge_operations import not_and_postings
+from dense_index import RRF_K, DenseIndex, load_dense_index
+from dense_index import reciprocal_rank_fusion
+from embedder import BACKENDS, MAX_TOKENS, Embedder, get_text_reduced
+from embedder import check_embeddings_version
+from posting_arrays import not_and_arrays
 from query import Indexer
-from scipy.spatial.distance import cosine
-from typing import List, Tuple
+from query_planner import tokenize
+from typing import Any, Dict, List, Optional, Tuple
+
+Posting = Tuple[int, float]
 
 
 def query_expand(query: str) -> Tuple[str, str]:
@@ -25,7 +36,8 @@ def query_expand(query: str) -> Tuple[str, str]:
         Substrings of tokens that should be in results and that shouldn't.
 
     """
-    m = re.search(r" NOT", query)
+    # AND before NOT joins negation to the rest of query
+    m = re.search(r"(?:\s+AND)?\s+NOT\b", query)
     if m:
         q_pos = query[: m.start()]
         q_neg = query[m.end():].strip("()")
@@ -50,31 +62,302 @@ def query_reduce(query: str) -> str:
     return query
 
 
-def batch_embed(
-    embedder: Embedder, texts: List[str], batch_size: int
+def load_embeddings(path: str, n_docs: int) -> Optional[np.ndarray]:
+    """Memory-map precomputed embeddings of corpus.
+
+    Args:
+        path: Numpy file with embeddings of all texts, rows by docID.
+        n_docs: Number of documents in corpus.
+
+    Returns:
+        Read-only memory-mapped array of (N, 768), None if there is no such
+        file.
+
+    Raises:
+        ValueError: If embeddings don't match documents of corpus or are
+            made by older Embedder.
+
+    """
+    try:
+        embeddings = np.load(path, mmap_mode="r")
+    except FileNotFoundError:
+        return None
+    check_embeddings_version(path)
+    if embeddings.ndim != 2 or len(embeddings) != n_docs:
+        raise ValueError(
+            "{} has {} embeddings, but corpus has {} documents".format(
+                path, len(embeddings), n_docs
+            )
+        )
+    return embeddings
+
+
+def cosine_similarity(
+    embeddings: np.ndarray, query_emb: np.ndarray
 ) -> np.ndarray:
-    """Get embeddings in batches if GPU memory is not enough.
+    """Get cosine similarity of embeddings to query embedding.
+
+    Args:
+        embeddings: Numpy array of (N, 768) of texts embeddings.
+        query_emb: Query embedding.
+
+    Returns:
+        Numpy array of N cosine similarities, 0 for zero embeddings.
+
+    """
+    query_emb = query_emb / (np.linalg.norm(query_emb) or 1.0)
+    norms = np.linalg.norm(embeddings, axis=1)
+    norms[norms == 0] = 1.0
+    return embeddings @ query_emb / norms
+
+
+def l0_search(index: Indexer, query: str, l0_size: int) -> List[Posting]:
+    """Get L0 candidates with boolean search.
+
+    Args:
+        index: Indexer.
+        query: Query string. Syntax: 'word1 word2 NOT(word3 word4)'.
+        l0_size: How many candidates to get.
+
+    Returns:
+        Best candidates (docID, tf-idf score), sorted by tf-idf.
+
+    Raises:
+        ValueError: If query is malformed.
+
+    """
+    q_pos, q_neg = query_expand(query)
+    # Words without operators between them are joined by AND
+    hits = index.query_boolean(tokenize(q_pos))
+    # Remove all NOT-ed tokens
+    if q_neg:
+        for token in q_neg.split():
+            not_posting = index.get_posting(token)
+            hits = not_and_arrays(not_posting, hits)
+    return hits.top(l0_size)
+
+
+def l1_search(
+    index: Indexer,
+    embedder: Embedder,
+    query: str,
+    hits: List[Posting],
+    l1_size: int,
+    batch_size: int,
+    embeddings: Optional[np.ndarray] = None,
+) -> List[Dict[str, Any]]:
+    """Rerank L0 candidates by cosine similarity of embeddings to query.
 
     Args:
+        index: Indexer.
         embedder: Embedder with DistilBERT model.
-        texts: List of songs' texts.
-        batch_size: Batch size.
+        query: Query string.
+        hits: L0 candidates (docID, tf-idf score), sorted by tf-idf.
+        l1_size: How many best hits to get.
+        batch_size: Batch size of embedder, in texts of maximal length,
+            batches of shorter texts are bigger.
+        embeddings: Precomputed embeddings of corpus, rows by docID. If
+            None, candidates are embedded with the model.
 
     Returns:
-        Numpy array of (N, 768) of texts embeddings.
+        Best hits with their docID, filename, L0 rank, tf-idf score and
+        cosine similarity, sorted by cosine similarity.
 
     """
-    embeddings = np.zeros((len(texts), 768))
+    if not hits:
+        return []
+    q_pos, _ = query_expand(query)
+    doc_ids = [x[0] for x in hits]
+    if embeddings is not None:
+        # Gather rows of candidates, in order of docIDs for the memory map
+        order = np.argsort(doc_ids)
+        candidates = np.empty((len(doc_ids), embeddings.shape[1]))
+        candidates[order] = embeddings[np.asarray(doc_ids)[order]]
+    else:
+        texts = [
+            get_text_reduced(index.store.text(docId), maxlen=512)
+            for docId in doc_ids
+        ]
+        candidates = embedder.embed_batched(texts, batch_size * MAX_TOKENS)
+    query_emb = embedder.embed([q_pos])[0]
+    cos_sim = cosine_similarity(candidates, query_emb)
+    idx_cos = np.argsort(-cos_sim, kind="stable")
+
+    return [
+        {
+            "docId": doc_ids[i],
+            "doc": index.docs[doc_ids[i]],
+            "l0_rank": int(i),
+            "tfidf": hits[i][1],
+            "cos_sim": float(cos_sim[i]),
+        }
+        for i in idx_cos[:l1_size]
+    ]
 
-    iters = len(texts) // batch_size
-    if len(texts) % batch_size > 0:
-        iters += 1
 
-    for i in range(iters):
-        batch = texts[i * batch_size: (i + 1) * batch_size]
-        emb_batch = embedder.embed(batch)
-        embeddings[i * batch_size: (i + 1) * batch_size] = emb_batch
-    return embeddings
+def ml_search(
+    index: Indexer,
+    embedder: Embedder,
+    query: str,
+    l0_size: int = 100,
+    l1_size: int = 20,
+    batch_size: int = 100,
+    embeddings: Optional[np.ndarray] = None,
+) -> List[Dict[str, Any]]:
+    """Search with boolean L0 and reranking of candidates with ML.
+
+    Args:
+        index: Indexer.
+        embedder: Embedder with DistilBERT model.
+        query: Query string. Syntax: 'word1 word2 NOT(word3 word4)'.
+        l0_size: How many hits from L0 are reranked with ML.
+        l1_size: How many best hits to get.
+        batch_size: Batch size of embedder.
+        embeddings: Precomputed embeddings of corpus, see `l1_search`.
+
+    Returns:
+        Best hits, see `l1_search`.
+
+    """
+    hits = l0_search(index, query, l0_size)
+    return l1_search(
+        index, embedder, query, hits, l1_size, batch_size, embeddings
+    )
+
+
+def dense_l0_search(
+    embedder: Embedder,
+    dense: DenseIndex,
+    query: str,
+    l0_size: int,
+    probe: Optional[int] = None,
+) -> List[Posting]:
+    """Get L0 candidates with approximate nearest neighbours search.
+
+    Args:
+        embedder: Embedder with DistilBERT model.
+        dense: Dense index of corpus embeddings.
+        query: Query string. Syntax: 'word1 word2 NOT(word3 word4)'.
+        l0_size: How many candidates to get.
+        probe: Number of inverted lists or graph candidates explored,
+            default of dense index if None.
+
+    Returns:
+        Best candidates (docID, cosine similarity), sorted by similarity.
+        NOT-ed tokens are not checked, see `remove_negated`.
+
+    """
+    q_pos, _ = query_expand(query)
+    query_emb = embedder.embed([q_pos])[0]
+    return dense.search(query_emb, l0_size, probe)
+
+
+def remove_negated(
+    index: Indexer, query: str, hits: List[Posting]
+) -> List[Posting]:
+    """Remove candidates that contain NOT-ed tokens of query.
+
+    Args:
+        index: Indexer.
+        query: Query string. Syntax: 'word1 word2 NOT(word3 word4)'.
+        hits: Candidates (docID, score).
+
+    Returns:
+        Candidates without NOT-ed tokens, in the same order.
+
+    """
+    _, q_neg = query_expand(query)
+    if not q_neg or not hits:
+        return hits
+    doc_ids = np.array([x[0] for x in hits])
+    keep = np.ones(len(hits), dtype=bool)
+    for token in q_neg.split():
+        keep &= ~np.isin(doc_ids, index.get_posting(token).doc_ids)
+    return [hit for hit, kept in zip(hits, keep) if kept]
+
+
+def fuse_hits(
+    index: Indexer,
+    hits: List[Posting],
+    dense_hits: List[Posting],
+    l1_size: int,
+    rrf_k: int = RRF_K,
+) -> List[Dict[str, Any]]:
+    """Fuse boolean and dense L0 candidates with reciprocal rank fusion.
+
+    Args:
+        index: Indexer.
+        hits: Boolean candidates (docID, tf-idf score), sorted by tf-idf.
+        dense_hits: Dense candidates (docID, cosine similarity), sorted by
+            similarity.
+        l1_size: How many best hits to get.
+        rrf_k: Rank constant of reciprocal rank fusion.
+
+    Returns:
+        Best hits with their docID, filename, fused score, boolean L0 rank
+        and tf-idf score, dense rank and cosine similarity (None if hit is
+        not a candidate of that kind), sorted by fused score.
+
+    """
+    lexical = {
+        docId: (rank, score) for rank, (docId, score) in enumerate(hits)
+    }
+    dense = {
+        docId: (rank, sim) for rank, (docId, sim) in enumerate(dense_hits)
+    }
+    fused = reciprocal_rank_fusion(
+        [[x[0] for x in hits], [x[0] for x in dense_hits]], rrf_k
+    )
+    results = []
+    for docId, score in fused[:l1_size]:
+        l0_rank, tfidf = lexical.get(docId, (None, None))
+        dense_rank, cos_sim = dense.get(docId, (None, None))
+        results.append(
+            {
+                "docId": docId,
+                "doc": index.docs[docId],
+                "rrf": score,
+                "l0_rank": l0_rank,
+                "tfidf": tfidf,
+                "dense_rank": dense_rank,
+                "cos_sim": cos_sim,
+            }
+        )
+    return results
+
+
+def hybrid_search(
+    index: Indexer,
+    embedder: Embedder,
+    dense: DenseIndex,
+    query: str,
+    l0_size: int = 100,
+    l1_size: int = 20,
+    probe: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Search with boolean and dense L0, fused with reciprocal rank fusion.
+
+    Recall is traded for latency with the number of candidates l0_size and
+    the effort of dense search probe.
+
+    Args:
+        index: Indexer.
+        embedder: Embedder with DistilBERT model.
+        dense: Dense index of corpus embeddings.
+        query: Query string. Syntax: 'word1 word2 NOT(word3 word4)'.
+        l0_size: How many candidates to get from every L0.
+        l1_size: How many best hits to get.
+        probe: Number of inverted lists or graph candidates explored,
+            default of dense index if None.
+
+    Returns:
+        Best hits, see `fuse_hits`.
+
+    """
+    hits = l0_search(index, query, l0_size)
+    dense_hits = dense_l0_search(embedder, dense, query, l0_size, probe)
+    dense_hits = remove_negated(index, query, dense_hits)
+    return fuse_hits(index, hits, dense_hits, l1_size)
 
 
 def arg_parse() -> argparse.Namespace:
@@ -90,6 +373,48 @@ def arg_parse() -> argparse.Namespace:
     parser.add_argument(
         "--index", dest="index", help="Index file", default="index", type=str
     )
+    parser.add_argument(
+        "--meta",
+        dest="meta",
+        help="Documents metadata file",
+        default="docs.meta",
+        type=str,
+    )
+    parser.add_argument(
+        "--store",
+        dest="store",
+        help="Packed documents file",
+        default="docs.store",
+        type=str,
+    )
+    parser.add_argument(
+        "--emb",
+        dest="emb_file",
+        help="Numpy file with embeddings for all texts, candidates are "
+        "embedded at query time if there is no such file",
+        default="embeddings.npy",
+        type=str,
+    )
+    parser.add_argument(
+        "--ann",
+        dest="ann_file",
+        help="Dense index file of embeddings, see dense_index.py",
+        default="embeddings.faiss",
+        type=str,
+    )
+    parser.add_argument(
+        "--hybrid",
+        help="Fuse boolean L0 with dense L0 instead of reranking",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--probe",
+        dest="probe",
+        help="Inverted lists (IVF) or graph candidates (HNSW) explored by "
+        "dense search, more is slower with better recall",
+        default=None,
+        type=int,
+    )
     parser.add_argument(
         "--q",
         dest="query",
@@ -100,7 +425,7 @@ def arg_parse() -> argparse.Namespace:
     parser.add_argument(
         "--L0",
         dest="l0_size",
-        help="How many hits from L0 are reranked with ML",
+        help="How many hits from L0 are reranked (or fused) with ML",
         default=100,
         type=int,
     )
@@ -111,6 +436,20 @@ def arg_parse() -> argparse.Namespace:
         default=20,
         type=int,
     )
+    parser.add_argument(
+        "--backend",
+        dest="backend",
+        help="Inference backend of embedder",
+        choices=BACKENDS,
+        default="torch",
+    )
+    parser.add_argument(
+        "--threads",
+        dest="threads",
+        help="Number of CPU threads of embedder, default if 0",
+        default=0,
+        type=int,
+    )
     parser.add_argument(
         "--bs",
         dest="batch_size",
@@ -123,61 +462,60 @@ def arg_parse() -> argparse.Namespace:
 
 def main():
     args = arg_parse()
-    docs = [
-        os.path.join(dir, f)
-        for dir in os.listdir(args.root)
-        for f in os.listdir(os.path.join(args.root, dir))
-    ]
-    docs = sorted(docs)
-
-    index = Indexer(docs, args.index, args.root)
-    embedder = Embedder()
+    index = Indexer(args.index, args.root, args.meta, args.store)
+    embedder = Embedder(args.backend, args.threads)
 
-    # L0
-    q_pos, q_neg = query_expand(args.query)
-    # Get all OR-ed tokens
-    q_pos_expand = re.sub(r" ", " AND ", q_pos)
-    hits = index.query_boolean(q_pos_expand.split())
-    # Remove all NOT-ed tokens
-    if q_neg:
-        for token in q_neg.split():
-            term = index.stemmer.stem(token)
-            try:
-                not_posting = index.tfidf(index.index[term])
-            except KeyError:
-                not_posting = []
-            hits = not_and_postings(not_posting, hits)
-
-    if not hits:
+    if args.hybrid:
+        dense = load_dense_index(args.ann_file)
+        if dense is None:
+            print("Dense index not found, build it with dense_index.py")
+            return
+    else:
+        embeddings = load_embeddings(args.emb_file, len(index.docs))
+    try:
+        if args.hybrid:
+            results = hybrid_search(
+                index,
+                embedder,
+                dense,
+                args.query,
+                args.l0_size,
+                args.l1_size,
+                args.probe,
+            )
+        else:
+            results = ml_search(
+                index,
+                embedder,
+                args.query,
+                args.l0_size,
+                args.l1_size,
+                args.batch_size,
+                embeddings,
+            )
+    except ValueError as e:
+        print("Invalid query: {}".format(e))
+        return
+    if not results:
         print("nothing found")
         return
 
-    hits = sorted(hits, key=lambda item: item[1], reverse=True)
-    hits = hits[: args.l0_size]
-
-    # L1
-    doc_ids = [x[0] for x in hits]
-    filenames = [os.path.join(args.root, docs[i]) for i in doc_ids]
-    texts = [get_text_reduced(x, maxlen=512) for x in filenames]
-
-    if args.batch_size >= args.l0_size:
-        embeddings = embedder.embed(texts)
-    else:
-        embeddings = batch_embed(embedder, texts, args.batch_size)
-    query_emb = embedder.embed([q_pos])[0]
-    dist_cos = [cosine(query_emb, e) for e in embeddings]
-    idx_cos = np.argsort(dist_cos)
-
     # Render
-    q_red = query_reduce(args.query)
-    resorted = [doc_ids[i] for i in idx_cos]
-    for i, id in enumerate(resorted[: args.l1_size]):
+    tokens = query_reduce(args.query).split()
+    page = index.page_offsets(tokens, [hit["docId"] for hit in results])
+    for i, (hit, offsets) in enumerate(zip(results, page)):
         print("\n{}:".format(i))
-        index.render_file(q_red.split(), docs[id])
-        orig_pos = idx_cos[i]
+        index.render_file(tokens, hit["docId"], offsets=offsets)
+        if args.hybrid:
+            print(
+                "\tL0 rank = {}; dense rank = {}; rrf = {:.4f}".format(
+                    hit["l0_rank"], hit["dense_rank"], hit["rrf"]
+                )
+            )
+            continue
         print(
             "\tL0 rank = {}; tf-idf = {:.3f}; cos-sim = {:.3f}".format(
-                orig_pos, hits[orig_pos][1], 1 - dist_cos[orig_pos]
+                hit["l0_rank"], hit["tfidf"], hit["cos_sim"]
             )
         )
 
@@ -0,0 +1,362 @@
+"""This module implements parsing and planning of boolean queries.
+
+Query is parsed into an expression tree. Operators are `OR`, `AND`, `NOT`
+and `NEAR/k`, from the lowest precedence to the highest, parentheses group
+subexpressions and quotes group phrases, adjacent operands without an
+operator between them are joined by AND:
+    query := and_query (OR and_query)*
+    and_query := not_query ([AND] not_query)*
+    not_query := NOT not_query | near_query
+    near_query := operand [NEAR/k operand] | "(" query ")"
+    operand := term | '"' term+ '"'
+Phrase matches documents, where its terms occur one right after another,
+and `x NEAR/k y` matches documents, where x and y (terms or phrases) occur
+with at most k other words between them, in any order, so they are
+checked with positional index.
+
+Planner then rewrites the tree into a plan, that is cheaper to evaluate:
+nested AND and OR are flattened into n-ary operators, operands of AND are
+ordered by their estimated number of hits, so the rarest terms shrink the
+result first, and `x AND NOT y` becomes difference of x and y instead of
+intersection with the complement of y.
+"""
+import re
+import string
+from typing import Callable, List, NamedTuple, Optional
+
+OPERATORS = ("AND", "OR", "NOT")
+# Proximity operator with maximal number of words between its operands
+NEAR = re.compile(r"NEAR/(\d+)$")
+# Operators, that are checked with positions of terms
+POSITIONAL = ("PHRASE", "NEAR")
+
+
+class Node(NamedTuple):
+    """Node of query expression tree or of query plan.
+
+    Attributes:
+        op: Operator, "TERM", "AND", "OR", "NOT", "PHRASE" or "NEAR".
+        token: Query token of TERM node.
+        children: Operands.
+        excluded: Operands of AND after NOT, subtracted from the result
+            (only in plan).
+        size: Estimated number of hits (only in plan).
+        cost: Estimated number of postings read from index and gone
+            through by operators (only in plan).
+        distance: Maximal number of words between operands of NEAR.
+
+    """
+
+    op: str
+    token: Optional[str] = None
+    children: List["Node"] = []
+    excluded: List["Node"] = []
+    size: int = 0
+    cost: int = 0
+    distance: int = 0
+
+
+def tokenize(query: str) -> List[str]:
+    """Split query string into tokens.
+
+    Parentheses and quotes are separate tokens.
+
+    Args:
+        query: Query string.
+
+    Returns:
+        List of tokens.
+
+    """
+    for symbol in "()\"":
+        query = query.replace(symbol, " {} ".format(symbol))
+    return query.split()
+
+
+def is_term(token: str) -> bool:
+    """Check if query token is a term, not an operator or a delimiter."""
+    return not (
+        token in OPERATORS or token in ("(", ")", '"') or NEAR.match(token)
+    )
+
+
+class Parser:
+    """Recursive descent parser of boolean queries.
+
+    Attributes:
+        tokens: List of query tokens.
+        pos: Position of the current token.
+
+    """
+
+    def __init__(self, tokens: List[str]) -> None:
+        """Initialize Parser.
+
+        Args:
+            tokens: List of query tokens.
+
+        """
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self) -> Optional[str]:
+        """Get current token, None at the end of query."""
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def parse(self) -> Node:
+        """Parse the whole query.
+
+        Returns:
+            Root of expression tree.
+
+        Raises:
+            ValueError: If query is malformed.
+
+        """
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise ValueError(
+                "Unexpected '{}' at position {}".format(self.peek(), self.pos)
+            )
+        return node
+
+    def parse_or(self) -> Node:
+        """Parse disjunction of conjunctions."""
+        children = [self.parse_and()]
+        while self.peek() == "OR":
+            self.pos += 1
+            children.append(self.parse_and())
+        if len(children) == 1:
+            return children[0]
+        return Node("OR", None, children)
+
+    def parse_and(self) -> Node:
+        """Parse conjunction of negations, terms and subqueries.
+
+        `AND` may be omitted, so conjunction continues until `OR`, `)` or
+        the end of query.
+
+        """
+        children = [self.parse_not()]
+        while self.peek() not in (None, "OR", ")"):
+            if self.peek() == "AND":
+                self.pos += 1
+            children.append(self.parse_not())
+        if len(children) == 1:
+            return children[0]
+        return Node("AND", None, children)
+
+    def parse_not(self) -> Node:
+        """Parse negation, proximity or subquery in parentheses."""
+        if self.peek() == "NOT":
+            self.pos += 1
+            return Node("NOT", None, [self.parse_not()])
+        if self.peek() == "(":
+            self.pos += 1
+            node = self.parse_or()
+            if self.peek() != ")":
+                raise ValueError("Missing ')' at position {}".format(self.pos))
+            self.pos += 1
+            return node
+        node = self.parse_operand()
+        match = NEAR.match(self.peek() or "")
+        if match is None:
+            return node
+        self.pos += 1
+        return Node(
+            "NEAR",
+            children=[node, self.parse_operand()],
+            distance=int(match.group(1)),
+        )
+
+    def parse_operand(self) -> Node:
+        """Parse term or phrase in quotes."""
+        token = self.peek()
+        if token is None:
+            raise ValueError("Unexpected end of query")
+        self.pos += 1
+        if token == '"':
+            return self.parse_phrase()
+        if not is_term(token):
+            raise ValueError(
+                "Unexpected '{}' at position {}".format(token, self.pos - 1)
+            )
+        return Node("TERM", token)
+
+    def parse_phrase(self) -> Node:
+        """Parse phrase after opening quote.
+
+        Punctuation is removed from phrase, the same way as from indexed
+        documents, so positions of its terms are consecutive.
+
+        """
+        table = str.maketrans("", "", string.punctuation)
+        children = []
+        while self.peek() != '"':
+            if self.peek() is None:
+                raise ValueError(
+                    "Missing '\"' at position {}".format(self.pos)
+                )
+            token = self.peek().translate(table)
+            if token:
+                children.append(Node("TERM", token))
+            self.pos += 1
+        self.pos += 1
+        if not children:
+            raise ValueError("Empty phrase at position {}".format(self.pos))
+        if len(children) == 1:
+            return children[0]
+        return Node("PHRASE", children=children)
+
+
+def parse(tokens: List[str]) -> Node:
+    """Parse query tokens into expression tree.
+
+    Args:
+        tokens: List of query tokens, see `tokenize`.
+
+    Returns:
+        Root of expression tree.
+
+    Raises:
+        ValueError: If query is malformed.
+
+    """
+    return Parser(tokens).parse()
+
+
+def _flatten(node: Node, op: str) -> List[Node]:
+    """Get operands of nested operators op."""
+    if node.op != op:
+        return [node]
+    return [leaf for child in node.children for leaf in _flatten(child, op)]
+
+
+def normalize(node: Node, stem: Callable[[str], str]) -> str:
+    """Get canonical form of expression tree.
+
+    Queries that differ only in stems of their terms, order of operands
+    of AND and OR, nesting of AND and OR and parentheses have the same
+    canonical form.
+
+    Args:
+        node: Root of expression tree.
+        stem: Function that stems query tokens.
+
+    Returns:
+        Canonical form of query.
+
+    """
+    if node.op == "TERM":
+        return stem(node.token)
+    if node.op == "NOT":
+        return "NOT({})".format(normalize(node.children[0], stem))
+    if node.op == "PHRASE":
+        terms = [stem(c.token) for c in node.children]
+        return "PHRASE({})".format(" ".join(terms))
+    if node.op == "NEAR":
+        children = sorted(normalize(c, stem) for c in node.children)
+        return "NEAR/{}({})".format(node.distance, " ".join(children))
+    children = sorted(normalize(c, stem) for c in _flatten(node, node.op))
+    return "{}({})".format(node.op, " ".join(children))
+
+
+def _plan_not(child: Node, n_docs: int) -> Node:
+    """Make plan of complement of planned operand."""
+    return Node(
+        "NOT",
+        children=[child],
+        size=n_docs - child.size,
+        cost=child.cost + child.size,
+    )
+
+
+def _plan_or(children: List[Node], n_docs: int) -> Node:
+    """Make plan of union of planned operands."""
+    size = min(n_docs, sum(c.size for c in children))
+    cost = sum(c.cost + c.size for c in children)
+    return Node("OR", children=children, size=size, cost=cost)
+
+
+def plan(node: Node, df: Callable[[str], int], n_docs: int) -> Node:
+    """Make query plan of expression tree and estimate its cost.
+
+    Args:
+        node: Root of expression tree.
+        df: Function that gets document frequency of a query token.
+        n_docs: Number of documents in corpus.
+
+    Returns:
+        Root of query plan.
+
+    """
+    if node.op == "TERM":
+        size = df(node.token)
+        return Node("TERM", node.token, size=size, cost=size)
+    if node.op == "NOT":
+        return _plan_not(plan(node.children[0], df, n_docs), n_docs)
+    if node.op == "OR":
+        children = [plan(c, df, n_docs) for c in _flatten(node, "OR")]
+        return _plan_or(children, n_docs)
+    if node.op in POSITIONAL:
+        # Positions are decoded only in documents of the rarest operand
+        children = [plan(c, df, n_docs) for c in node.children]
+        size = min(c.size for c in children)
+        cost = sum(c.cost + size for c in children)
+        return node._replace(children=children, size=size, cost=cost)
+
+    children, excluded = [], []
+    for child in _flatten(node, "AND"):
+        if child.op == "NOT":
+            excluded.append(plan(child.children[0], df, n_docs))
+        else:
+            children.append(plan(child, df, n_docs))
+    if not children:
+        # NOT x AND NOT y is NOT (x OR y)
+        if len(excluded) == 1:
+            return _plan_not(excluded[0], n_docs)
+        return _plan_not(_plan_or(excluded, n_docs), n_docs)
+    children.sort(key=lambda c: (c.size, c.cost))
+    excluded.sort(key=lambda c: (c.size, c.cost))
+    # Every next operand is intersected with the result, not bigger than
+    # the smallest operand
+    size = children[0].size
+    cost = children[0].cost
+    for child in children[1:] + excluded:
+        cost += child.cost + min(child.size, size)
+    return Node(
+        "AND", children=children, excluded=excluded, size=size, cost=cost
+    )
+
+
+def explain(node: Node, indent: int = 0) -> str:
+    """Format query plan with estimated costs.
+
+    Args:
+        node: Root of query plan.
+        indent: Indentation of the root.
+
+    Returns:
+        Plan, one operator per line.
+
+    """
+    if node.token is not None:
+        label = "TERM '{}'".format(node.token)
+    elif node.op == "NEAR":
+        label = "NEAR/{}".format(node.distance)
+    else:
+        label = node.op
+    lines = [
+        "{}{} (hits ~{}, cost ~{})".format(
+            "  " * indent, label, node.size, node.cost
+        )
+    ]
+    for child in node.children:
+        lines.append(explain(child, indent + 1))
+    if node.excluded:
+        lines.append("{}EXCEPT".format("  " * (indent + 1)))
+        for child in node.excluded:
+            lines.append(explain(child, indent + 2))
+    return "\n".join(lines)
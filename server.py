@@ -0,0 +1,357 @@
+"""This module implements the long-running query server.
+
+Index, documents metadata and, optionally, DistilBERT model are loaded
+once, then queries are answered over TCP with a line protocol: every
+request is a JSON object on its own line, for example
+    {"id": 1, "q": "nothing AND else", "mode": "boolean", "count": 10}
+    {"id": 2, "q": "nothing else matters", "mode": "ml", "count": 20}
+    {"cmd": "stats"}
+and every response is a JSON object on its own line, with the same "id":
+    {"id": 1, "total": 42, "hits": [{"docId": 7, "doc": ..., "score": ...}],
+     "took_ms": 1.3}
+Modes are "boolean", "top_k" and "daat" of `Indexer.search`, "ml" of
+`query_ml.ml_search` and "hybrid" of `query_ml.hybrid_search`. Errors are
+reported as {"id": ..., "error": ...}.
+
+Connections are served concurrently by asyncio. Search runs in worker
+threads: Indexer is used by one thread at a time, while embedding of ML
+candidates runs outside of the lock.
+"""
+import argparse
+import asyncio
+import json
+import numpy as np
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from query import Indexer
+from typing import Any, ContextManager, Dict, Optional
+
+
+def _non_negative(request: Dict[str, Any], key: str, default: Any) -> Any:
+    """Get non-negative integer field of request.
+
+    Args:
+        request: Request object.
+        key: Field name.
+        default: Value if request has no such field.
+
+    Returns:
+        Value of field.
+
+    Raises:
+        ValueError: If value is not a non-negative integer.
+
+    """
+    if key not in request:
+        return default
+    value = request[key]
+    # bool is a subclass of int, but true isn't a count
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise ValueError(
+            "'{}' must be a non-negative integer, got {}".format(
+                key, json.dumps(value)
+            )
+        )
+    return value
+
+
+def run_request(
+    index: Indexer,
+    request: Dict[str, Any],
+    embedder: Optional[Any] = None,
+    batch_size: int = 100,
+    lock: Optional[ContextManager] = None,
+    embeddings: Optional[np.ndarray] = None,
+    dense: Optional[Any] = None,
+) -> Dict[str, Any]:
+    """Answer a request.
+
+    Args:
+        index: Indexer.
+        request: Request object.
+        embedder: Embedder, None if ML search is disabled.
+        batch_size: Batch size of embedder.
+        lock: Lock that is held while Indexer is used, if it is shared
+            between threads.
+        embeddings: Precomputed embeddings of corpus for ML search, see
+            `query_ml.l1_search`.
+        dense: Dense index of corpus embeddings for hybrid search, see
+            `dense_index.DenseIndex`.
+
+    Returns:
+        Response object, without "id".
+
+    Raises:
+        ValueError: If request is malformed.
+
+    """
+    if lock is None:
+        lock = nullcontext()
+    if request.get("cmd") == "stats":
+        with lock:
+            return {"cache": index.cache_stats()}
+    query = request.get("q")
+    if not isinstance(query, str):
+        raise ValueError("Request has no query 'q'")
+    mode = request.get("mode", "boolean")
+    count = _non_negative(request, "count", 10)
+
+    if mode == "ml":
+        if embedder is None:
+            raise ValueError("ML search is disabled, start with --ml")
+        # Imported here, because it imports torch
+        from query_ml import l0_search, l1_search
+
+        l0_size = _non_negative(request, "l0", 100)
+        with lock:
+            hits = l0_search(index, query, l0_size)
+        return {
+            "hits": l1_search(
+                index, embedder, query, hits, count, batch_size, embeddings
+            )
+        }
+
+    if mode == "hybrid":
+        if embedder is None or dense is None:
+            raise ValueError(
+                "Hybrid search is disabled, start with --ml and dense index"
+            )
+        from query_ml import dense_l0_search, fuse_hits, l0_search
+        from query_ml import remove_negated
+
+        l0_size = _non_negative(request, "l0", 100)
+        probe = _non_negative(request, "probe", None)
+        with lock:
+            hits = l0_search(index, query, l0_size)
+        dense_hits = dense_l0_search(embedder, dense, query, l0_size, probe)
+        with lock:
+            dense_hits = remove_negated(index, query, dense_hits)
+        return {"hits": fuse_hits(index, hits, dense_hits, count)}
+
+    with lock:
+        hits, total = index.search(query, count, mode)
+        return {
+            "total": total,
+            "hits": [
+                {"docId": docId, "doc": index.docs[docId], "score": score}
+                for docId, score in hits
+            ],
+        }
+
+
+class QueryServer:
+    """Class that answers queries with warm Indexer and Embedder.
+
+    Attributes:
+        index: Indexer.
+        embedder: Embedder, None if ML search is disabled.
+        batch_size: Batch size of embedder.
+        embeddings: Precomputed embeddings of corpus, memory-mapped.
+        dense: Dense index of corpus embeddings.
+        lock: Lock of Indexer.
+        executor: Worker threads that run searches.
+
+    """
+
+    def __init__(
+        self,
+        index: Indexer,
+        embedder: Optional[Any] = None,
+        batch_size: int = 100,
+        workers: int = 4,
+        embeddings: Optional[np.ndarray] = None,
+        dense: Optional[Any] = None,
+    ) -> None:
+        """Initialize QueryServer.
+
+        Args:
+            index: Indexer.
+            embedder: Embedder, None to disable ML search.
+            batch_size: Batch size of embedder.
+            workers: Number of worker threads.
+            embeddings: Precomputed embeddings of corpus, None to embed
+                candidates of ML search at query time.
+            dense: Dense index of corpus embeddings, None to disable
+                hybrid search.
+
+        """
+        self.index = index
+        self.embedder = embedder
+        self.batch_size = batch_size
+        self.embeddings = embeddings
+        self.dense = dense
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def search(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Answer a request, runs in a worker thread.
+
+        Args:
+            request: Request object.
+
+        Returns:
+            Response object, without "id".
+
+        Raises:
+            ValueError: If request is malformed.
+
+        """
+        return run_request(
+            self.index,
+            request,
+            self.embedder,
+            self.batch_size,
+            self.lock,
+            self.embeddings,
+            self.dense,
+        )
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Serve a connection, until client closes it."""
+        loop = asyncio.get_event_loop()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            request_id = None
+            start = time.perf_counter()
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("Request must be a JSON object")
+                request_id = request.get("id")
+                response = await loop.run_in_executor(
+                    self.executor, self.search, request
+                )
+            except ValueError as e:
+                response = {"error": str(e)}
+            except Exception as e:
+                # Failed search must not drop the connection
+                response = {"error": "{}: {}".format(type(e).__name__, e)}
+            response["id"] = request_id
+            response["took_ms"] = (time.perf_counter() - start) * 1000
+            writer.write(json.dumps(response).encode("utf-8") + b"\n")
+            await writer.drain()
+        writer.close()
+
+    async def serve(self, host: str, port: int) -> None:
+        """Accept connections forever."""
+        server = await asyncio.start_server(self.handle, host, port)
+        print("Serving on {}:{}".format(host, port), flush=True)
+        async with server:
+            await server.serve_forever()
+
+
+def arg_parse() -> argparse.Namespace:
+    """Parse command line arguments."""
+    # Imported here, because it imports torch, which only CLI needs
+    from embedder import BACKENDS
+
+    parser = argparse.ArgumentParser(description="Query server")
+    parser.add_argument(
+        "--root",
+        dest="root",
+        help="Lyrics root directory",
+        default="lyrics/",
+        type=str,
+    )
+    parser.add_argument(
+        "--index", dest="index", help="Index", default="index", type=str
+    )
+    parser.add_argument(
+        "--meta",
+        dest="meta",
+        help="Documents metadata file",
+        default="docs.meta",
+        type=str,
+    )
+    parser.add_argument(
+        "--store",
+        dest="store",
+        help="Packed documents file",
+        default="docs.store",
+        type=str,
+    )
+    parser.add_argument(
+        "--host", dest="host", help="Host", default="127.0.0.1", type=str
+    )
+    parser.add_argument(
+        "--port", dest="port", help="Port", default=8765, type=int
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        help="Number of worker threads",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--ml",
+        help="Load DistilBERT and enable ML search",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--emb",
+        dest="emb_file",
+        help="Numpy file with embeddings for all texts, used by ML search",
+        default="embeddings.npy",
+        type=str,
+    )
+    parser.add_argument(
+        "--ann",
+        dest="ann_file",
+        help="Dense index file of embeddings, enables hybrid search",
+        default="embeddings.faiss",
+        type=str,
+    )
+    parser.add_argument(
+        "--backend",
+        dest="backend",
+        help="Inference backend of embedder",
+        choices=BACKENDS,
+        default="torch",
+    )
+    parser.add_argument(
+        "--threads",
+        dest="threads",
+        help="Number of CPU threads of embedder, default if 0",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--bs",
+        dest="batch_size",
+        help="Batch size of ML search",
+        default=100,
+        type=int,
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+    index = Indexer(args.index, args.root, args.meta, args.store)
+    embedder = embeddings = dense = None
+    if args.ml:
+        from dense_index import load_dense_index
+        from embedder import Embedder
+        from query_ml import load_embeddings
+
+        embedder = Embedder(args.backend, args.threads)
+        embeddings = load_embeddings(args.emb_file, len(index.docs))
+        dense = load_dense_index(args.ann_file)
+    server = QueryServer(
+        index, embedder, args.batch_size, args.workers, embeddings, dense
+    )
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        index.close()
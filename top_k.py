@@ -0,0 +1,85 @@
+"""This module implements top-k retrieval with block-max WAND.
+
+Documents are scored by the sum of tf-idf weights of query terms, as in
+union of posting lists, but only k best documents are found: cursors skip
+documents (and whole blocks of postings) whose upper bound of score can't
+beat the current k-th best score.
+"""
+import heapq
+from operator import attrgetter
+from compression import END_DOC, PostingCursor
+from typing import List, Tuple
+
+Posting = Tuple[int, float]
+
+
+def wand_top_k(cursors: List[PostingCursor], k: int) -> List[Posting]:
+    """Block-max WAND over union of posting lists.
+
+    Args:
+        cursors: Cursors over posting lists of query terms.
+        k: How many best documents to find, none if not positive.
+
+    Returns:
+        List of k best (docID, score), sorted by score in descending order
+        and by docID among equal scores.
+
+    """
+    if k <= 0:
+        return []
+    cursors = list(cursors)
+    heap = []  # min-heap of (score, -docID) of k best documents
+    threshold = 0.0
+    by_doc = attrgetter("doc")
+    while True:
+        cursors.sort(key=by_doc)
+        # Exhausted cursors are sorted to the end
+        while cursors and cursors[-1].doc == END_DOC:
+            cursors.pop()
+        if not cursors:
+            break
+
+        # Find pivot: first cursor where sum of upper bounds beats threshold
+        upper_bound = 0.0
+        pivot = None
+        for i, cursor in enumerate(cursors):
+            upper_bound += cursor.max_score
+            if upper_bound > threshold or len(heap) < k:
+                pivot = i
+                break
+        if pivot is None:
+            break
+        pivot_doc = cursors[pivot].doc
+        while pivot + 1 < len(cursors) and cursors[pivot + 1].doc == pivot_doc:
+            pivot += 1
+
+        # Check tighter bound with maximal weights of current blocks
+        block_bound = 0.0
+        next_doc = END_DOC
+        for cursor in cursors[:pivot + 1]:
+            block_last, block_max = cursor.block_bound(pivot_doc)
+            block_bound += block_max
+            next_doc = min(next_doc, block_last + 1)
+        if block_bound <= threshold and len(heap) >= k:
+            # No document before the end of some block can beat threshold
+            if pivot + 1 < len(cursors):
+                next_doc = min(next_doc, cursors[pivot + 1].doc)
+            for cursor in cursors[:pivot + 1]:
+                cursor.advance(next_doc)
+        elif cursors[0].doc == pivot_doc:
+            # All cursors up to pivot are on pivot document, score it
+            score = 0.0
+            for cursor in cursors[:pivot + 1]:
+                score += cursor.score()
+                cursor.next()
+            if len(heap) < k:
+                heapq.heappush(heap, (score, -pivot_doc))
+            elif score > threshold:
+                heapq.heapreplace(heap, (score, -pivot_doc))
+            if len(heap) >= k:
+                threshold = heap[0][0]
+        else:
+            for cursor in cursors[:pivot]:
+                cursor.advance(pivot_doc)
+
+    return [(-docId, score) for score, docId in sorted(heap, reverse=True)]